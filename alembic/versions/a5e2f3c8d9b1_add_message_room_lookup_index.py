@@ -0,0 +1,27 @@
+"""Add message room lookup index
+
+Revision ID: a5e2f3c8d9b1
+Revises: 143181919790
+Create Date: 2021-10-20 14:02:41.318752
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5e2f3c8d9b1'
+down_revision = '143181919790'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Lookups by Matrix event ID are already covered by the (mxid, mx_room, tg_space) unique
+    # constraint, but find_last and delete_all had to scan the whole table.
+    op.create_index('ix_message_mx_room_tg_space_tgid', 'message',
+                    ['mx_room', 'tg_space', 'tgid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_mx_room_tg_space_tgid', table_name='message')
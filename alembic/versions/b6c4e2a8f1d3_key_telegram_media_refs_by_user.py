@@ -0,0 +1,52 @@
+"""Key telegram media refs by the user who sent them
+
+Revision ID: b6c4e2a8f1d3
+Revises: f1a7c3e5b9d2
+Create Date: 2021-11-02 14:12:08.417351
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6c4e2a8f1d3'
+down_revision = 'f1a7c3e5b9d2'
+branch_labels = None
+depends_on = None
+
+
+def _create_table(*extra_columns: sa.Column, primary_key: tuple) -> None:
+    op.create_table('telegram_media_ref',
+                    sa.Column('mxc', sa.String(), nullable=False),
+                    sa.Column('sticker', sa.Boolean(), nullable=False),
+                    *extra_columns,
+                    sa.Column('sha256', sa.String(), nullable=True),
+                    sa.Column('photo', sa.Boolean(), nullable=False),
+                    sa.Column('tg_id', sa.BigInteger(), nullable=False),
+                    sa.Column('access_hash', sa.BigInteger(), nullable=False),
+                    sa.Column('file_reference', sa.LargeBinary(), nullable=False),
+                    sa.Column('origin_chat', sa.BigInteger(), nullable=False),
+                    sa.Column('origin_msg_id', sa.BigInteger(), nullable=False),
+                    sa.Column('timestamp', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint(*primary_key))
+    op.create_index('ix_telegram_media_ref_sha256', 'telegram_media_ref', ['sha256'],
+                    unique=False)
+
+
+def _drop_table() -> None:
+    op.drop_index('ix_telegram_media_ref_sha256', table_name='telegram_media_ref')
+    op.drop_table('telegram_media_ref')
+
+
+def upgrade():
+    # The refs are only a cache and the old ones don't say who sent the media, so they're
+    # dropped instead of being migrated
+    _drop_table()
+    _create_table(sa.Column('tg_user', sa.BigInteger(), nullable=False),
+                  primary_key=('mxc', 'sticker', 'tg_user'))
+
+
+def downgrade():
+    _drop_table()
+    _create_table(primary_key=('mxc', 'sticker'))
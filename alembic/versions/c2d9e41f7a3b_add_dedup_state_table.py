@@ -0,0 +1,28 @@
+"""Add dedup state table
+
+Revision ID: c2d9e41f7a3b
+Revises: a5e2f3c8d9b1
+Create Date: 2021-10-22 10:48:13.592017
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d9e41f7a3b'
+down_revision = 'a5e2f3c8d9b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('dedup_state',
+                    sa.Column('tgid', sa.BigInteger(), nullable=False),
+                    sa.Column('tg_receiver', sa.BigInteger(), nullable=False),
+                    sa.Column('state', sa.Text(), nullable=False),
+                    sa.PrimaryKeyConstraint('tgid', 'tg_receiver'))
+
+
+def downgrade():
+    op.drop_table('dedup_state')
@@ -0,0 +1,28 @@
+"""Add content hash to telegram files
+
+Revision ID: e8b1d6f2c4a7
+Revises: c2d9e41f7a3b
+Create Date: 2021-10-25 16:21:37.204815
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b1d6f2c4a7'
+down_revision = 'c2d9e41f7a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("telegram_file") as batch_op:
+        batch_op.add_column(sa.Column('sha256', sa.String(), nullable=True))
+        batch_op.create_index('ix_telegram_file_sha256', ['sha256'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table("telegram_file") as batch_op:
+        batch_op.drop_index('ix_telegram_file_sha256')
+        batch_op.drop_column('sha256')
@@ -0,0 +1,38 @@
+"""Add telegram media ref table
+
+Revision ID: f1a7c3e5b9d2
+Revises: e8b1d6f2c4a7
+Create Date: 2021-10-26 11:37:52.861204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a7c3e5b9d2'
+down_revision = 'e8b1d6f2c4a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('telegram_media_ref',
+                    sa.Column('mxc', sa.String(), nullable=False),
+                    sa.Column('sticker', sa.Boolean(), nullable=False),
+                    sa.Column('sha256', sa.String(), nullable=True),
+                    sa.Column('photo', sa.Boolean(), nullable=False),
+                    sa.Column('tg_id', sa.BigInteger(), nullable=False),
+                    sa.Column('access_hash', sa.BigInteger(), nullable=False),
+                    sa.Column('file_reference', sa.LargeBinary(), nullable=False),
+                    sa.Column('origin_chat', sa.BigInteger(), nullable=False),
+                    sa.Column('origin_msg_id', sa.BigInteger(), nullable=False),
+                    sa.Column('timestamp', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('mxc', 'sticker'))
+    op.create_index('ix_telegram_media_ref_sha256', 'telegram_media_ref', ['sha256'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_telegram_media_ref_sha256', table_name='telegram_media_ref')
+    op.drop_table('telegram_media_ref')
@@ -28,17 +28,26 @@ from mautrix.util.opt_prometheus import Gauge
 
 from .web.provisioning import ProvisioningAPI
 from .web.public import PublicBridgeWebsite
-from .abstract_user import init as init_abstract_user
+from .abstract_user import AbstractUser, init as init_abstract_user
 from .bot import Bot, init as init_bot
 from .config import Config
 from .context import Context
-from .db import init as init_db
+from .db import init as init_db, Message as DBMessage
+from .db.message_queue import MessageWriteQueue
+from .db.message_cache import MessageCache
 from .db.user_activity import UserActivity
 from .formatter import init as init_formatter
 from .matrix import MatrixHandler
 from .portal import Portal, init as init_portal
+from .portal.deduplication import save_all as save_dedup_state
 from .puppet import Puppet, init as init_puppet
 from .user import User, init as init_user
+from .util.file_transfer import init as init_file_transfer
+from .util.parallel_file_transfer import init as init_parallel_file_transfer
+from .util.process_pool import init as init_process_pool
+from .util.sticker_cache import init as init_sticker_cache
+from .util.sticker_prewarm import init as init_sticker_prewarm
+from .util.tgs_converter import init as init_tgs_converter
 from .version import version, linkified_version
 
 try:
@@ -74,6 +83,7 @@ class TelegramBridge(Bridge):
 
     periodic_sync_task: asyncio.Task = None
     as_bridge_liveness_task: asyncio.Task = None
+    dedup_save_task: asyncio.Task = None
 
     latest_telegram_update_timestamp: float
 
@@ -99,6 +109,18 @@ class TelegramBridge(Bridge):
             self.context.provisioning_api = provisioning_api
 
     def prepare_bridge(self) -> None:
+        if self.config["bridge.message_write_batching.enabled"]:
+            DBMessage.write_queue = MessageWriteQueue(
+                DBMessage, max_size=self.config["bridge.message_write_batching.max_size"],
+                max_delay=self.config["bridge.message_write_batching.max_delay"])
+        if self.config["bridge.message_cache_size"] > 0:
+            DBMessage.cache = MessageCache(self.config["bridge.message_cache_size"])
+        init_file_transfer(self.config)
+        init_parallel_file_transfer(self.config)
+        init_process_pool(self.config)
+        init_sticker_cache(self.config)
+        init_sticker_prewarm(self.config)
+        init_tgs_converter(self.config)
         self.bot = init_bot(self.config)
         self.context = Context(self.az, self.config, self.loop, self.session_container, self, self.bot)
         self._prepare_website()
@@ -119,6 +141,9 @@ class TelegramBridge(Bridge):
         if self.config.get('telegram.liveness_timeout', 0) >= 1:
             self.as_bridge_liveness_task = self.loop.create_task(self._loop_check_bridge_liveness())
 
+        if self.config["bridge.deduplication.persist_interval"] > 0:
+            self.dedup_save_task = self.loop.create_task(self._loop_save_dedup_state())
+
     async def start(self) -> None:
         await super().start()
 
@@ -147,6 +172,27 @@ class TelegramBridge(Bridge):
 
         await asyncio.gather(*(sem_task(task) for task in init_user(self.context)))
 
+    async def stop(self) -> None:
+        # Handle the Telegram updates that were already received before the clients and the
+        # appservice HTTP session are closed, so that their message mappings are flushed below
+        for user in User.by_tgid.values():
+            user.stop_receiving_updates()
+        if AbstractUser.relaybot:
+            AbstractUser.relaybot.stop_receiving_updates()
+        self.log.debug("Waiting for queued Telegram updates to be handled")
+        await asyncio.gather(*(portal.work_queue.stop()
+                               for portal in list(Portal.by_tgid.values())))
+        # The redactions need the appservice HTTP session, which super().stop() closes
+        if AbstractUser.redaction_queue:
+            await AbstractUser.redaction_queue.stop()
+        await super().stop()
+        if self.config["bridge.deduplication.persist_interval"] > 0:
+            self.log.debug("Saving dedup state")
+            await save_dedup_state(list(Portal.by_tgid.values()))
+        if DBMessage.write_queue:
+            self.log.debug("Flushing buffered message mappings")
+            await DBMessage.write_queue.stop()
+
     async def resend_bridge_info(self) -> None:
         self.config["bridge.resend_bridge_info"] = False
         self.config.save()
@@ -162,6 +208,8 @@ class TelegramBridge(Bridge):
             self.as_connection_metric_task.cancel()
         if self.as_bridge_liveness_task:
             self.as_bridge_liveness_task.cancel()
+        if self.dedup_save_task:
+            self.dedup_save_task.cancel()
         for puppet in Puppet.by_custom_mxid.values():
             puppet.stop()
         self.shutdown_actions = (user.stop() for user in User.by_tgid.values())
@@ -194,7 +242,7 @@ class TelegramBridge(Bridge):
         self.az.live = True
 
     async def _update_active_puppet_metric(self) -> None:
-        active_users = UserActivity.get_active_count(
+        active_users = await UserActivity.get_active_count(
             self.config['bridge.limits.min_puppet_activity_days'],
             self.config['bridge.limits.puppet_inactivity_days'],
         )
@@ -244,6 +292,19 @@ class TelegramBridge(Bridge):
 
             await asyncio.sleep(15)
 
+    async def _loop_save_dedup_state(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(self.config["bridge.deduplication.persist_interval"])
+            except asyncio.CancelledError:
+                return
+            try:
+                await save_dedup_state(list(Portal.by_tgid.values()))
+            except asyncio.CancelledError:
+                return
+            except Exception:
+                self.log.exception("Failed to save dedup state")
+
     async def manhole_global_namespace(self, user_id: UserID) -> Dict[str, Any]:
         return {
             **await super().manhole_global_namespace(user_id),
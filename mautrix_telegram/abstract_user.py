@@ -13,7 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Optional, Union, Dict, Type, Any, TYPE_CHECKING
+from typing import (Tuple, Optional, Union, Dict, Type, Any, List, Callable, Awaitable,
+                    TYPE_CHECKING)
 from abc import ABC, abstractmethod
 import platform
 import asyncio
@@ -32,10 +33,9 @@ from telethon.tl.types import (
     UpdateShortChatMessage, UpdateShortMessage, UpdateUserName, UpdateUserPhoto, UpdateUserStatus,
     UpdateUserTyping, User, UserStatusOffline, UserStatusOnline, UpdateReadHistoryInbox,
     UpdateReadChannelInbox, MessageEmpty, UpdateFolderPeers, UpdatePinnedDialogs,
-    UpdateNotifySettings, UpdateChannelUserTyping)
+    UpdateNotifySettings, UpdateChannelUserTyping, MessageMediaPhoto, MessageMediaDocument)
 
 from mautrix.types import UserID, PresenceState
-from mautrix.errors import MatrixError
 from mautrix.appservice import AppService
 from mautrix.util.logging import TraceLogger
 from mautrix.util.opt_prometheus import Histogram, Counter
@@ -45,6 +45,9 @@ from . import portal as po, puppet as pu, __version__
 from .db import Message as DBMessage
 from .types import TelegramID
 from .tgclient import MautrixTelegramClient
+from .util.redaction_queue import RedactionQueue
+from .util.sender_pool import SenderPool
+from .portal.deduplication import SharedDedup
 
 if TYPE_CHECKING:
     from .context import Context
@@ -53,8 +56,6 @@ if TYPE_CHECKING:
     from .__main__ import TelegramBridge
 
 config: Optional['Config'] = None
-# Value updated from config in init()
-MAX_DELETIONS: int = 10
 
 UpdateMessage = Union[UpdateShortChatMessage, UpdateShortMessage, UpdateNewChannelMessage,
                       UpdateNewMessage, UpdateEditMessage, UpdateEditChannelMessage]
@@ -75,6 +76,8 @@ class AbstractUser(ABC):
     bridge: 'TelegramBridge'
     relaybot: Optional['Bot']
     ignore_incoming_bot_events: bool = True
+    redaction_queue: RedactionQueue = None
+    shared_dedup: SharedDedup = None
 
     client: Optional[MautrixTelegramClient]
     mxid: Optional[UserID]
@@ -91,6 +94,8 @@ class AbstractUser(ABC):
     matrix_puppet_whitelisted: bool
     is_admin: bool
 
+    _queued_private_updates: Dict['po.Portal', int]
+
     def __init__(self) -> None:
         self.is_admin = False
         self.matrix_puppet_whitelisted = False
@@ -100,6 +105,7 @@ class AbstractUser(ABC):
         self.client = None
         self.is_relaybot = False
         self.is_bot = False
+        self._queued_private_updates = {}
 
     @property
     def connected(self) -> bool:
@@ -194,15 +200,41 @@ class AbstractUser(ABC):
     async def _update_catch(self, update: TypeUpdate) -> None:
         start_time = time.time()
         update_type = type(update).__name__
+        queued = False
         try:
-            if not await self.update(update):
-                await self._update(update)
+            # Bots may ignore or handle updates differently than normal users' clients, so they
+            # shouldn't mark them as handled for everyone else.
+            if not self.is_bot and not self.is_relaybot and self.shared_dedup.is_duplicate(update):
+                self.log.trace("Ignoring %s as another client already received it", update_type)
+            elif not await self.update(update):
+                queued = await self._update(update)
         except Exception:
             self.log.exception("Failed to handle Telegram update")
             UPDATE_ERRORS.labels(update_type=update_type).inc()
-        UPDATE_TIME.labels(update_type=update_type).observe(time.time() - start_time)
+        if not queued:
+            # Queued updates are timed by _handle_queued_update when they're actually handled
+            UPDATE_TIME.labels(update_type=update_type).observe(time.time() - start_time)
         self.bridge.confirm_bridge_liveness()
 
+    async def _queue_portal_update(self, portal: po.Portal, update: TypeUpdate,
+                                   func: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        seq = await portal.work_queue.push(self._handle_queued_update, type(update).__name__,
+                                           func, args)
+        if portal.peer_type != "channel":
+            # Remember the latest update for delete_message(), which has to wait for these
+            self._queued_private_updates[portal] = seq
+        return True
+
+    async def _handle_queued_update(self, update_type: str, func: Callable[..., Awaitable[Any]],
+                                    args: Tuple[Any, ...]) -> None:
+        start_time = time.time()
+        try:
+            await func(*args)
+        except Exception:
+            self.log.exception("Failed to handle Telegram update")
+            UPDATE_ERRORS.labels(update_type=update_type).inc()
+        UPDATE_TIME.labels(update_type=update_type).observe(time.time() - start_time)
+
     @property
     @abstractmethod
     def name(self) -> str:
@@ -233,21 +265,29 @@ class AbstractUser(ABC):
             await self.start(delete_unless_authenticated=not even_if_no_session)
         return self
 
+    def stop_receiving_updates(self) -> None:
+        if self.client:
+            self.client.remove_event_handler(self._update_catch)
+
     async def stop(self) -> None:
+        await SenderPool.close_all(self.client)
         await self.client.disconnect()
         self.client = None
 
     # region Telegram update handling
 
-    async def _update(self, update: TypeUpdate) -> None:
+    async def _update(self, update: TypeUpdate) -> bool:
+        """Handle an update. Returns ``True`` if it was queued to be handled in a portal."""
         asyncio.create_task(self._handle_entity_updates(getattr(update, "_entities", {})))
+        # Everything that refers to messages goes through the portal queues, so that it's
+        # handled after the messages that were received before it
         if isinstance(update, (UpdateShortChatMessage, UpdateShortMessage, UpdateNewChannelMessage,
                                UpdateNewMessage, UpdateEditMessage, UpdateEditChannelMessage)):
-            await self.update_message(update)
+            return await self.update_message(update)
         elif isinstance(update, UpdateDeleteMessages):
             await self.delete_message(update)
         elif isinstance(update, UpdateDeleteChannelMessages):
-            await self.delete_channel_message(update)
+            return await self.delete_channel_message(update)
         elif isinstance(update, (UpdateChatUserTyping, UpdateChannelUserTyping, UpdateUserTyping)):
             await self.update_typing(update)
         elif isinstance(update, UpdateUserStatus):
@@ -257,13 +297,13 @@ class AbstractUser(ABC):
         elif isinstance(update, UpdateChatParticipants):
             await self.update_participants(update)
         elif isinstance(update, (UpdatePinnedMessages, UpdatePinnedChannelMessages)):
-            await self.update_pinned_messages(update)
+            return await self.update_pinned_messages(update)
         elif isinstance(update, (UpdateUserName, UpdateUserPhoto)):
             await self.update_others_info(update)
         elif isinstance(update, UpdateReadHistoryOutbox):
-            await self.update_read_receipt(update)
+            return await self.update_read_receipt(update)
         elif isinstance(update, (UpdateReadHistoryInbox, UpdateReadChannelInbox)):
-            await self.update_own_read_receipt(update)
+            return await self.update_own_read_receipt(update)
         elif isinstance(update, UpdateFolderPeers):
             await self.update_folder_peers(update)
         elif isinstance(update, UpdatePinnedDialogs):
@@ -272,6 +312,7 @@ class AbstractUser(ABC):
             await self.update_notify_settings(update)
         else:
             self.log.trace("Unhandled update: %s", update)
+        return False
 
     async def update_folder_peers(self, update: UpdateFolderPeers) -> None:
         pass
@@ -283,14 +324,15 @@ class AbstractUser(ABC):
         pass
 
     async def update_pinned_messages(self, update: Union[UpdatePinnedMessages,
-                                                         UpdatePinnedChannelMessages]) -> None:
+                                                         UpdatePinnedChannelMessages]) -> bool:
         if isinstance(update, UpdatePinnedMessages):
             portal = po.Portal.get_by_entity(update.peer, receiver_id=self.tgid)
         else:
             portal = po.Portal.get_by_tgid(TelegramID(update.channel_id))
-        if portal and portal.mxid:
-            await portal.receive_telegram_pin_ids(update.messages, self.tgid,
-                                                  remove=not update.pinned)
+        if not portal or not portal.mxid:
+            return False
+        return await self._queue_portal_update(portal, update, portal.receive_telegram_pin_ids,
+                                               update.messages, self.tgid, not update.pinned)
 
     @staticmethod
     async def update_participants(update: UpdateChatParticipants) -> None:
@@ -298,17 +340,22 @@ class AbstractUser(ABC):
         if portal and portal.mxid:
             await portal.update_power_levels(update.participants.participants)
 
-    async def update_read_receipt(self, update: UpdateReadHistoryOutbox) -> None:
+    async def update_read_receipt(self, update: UpdateReadHistoryOutbox) -> bool:
         if not isinstance(update.peer, PeerUser):
             self.log.debug("Unexpected read receipt peer: %s", update.peer)
-            return
+            return False
 
         portal = po.Portal.get_by_tgid(TelegramID(update.peer.user_id), self.tgid)
         if not portal or not portal.mxid:
-            return
+            return False
+        return await self._queue_portal_update(portal, update, self._handle_read_receipt,
+                                               update, portal)
 
+    async def _handle_read_receipt(self, update: UpdateReadHistoryOutbox, portal: po.Portal
+                                   ) -> None:
         # We check that these are user read receipts, so tg_space is always the user ID.
-        message = DBMessage.get_one_by_tgid(TelegramID(update.max_id), self.tgid, edit_index=-1)
+        message = await DBMessage.get_one_by_tgid(TelegramID(update.max_id), self.tgid,
+                                                  edit_index=-1)
         if not message:
             return
 
@@ -316,10 +363,10 @@ class AbstractUser(ABC):
         await puppet.intent.mark_read(portal.mxid, message.mxid)
 
     async def update_own_read_receipt(self, update: Union[UpdateReadHistoryInbox,
-                                                          UpdateReadChannelInbox]) -> None:
+                                                          UpdateReadChannelInbox]) -> bool:
         puppet = pu.Puppet.get(self.tgid)
         if not puppet.is_real_user:
-            return
+            return False
 
         if isinstance(update, UpdateReadChannelInbox):
             portal = po.Portal.get_by_tgid(TelegramID(update.channel_id))
@@ -329,13 +376,19 @@ class AbstractUser(ABC):
             portal = po.Portal.get_by_tgid(TelegramID(update.peer.user_id), self.tgid)
         else:
             self.log.debug("Unexpected own read receipt peer: %s", update.peer)
-            return
+            return False
 
         if not portal or not portal.mxid:
-            return
+            return False
+        return await self._queue_portal_update(portal, update, self._handle_own_read_receipt,
+                                               update, portal, puppet)
 
+    async def _handle_own_read_receipt(self, update: Union[UpdateReadHistoryInbox,
+                                                           UpdateReadChannelInbox],
+                                       portal: po.Portal, puppet: pu.Puppet) -> None:
         tg_space = portal.tgid if portal.peer_type == "channel" else self.tgid
-        message = DBMessage.get_one_by_tgid(TelegramID(update.max_id), tg_space, edit_index=-1)
+        message = await DBMessage.get_one_by_tgid(TelegramID(update.max_id), tg_space,
+                                                  edit_index=-1)
         if not message:
             return
 
@@ -436,65 +489,78 @@ class AbstractUser(ABC):
             return update, None, None
         return update, sender, portal
 
-    @staticmethod
-    async def _try_redact(message: DBMessage) -> None:
-        portal = po.Portal.get_by_mxid(message.mx_room)
-        if not portal:
-            return
-        try:
-            await portal.main_intent.redact(message.mx_room, message.mxid)
-        except MatrixError:
-            pass
+    async def _delete_messages(self, message_ids: List[int], tg_space: TelegramID,
+                               redact_if_unused: bool = False) -> None:
+        messages = await DBMessage.delete_by_tgids([TelegramID(message_id)
+                                                    for message_id in message_ids], tg_space)
+        if messages and redact_if_unused:
+            # In normal groups, the event is only redacted after it has been deleted for everyone
+            remaining = await DBMessage.count_spaces_by_mxids(list({message.mxid
+                                                                    for message in messages}))
+            messages = [message for message in messages
+                        if remaining.get((message.mxid, message.mx_room), 0) == 0]
+        for message in messages:
+            portal = po.Portal.get_by_mxid(message.mx_room)
+            if portal:
+                self.redaction_queue.push(portal.main_intent, message.mx_room, message.mxid)
 
     async def delete_message(self, update: UpdateDeleteMessages) -> None:
-        if len(update.messages) > MAX_DELETIONS:
-            return
-
-        for message_id in update.messages:
-            for message in DBMessage.get_all_by_tgid(TelegramID(message_id), self.tgid):
-                if message.redacted:
-                    continue
-                message.delete()
-                number_left = DBMessage.count_spaces_by_mxid(message.mxid, message.mx_room)
-                if number_left == 0:
-                    await self._try_redact(message)
-
-    async def delete_channel_message(self, update: UpdateDeleteChannelMessages) -> None:
-        if len(update.messages) > MAX_DELETIONS:
-            return
-
+        # Deletions outside channels don't say which chat they're in, so wait until the updates
+        # this user received before them have been handled in normal group and private chat
+        # portals. Otherwise a deleted message that was still queued would be bridged after the
+        # deletion. Other users' updates can't contain messages in this user's message ID space.
+        queued = list(self._queued_private_updates.items())
+        await asyncio.gather(*(portal.work_queue.wait_for_pending(seq) for portal, seq in queued))
+        for portal, seq in queued:
+            if self._queued_private_updates.get(portal) == seq:
+                del self._queued_private_updates[portal]
+        await self._delete_messages(update.messages, self.tgid, redact_if_unused=True)
+
+    async def delete_channel_message(self, update: UpdateDeleteChannelMessages) -> bool:
         channel_id = TelegramID(update.channel_id)
-
-        for message_id in update.messages:
-            for message in DBMessage.get_all_by_tgid(TelegramID(message_id), channel_id):
-                if message.redacted:
-                    continue
-                message.delete()
-                await self._try_redact(message)
-
-    async def update_message(self, original_update: UpdateMessage) -> None:
+        portal = po.Portal.get_by_tgid(channel_id)
+        if not portal:
+            await self._delete_messages(update.messages, channel_id)
+            return False
+        return await self._queue_portal_update(portal, update, self._delete_channel_messages,
+                                               portal, update.messages)
+
+    async def _delete_channel_messages(self, portal: po.Portal, message_ids: List[int]) -> None:
+        # Messages with files may still be in the middle of being bridged
+        await asyncio.gather(*(portal.work_queue.wait_for_background((portal.tgid, message_id))
+                               for message_id in message_ids))
+        await self._delete_messages(message_ids, portal.tgid)
+
+    async def update_message(self, original_update: UpdateMessage) -> bool:
         update, sender, portal = self.get_message_details(original_update)
         if not portal:
-            return
+            return False
         elif portal and not portal.allow_bridging:
             self.log.debug(f"Ignoring message in portal {portal.tgid_log} (bridging disallowed)")
-            return
+            return False
 
         if self.is_relaybot:
             if update.is_private:
                 if not config["bridge.relaybot.private_chat.invite"]:
                     self.log.debug(f"Ignoring private message to bot from {sender.id}")
-                    return
+                    return False
             elif not portal.mxid and config["bridge.relaybot.ignore_unbridged_group_chat"]:
                 self.log.debug("Ignoring message received by bot"
                                f" in unbridged chat {portal.tgid_log}")
-                return
+                return False
 
         if ((self.ignore_incoming_bot_events and self.relaybot
              and sender and sender.id == self.relaybot.tgid)):
             self.log.debug(f"Ignoring relaybot-sent message %s to %s", update.id, portal.tgid_log)
-            return
+            return False
+
+        return await self._queue_portal_update(portal, original_update,
+                                               self._handle_portal_message, original_update,
+                                               update, sender, portal)
 
+    async def _handle_portal_message(self, original_update: UpdateMessage,
+                                     update: UpdateMessageContent, sender: Optional[pu.Puppet],
+                                     portal: po.Portal) -> None:
         await portal.backfill_lock.wait(update.id)
 
         if isinstance(update, MessageService):
@@ -508,17 +574,31 @@ class AbstractUser(ABC):
                            (sender.id if sender else 0))
             return await portal.handle_telegram_action(self, sender, update)
 
+        tg_space = portal.tgid if portal.peer_type == "channel" else self.tgid
         if isinstance(original_update, (UpdateEditMessage, UpdateEditChannelMessage)):
+            # Edits of messages whose files are still being transferred must wait for the send
+            await portal.work_queue.wait_for_background((tg_space, update.id))
             return await portal.handle_telegram_edit(self, sender, update)
+        if isinstance(getattr(update, "media", None), (MessageMediaPhoto, MessageMediaDocument)):
+            # File transfers can take a long time, so they shouldn't hold up the later updates
+            portal.work_queue.run_in_background((tg_space, update.id),
+                                                portal.handle_telegram_message(self, sender,
+                                                                               update))
+            return
         return await portal.handle_telegram_message(self, sender, update)
 
     # endregion
 
 
 def init(context: 'Context') -> None:
-    global config, MAX_DELETIONS
+    global config
     AbstractUser.az, config, AbstractUser.loop, AbstractUser.relaybot = context.core
     AbstractUser.bridge = context.bridge
     AbstractUser.ignore_incoming_bot_events = config["bridge.relaybot.ignore_own_incoming_events"]
     AbstractUser.session_container = context.session_container
-    MAX_DELETIONS = config.get("bridge.max_telegram_delete", 10)
+    AbstractUser.redaction_queue = RedactionQueue(
+        concurrency=config["bridge.telegram_delete.concurrency"],
+        rate_limit=config["bridge.telegram_delete.rate_limit"])
+    AbstractUser.shared_dedup = SharedDedup(
+        max_size=config["bridge.deduplication.shared_cache_length"],
+        max_age=config["bridge.deduplication.cache_max_age"])
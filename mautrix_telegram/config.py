@@ -94,7 +94,8 @@ class Config(BaseBridgeConfig):
             copy("bridge.sync_update_limit")
             copy("bridge.sync_create_limit")
         copy("bridge.sync_direct_chats")
-        copy("bridge.max_telegram_delete")
+        copy("bridge.telegram_delete.concurrency")
+        copy("bridge.telegram_delete.rate_limit")
         copy("bridge.sync_matrix_state")
         copy("bridge.allow_matrix_login")
         copy("bridge.plaintext_highlights")
@@ -115,9 +116,30 @@ class Config(BaseBridgeConfig):
         copy("bridge.image_as_file_size")
         copy("bridge.max_document_size")
         copy("bridge.parallel_file_transfer")
+        copy("bridge.media_stream_buffer")
+        copy("bridge.media_content_dedup")
+        copy("bridge.reverse_media_cache")
+        copy("bridge.parallel_transfer_budget.max_connections")
+        copy("bridge.parallel_transfer_budget.max_connections_per_dc")
+        copy("bridge.parallel_transfer_budget.max_connections_per_user")
+        copy("bridge.parallel_transfer_budget.max_connections_per_transfer")
+        copy("bridge.parallel_transfer_budget.max_bytes_in_flight")
+        copy("bridge.parallel_transfer_budget.connection_idle_timeout")
+        copy("bridge.transfer_spool.directory")
+        copy("bridge.transfer_spool.max_size")
+        copy("bridge.transfer_spool.max_age")
+        copy("bridge.media_process_pool.workers")
+        copy("bridge.media_process_pool.timeout")
         copy("bridge.federate_rooms")
         copy("bridge.animated_sticker.target")
         copy("bridge.animated_sticker.args")
+        copy("bridge.sticker_cache.directory")
+        copy("bridge.sticker_cache.max_size")
+        copy("bridge.sticker_conversion.max_parallel")
+        copy("bridge.sticker_conversion.timeout")
+        copy("bridge.sticker_prewarm.enabled")
+        copy("bridge.sticker_prewarm.max_sets_per_hour")
+        copy("bridge.sticker_prewarm.max_bytes_per_day")
         copy("bridge.encryption.allow")
         copy("bridge.encryption.default")
         copy("bridge.encryption.database")
@@ -154,6 +176,15 @@ class Config(BaseBridgeConfig):
 
         copy("bridge.deduplication.pre_db_check")
         copy("bridge.deduplication.cache_queue_length")
+        copy("bridge.deduplication.cache_max_age")
+        copy("bridge.deduplication.shared_cache_length")
+        copy("bridge.deduplication.persist_interval")
+
+        copy("bridge.message_write_batching.enabled")
+        copy("bridge.message_write_batching.max_size")
+        copy("bridge.message_write_batching.max_delay")
+        copy("bridge.message_cache_size")
+        copy("bridge.portal_queue_size")
 
         if "bridge.message_formats.m_text" in self:
             del self["bridge.message_formats"]
@@ -18,15 +18,19 @@ from sqlalchemy.engine.base import Engine
 from mautrix.client.state_store.sqlalchemy import UserProfile, RoomState
 
 from .bot_chat import BotChat
+from .dedup_state import DedupState
 from .message import Message
 from .portal import Portal
 from .puppet import Puppet
 from .telegram_file import TelegramFile
+from .telegram_media_ref import TelegramMediaRef
 from .user import User, UserPortal, Contact
 from .user_activity import UserActivity
+from . import executor
 
 
 def init(db_engine: Engine) -> None:
     for table in (Portal, Message, User, Contact, UserPortal, Puppet, TelegramFile, UserProfile,
-                  RoomState, BotChat, UserActivity):
+                  RoomState, BotChat, UserActivity, DedupState, TelegramMediaRef):
         table.bind(db_engine)
+    executor.init(db_engine)
@@ -0,0 +1,56 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterable, Optional
+
+from sqlalchemy import Column, BigInteger, Text, and_
+
+from mautrix.util.db import Base
+
+from ..types import TelegramID
+from .executor import in_thread
+
+
+class DedupState(Base):
+    __tablename__ = "dedup_state"
+
+    tgid: TelegramID = Column(BigInteger, primary_key=True)
+    tg_receiver: TelegramID = Column(BigInteger, primary_key=True)
+    # JSON-serialized PortalDedup windows
+    state: str = Column(Text, nullable=False)
+
+    @classmethod
+    @in_thread
+    def get(cls, tgid: TelegramID, tg_receiver: TelegramID) -> Optional['DedupState']:
+        return cls._select_one_or_none(cls.c.tgid == tgid, cls.c.tg_receiver == tg_receiver)
+
+    @classmethod
+    @in_thread
+    def save_all(cls, states: Iterable['DedupState']) -> None:
+        states = list(states)
+        if not states:
+            return
+        with cls.db.begin() as conn:
+            for state in states:
+                conn.execute(cls.t.delete().where(and_(cls.c.tgid == state.tgid,
+                                                       cls.c.tg_receiver == state.tg_receiver)))
+            conn.execute(cls.t.insert(), [{"tgid": state.tgid, "tg_receiver": state.tg_receiver,
+                                           "state": state.state} for state in states])
+
+    @classmethod
+    @in_thread
+    def delete_by_tgid(cls, tgid: TelegramID, tg_receiver: TelegramID) -> None:
+        cls.db.execute(cls.t.delete().where(and_(cls.c.tgid == tgid,
+                                                 cls.c.tg_receiver == tg_receiver)))
@@ -0,0 +1,74 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import asyncio
+import time
+
+from sqlalchemy.engine.base import Engine
+
+from mautrix.util.opt_prometheus import Histogram
+
+T = TypeVar("T")
+
+DB_QUERY_TIME = Histogram("bridge_db_query_time", "Time spent waiting for database queries",
+                          ("query",))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _pool_size(db_engine: Engine) -> int:
+    if db_engine.dialect.name == "sqlite":
+        # SQLite only allows one writer at a time, so more threads would only cause lock errors
+        return 1
+    try:
+        return db_engine.pool.size() + max(db_engine.pool._max_overflow, 0)
+    except AttributeError:
+        return 5
+
+
+def init(db_engine: Engine) -> None:
+    global _executor
+    if _executor:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=_pool_size(db_engine),
+                                   thread_name_prefix="mxtg_db")
+
+
+def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> Awaitable[T]:
+    """Run a blocking database function in the database thread pool.
+
+    The SQLAlchemy engine already keeps a connection pool, so the executor is sized to match it
+    and every worker thread can hold its own connection while the event loop keeps running.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def in_thread(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Turn a blocking model method into a coroutine that runs in the database thread pool."""
+    query = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        start_time = time.time()
+        try:
+            return await run_sync(func, *args, **kwargs)
+        finally:
+            DB_QUERY_TIME.labels(query=query).observe(time.time() - start_time)
+
+    return wrapper
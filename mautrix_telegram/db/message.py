@@ -13,20 +13,38 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterator, List
+from typing import Any, Dict, Iterable, Iterator, Optional, List, Tuple, TypeVar
+import asyncio
 
-from sqlalchemy import (Column, UniqueConstraint, BigInteger, Integer, String, Boolean, and_, func,
-                        desc, select, false)
+from sqlalchemy import (Column, UniqueConstraint, Index, BigInteger, Integer, String, Boolean,
+                        and_, or_, func, desc, select, false)
 
 from mautrix.types import RoomID, EventID
 from mautrix.util.db import Base
 
 from ..types import TelegramID
+from .executor import in_thread
+from .message_queue import MessageWriteQueue
+from .message_cache import MessageCache
+
+T = TypeVar("T")
+
+# SQLite doesn't allow more than 999 bound parameters per query
+IN_QUERY_CHUNK_SIZE = 500
+
+
+def _chunks(items: List[T]) -> Iterator[List[T]]:
+    for i in range(0, len(items), IN_QUERY_CHUNK_SIZE):
+        yield items[i:i + IN_QUERY_CHUNK_SIZE]
 
 
 class Message(Base):
     __tablename__ = "message"
 
+    # Set in init() when write batching or caching is enabled
+    write_queue: Optional[MessageWriteQueue] = None
+    cache: Optional[MessageCache] = None
+
     mxid: EventID = Column(String)
     mx_room: RoomID = Column(String)
     tgid: TelegramID = Column(BigInteger, primary_key=True)
@@ -34,15 +52,61 @@ class Message(Base):
     edit_index: int = Column(Integer, primary_key=True)
     redacted: bool = Column(Boolean, server_default=false())
 
-    __table_args__ = (UniqueConstraint("mxid", "mx_room", "tg_space", name="_mx_id_room_2"),)
+    __table_args__ = (UniqueConstraint("mxid", "mx_room", "tg_space", name="_mx_id_room_2"),
+                      Index("ix_message_mx_room_tg_space_tgid", "mx_room", "tg_space", "tgid"))
+
+    @classmethod
+    async def _flush_writes(cls) -> None:
+        if cls.write_queue:
+            await cls.write_queue.flush()
+
+    @classmethod
+    def _cache_rows(cls, rows: Iterable['Message'], generation: int) -> None:
+        if cls.cache:
+            for row in rows:
+                cls.cache.put(row, generation)
+
+    @classmethod
+    def _generation(cls) -> int:
+        return cls.cache.generation if cls.cache else 0
 
     @classmethod
-    def get_all_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID) -> Iterator['Message']:
-        return cls._select_all(cls.c.tgid == tgid, cls.c.tg_space == tg_space)
+    async def get_all_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID) -> List['Message']:
+        await cls._flush_writes()
+        return await cls._get_all_by_tgid(tgid, tg_space)
 
     @classmethod
-    def get_one_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID, edit_index: int = 0
-                        ) -> Optional['Message']:
+    @in_thread
+    def _get_all_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID) -> List['Message']:
+        return list(cls._select_all(cls.c.tgid == tgid, cls.c.tg_space == tg_space))
+
+    @classmethod
+    async def get_one_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID, edit_index: int = 0
+                              ) -> Optional['Message']:
+        if cls.cache and edit_index >= -1:
+            cached = (cls.cache.get_latest(tgid, tg_space) if edit_index == -1
+                      else cls.cache.get_by_tgid(tgid, tg_space, edit_index))
+            if cached:
+                return cached
+        if cls.write_queue and edit_index >= -1:
+            pending = await cls.write_queue.lookup(
+                lambda row: (row["tgid"] == tgid and row["tg_space"] == tg_space
+                             and (edit_index < 0 or row["edit_index"] == edit_index)),
+                latest_edit=edit_index < 0)
+            if pending:
+                return pending
+        elif edit_index < -1:
+            await cls._flush_writes()
+        generation = cls._generation()
+        msg = await cls._get_one_by_tgid(tgid, tg_space, edit_index)
+        if msg and cls.cache:
+            cls.cache.put(msg, generation, latest=edit_index == -1)
+        return msg
+
+    @classmethod
+    @in_thread
+    def _get_one_by_tgid(cls, tgid: TelegramID, tg_space: TelegramID, edit_index: int = 0
+                         ) -> Optional['Message']:
         if edit_index < 0:
             return cls._one_or_none(cls.db.execute(
                 cls.t.select()
@@ -54,13 +118,41 @@ class Message(Base):
                                            cls.c.edit_index == edit_index)
 
     @classmethod
-    def get_first_by_tgids(cls, tgids: List[TelegramID], tg_space: TelegramID
-                           ) -> Iterator['Message']:
-        return cls._select_all(cls.c.tgid.in_(tgids), cls.c.tg_space == tg_space,
-                               cls.c.edit_index == 0)
+    async def get_first_by_tgids(cls, tgids: List[TelegramID], tg_space: TelegramID
+                                 ) -> List['Message']:
+        found = []
+        if cls.cache:
+            missing = []
+            for tgid in tgids:
+                cached = cls.cache.get_by_tgid(tgid, tg_space, 0)
+                if cached:
+                    found.append(cached)
+                else:
+                    missing.append(tgid)
+            if not missing:
+                return found
+            tgids = missing
+        await cls._flush_writes()
+        generation = cls._generation()
+        rows = await cls._get_first_by_tgids(tgids, tg_space)
+        cls._cache_rows(rows, generation)
+        return found + rows
+
+    @classmethod
+    @in_thread
+    def _get_first_by_tgids(cls, tgids: List[TelegramID], tg_space: TelegramID
+                            ) -> List['Message']:
+        return list(cls._select_all(cls.c.tgid.in_(tgids), cls.c.tg_space == tg_space,
+                                    cls.c.edit_index == 0))
 
     @classmethod
-    def count_spaces_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> int:
+    async def count_spaces_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> int:
+        await cls._flush_writes()
+        return await cls._count_spaces_by_mxid(mxid, mx_room)
+
+    @classmethod
+    @in_thread
+    def _count_spaces_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> int:
         rows = cls.db.execute(select([func.count(cls.c.tg_space)])
                               .where(and_(cls.c.mxid == mxid, cls.c.mx_room == mx_room)))
         try:
@@ -70,39 +162,203 @@ class Message(Base):
             return 0
 
     @classmethod
-    def find_last(cls, mx_room: RoomID, tg_space: TelegramID) -> Optional['Message']:
+    async def count_spaces_by_mxids(cls, mxids: List[EventID]
+                                    ) -> Dict[Tuple[EventID, RoomID], int]:
+        await cls._flush_writes()
+        return await cls._count_spaces_by_mxids(mxids)
+
+    @classmethod
+    @in_thread
+    def _count_spaces_by_mxids(cls, mxids: List[EventID]) -> Dict[Tuple[EventID, RoomID], int]:
+        counts = {}
+        for chunk in _chunks(mxids):
+            rows = cls.db.execute(select([cls.c.mxid, cls.c.mx_room, func.count(cls.c.tg_space)])
+                                  .where(cls.c.mxid.in_(chunk))
+                                  .group_by(cls.c.mxid, cls.c.mx_room))
+            for mxid, mx_room, count in rows:
+                counts[(mxid, mx_room)] = count
+        return counts
+
+    @classmethod
+    async def delete_by_tgids(cls, tgids: List[TelegramID], tg_space: TelegramID
+                              ) -> List['Message']:
+        """Delete all non-redacted mappings of the given messages and return the deleted rows."""
+        await cls._flush_writes()
+        deleted = await cls._delete_by_tgids(tgids, tg_space)
+        if cls.cache:
+            for msg in deleted:
+                cls.cache.remove(msg.tgid, msg.tg_space, msg.edit_index)
+        return deleted
+
+    @classmethod
+    @in_thread
+    def _delete_by_tgids(cls, tgids: List[TelegramID], tg_space: TelegramID
+                         ) -> List['Message']:
+        deleted = []
+        with cls.db.begin() as conn:
+            for chunk in _chunks(tgids):
+                # Mappings inserted without an explicit redaction state have it set to NULL
+                where = and_(cls.c.tgid.in_(chunk), cls.c.tg_space == tg_space,
+                             or_(cls.c.redacted == false(), cls.c.redacted.is_(None)))
+                deleted += [cls.scan(row) for row in conn.execute(cls.t.select().where(where))]
+                conn.execute(cls.t.delete().where(where))
+        return deleted
+
+    @classmethod
+    async def find_last(cls, mx_room: RoomID, tg_space: TelegramID) -> Optional['Message']:
+        await cls._flush_writes()
+        return await cls._find_last(mx_room, tg_space)
+
+    @classmethod
+    @in_thread
+    def _find_last(cls, mx_room: RoomID, tg_space: TelegramID) -> Optional['Message']:
         return cls._one_or_none(cls.db.execute(
             cls._make_simple_select(cls.c.mx_room == mx_room, cls.c.tg_space == tg_space)
                 .order_by(desc(cls.c.tgid)).limit(1)))
 
     @classmethod
-    def delete_all(cls, mx_room: RoomID) -> None:
+    async def delete_all(cls, mx_room: RoomID) -> None:
+        if cls.cache:
+            cls.cache.remove_room(mx_room)
+        await cls._flush_writes()
+        await cls._delete_all(mx_room)
+
+    @classmethod
+    @in_thread
+    def _delete_all(cls, mx_room: RoomID) -> None:
         cls.db.execute(cls.t.delete().where(cls.c.mx_room == mx_room))
 
     @classmethod
-    def get_by_mxid(cls, mxid: EventID, mx_room: RoomID, tg_space: TelegramID
-                    ) -> Optional['Message']:
+    async def get_by_mxid(cls, mxid: EventID, mx_room: RoomID, tg_space: TelegramID
+                          ) -> Optional['Message']:
+        if cls.cache:
+            cached = cls.cache.get_by_mxid(mxid, mx_room, tg_space)
+            if cached:
+                return cached
+        if cls.write_queue:
+            pending = await cls.write_queue.lookup(
+                lambda row: (row["mxid"] == mxid and row["mx_room"] == mx_room
+                             and row["tg_space"] == tg_space))
+            if pending:
+                return pending
+        generation = cls._generation()
+        msg = await cls._get_by_mxid(mxid, mx_room, tg_space)
+        if msg:
+            cls._cache_rows((msg,), generation)
+        return msg
+
+    @classmethod
+    @in_thread
+    def _get_by_mxid(cls, mxid: EventID, mx_room: RoomID, tg_space: TelegramID
+                     ) -> Optional['Message']:
         return cls._select_one_or_none(cls.c.mxid == mxid, cls.c.mx_room == mx_room,
                                        cls.c.tg_space == tg_space)
 
     @classmethod
-    def get_by_mxids(cls, mxids: List[EventID], mx_room: RoomID, tg_space: TelegramID
-                     ) -> Iterator['Message']:
-        return cls._select_all(cls.c.mxid.in_(mxids), cls.c.mx_room == mx_room,
-                               cls.c.tg_space == tg_space)
+    async def get_by_mxids(cls, mxids: List[EventID], mx_room: RoomID, tg_space: TelegramID
+                           ) -> List['Message']:
+        found = []
+        if cls.cache:
+            missing = []
+            for mxid in mxids:
+                cached = cls.cache.get_by_mxid(mxid, mx_room, tg_space)
+                if cached:
+                    found.append(cached)
+                else:
+                    missing.append(mxid)
+            if not missing:
+                return found
+            mxids = missing
+        await cls._flush_writes()
+        generation = cls._generation()
+        rows = await cls._get_by_mxids(mxids, mx_room, tg_space)
+        cls._cache_rows(rows, generation)
+        return found + rows
 
     @classmethod
-    def update_by_tgid(cls, s_tgid: TelegramID, s_tg_space: TelegramID, s_edit_index: int,
-                       **values) -> None:
-        with cls.db.begin() as conn:
-            conn.execute(cls.t.update()
-                         .where(and_(cls.c.tgid == s_tgid, cls.c.tg_space == s_tg_space,
-                                     cls.c.edit_index == s_edit_index))
-                         .values(**values))
+    @in_thread
+    def _get_by_mxids(cls, mxids: List[EventID], mx_room: RoomID, tg_space: TelegramID
+                      ) -> List['Message']:
+        return list(cls._select_all(cls.c.mxid.in_(mxids), cls.c.mx_room == mx_room,
+                                    cls.c.tg_space == tg_space))
+
+    @classmethod
+    async def update_by_tgid(cls, s_tgid: TelegramID, s_tg_space: TelegramID, s_edit_index: int,
+                             **values) -> None:
+        if cls.cache:
+            cls.cache.remove(s_tgid, s_tg_space, s_edit_index)
+        await cls._update(and_(cls.c.tgid == s_tgid, cls.c.tg_space == s_tg_space,
+                               cls.c.edit_index == s_edit_index), values)
 
     @classmethod
-    def update_by_mxid(cls, s_mxid: EventID, s_mx_room: RoomID, **values) -> None:
+    async def update_by_mxid(cls, s_mxid: EventID, s_mx_room: RoomID, **values) -> None:
+        if cls.cache:
+            cls.cache.remove_by_mxid(s_mxid, s_mx_room)
+        await cls._update(and_(cls.c.mxid == s_mxid, cls.c.mx_room == s_mx_room), values)
+
+    @classmethod
+    async def _update(cls, where: Any, values: Dict[str, Any]) -> None:
+        if cls.write_queue:
+            await cls.write_queue.update(where, values)
+        else:
+            await cls._update_now(where, values)
+
+    @classmethod
+    @in_thread
+    def _update_now(cls, where: Any, values: Dict[str, Any]) -> None:
         with cls.db.begin() as conn:
-            conn.execute(cls.t.update()
-                         .where(and_(cls.c.mxid == s_mxid, cls.c.mx_room == s_mx_room))
-                         .values(**values))
+            conn.execute(cls.t.update().where(where).values(**values))
+
+    @property
+    def _row_values(self) -> Dict[str, Any]:
+        return {col.key: getattr(self, col.key) for col in self.c}
+
+    async def insert(self) -> 'asyncio.Future[None]':
+        """Insert the mapping.
+
+        Returns:
+            A future that's resolved when the row has been written. With write batching, this
+            method returns before the write, so database errors like ``IntegrityError`` are only
+            raised by the future. Without batching, they're raised right away.
+        """
+        if self.write_queue:
+            written = await self.write_queue.insert(self._row_values)
+        else:
+            await self._insert_now()
+            written = asyncio.get_event_loop().create_future()
+            written.set_result(None)
+        if self.cache:
+            self.cache.put(self, inserted=True)
+        return written
+
+    @in_thread
+    def _insert_now(self) -> None:
+        super().insert()
+
+    def _uncache(self) -> None:
+        if self.cache:
+            self.cache.remove(self.tgid, self.tg_space, self.edit_index)
+
+    async def delete(self) -> None:
+        self._uncache()
+        if self.write_queue:
+            await self.write_queue.delete(self._edit_identity)
+        else:
+            await self._delete_now()
+
+    @in_thread
+    def _delete_now(self) -> None:
+        super().delete()
+
+    async def edit(self, **values) -> None:
+        self._uncache()
+        if self.write_queue:
+            await self.write_queue.update(self._edit_identity, values)
+            for key, value in values.items():
+                setattr(self, key, value)
+        else:
+            await self._edit_now(**values)
+
+    @in_thread
+    def _edit_now(self, **values) -> None:
+        super().edit(**values)
@@ -0,0 +1,170 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+
+from mautrix.types import RoomID, EventID
+from mautrix.util.opt_prometheus import Counter
+
+from ..types import TelegramID
+
+if TYPE_CHECKING:
+    from .message import Message
+
+CACHE_HITS = Counter("bridge_message_cache_hits", "Message mapping lookups answered from memory",
+                     ("lookup",))
+CACHE_MISSES = Counter("bridge_message_cache_misses",
+                       "Message mapping lookups that had to go to the database", ("lookup",))
+
+TelegramKey = Tuple[TelegramID, TelegramID, int]
+MessageKey = Tuple[TelegramID, TelegramID]
+MatrixKey = Tuple[EventID, RoomID]
+
+
+class MessageCache:
+    """Bounded LRU cache of message mappings that can be looked up from either side.
+
+    Entries are keyed by ``(tgid, tg_space, edit_index)``. The Matrix side is a secondary index
+    from ``(mxid, mx_room)`` to the Telegram spaces the event is mapped in, because the same
+    event can be mapped once per Telegram user in normal groups. The latest known edit of each
+    message is tracked too, for lookups with ``edit_index == -1`` like read receipts.
+
+    The cache keeps its own copies of the rows and hands out copies too, so callers can change
+    the rows they get (e.g. with :meth:`Message.edit`) without changing the cached entries.
+    """
+    max_size: int
+
+    _by_tgid: 'OrderedDict[TelegramKey, Message]'
+    _by_mxid: Dict[MatrixKey, Dict[TelegramID, TelegramKey]]
+    _latest: Dict[MessageKey, int]
+    _generation: int
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.max_size = max_size
+        self._by_tgid = OrderedDict()
+        self._by_mxid = {}
+        self._latest = {}
+        self._generation = 0
+
+    def get_by_tgid(self, tgid: TelegramID, tg_space: TelegramID, edit_index: int
+                    ) -> Optional['Message']:
+        key = (tgid, tg_space, edit_index)
+        try:
+            msg = self._by_tgid[key]
+        except KeyError:
+            CACHE_MISSES.labels(lookup="tgid").inc()
+            return None
+        self._by_tgid.move_to_end(key)
+        CACHE_HITS.labels(lookup="tgid").inc()
+        return self._copy(msg)
+
+    def get_by_mxid(self, mxid: EventID, mx_room: RoomID, tg_space: TelegramID
+                    ) -> Optional['Message']:
+        try:
+            key = self._by_mxid[(mxid, mx_room)][tg_space]
+        except KeyError:
+            CACHE_MISSES.labels(lookup="mxid").inc()
+            return None
+        self._by_tgid.move_to_end(key)
+        CACHE_HITS.labels(lookup="mxid").inc()
+        return self._copy(self._by_tgid[key])
+
+    def get_latest(self, tgid: TelegramID, tg_space: TelegramID) -> Optional['Message']:
+        edit_index = self._latest.get((tgid, tg_space))
+        if edit_index is None:
+            CACHE_MISSES.labels(lookup="latest").inc()
+            return None
+        key = (tgid, tg_space, edit_index)
+        self._by_tgid.move_to_end(key)
+        CACHE_HITS.labels(lookup="latest").inc()
+        return self._copy(self._by_tgid[key])
+
+    @staticmethod
+    def _copy(msg: 'Message') -> 'Message':
+        return type(msg)(**msg._row_values)
+
+    @property
+    def generation(self) -> int:
+        """A counter that changes whenever entries are invalidated.
+
+        Rows read from the database should be passed to :meth:`put` with the generation from
+        before the query, so that a row deleted while the query was running isn't cached.
+        """
+        return self._generation
+
+    def put(self, msg: 'Message', generation: Optional[int] = None, latest: bool = False,
+            inserted: bool = False) -> None:
+        """Cache a row.
+
+        Args:
+            msg: The row to cache.
+            generation: The :attr:`generation` from before the row was read from the database.
+            latest: Whether the row was read as the latest edit of the message.
+            inserted: Whether the row was just inserted. It replaces the cached latest edit if
+                it directly follows it, otherwise the latest edit is unknown again.
+        """
+        if generation is not None and generation != self._generation:
+            return
+        key = (msg.tgid, msg.tg_space, msg.edit_index)
+        old = self._by_tgid.pop(key, None)
+        if old:
+            self._forget(key, old)
+        self._by_tgid[key] = self._copy(msg)
+        self._by_mxid.setdefault((msg.mxid, msg.mx_room), {})[msg.tg_space] = key
+        if inserted:
+            if self._latest.get((msg.tgid, msg.tg_space)) == msg.edit_index - 1:
+                self._latest[(msg.tgid, msg.tg_space)] = msg.edit_index
+            else:
+                self._latest.pop((msg.tgid, msg.tg_space), None)
+        elif latest and (msg.tgid, msg.tg_space, msg.edit_index + 1) not in self._by_tgid:
+            # A newer edit that was inserted while the row was being read is cached already
+            self._latest[(msg.tgid, msg.tg_space)] = msg.edit_index
+        while len(self._by_tgid) > self.max_size:
+            self._forget(*self._by_tgid.popitem(last=False))
+
+    def _forget(self, key: TelegramKey, msg: 'Message') -> None:
+        if self._latest.get((msg.tgid, msg.tg_space)) == msg.edit_index:
+            del self._latest[(msg.tgid, msg.tg_space)]
+        spaces = self._by_mxid.get((msg.mxid, msg.mx_room))
+        if spaces and spaces.get(msg.tg_space) == key:
+            del spaces[msg.tg_space]
+            if not spaces:
+                del self._by_mxid[(msg.mxid, msg.mx_room)]
+
+    def remove(self, tgid: TelegramID, tg_space: TelegramID, edit_index: int) -> None:
+        self._generation += 1
+        self._latest.pop((tgid, tg_space), None)
+        key = (tgid, tg_space, edit_index)
+        msg = self._by_tgid.pop(key, None)
+        if msg:
+            self._forget(key, msg)
+
+    def remove_by_mxid(self, mxid: EventID, mx_room: RoomID) -> None:
+        self._generation += 1
+        for key in list(self._by_mxid.get((mxid, mx_room), {}).values()):
+            self.remove(*key)
+
+    def remove_room(self, mx_room: RoomID) -> None:
+        self._generation += 1
+        for key, msg in list(self._by_tgid.items()):
+            if msg.mx_room == mx_room:
+                self.remove(*key)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._by_tgid.clear()
+        self._by_mxid.clear()
+        self._latest.clear()
@@ -0,0 +1,204 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+import asyncio
+import logging
+
+from sqlalchemy.sql.elements import ClauseElement
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Histogram
+
+from .executor import run_sync
+
+if TYPE_CHECKING:
+    from .message import Message
+
+WRITE_BATCH_SIZE = Histogram("bridge_message_write_batch_size",
+                             "Number of message table writes flushed in one transaction",
+                             buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# ("insert", row values, None, result) or ("update"/"delete", where clause, values, result)
+WriteOp = Tuple[str, Any, Optional[Dict[str, Any]], 'asyncio.Future[None]']
+
+
+class MessageWriteQueue:
+    """Write-behind queue that coalesces ``message`` table writes into multi-row transactions.
+
+    Writes are flushed when ``max_size`` operations are pending or ``max_delay`` seconds after the
+    first pending operation, whichever comes first. Lookups go through :meth:`lookup`, which
+    answers from the pending inserts or flushes the queue first, so callers always read their own
+    writes. Each write returns a future that raises the database error if the write failed.
+    """
+    log: TraceLogger = logging.getLogger("mau.db.message_queue")
+
+    model: 'Message'
+    max_size: int
+    max_delay: float
+
+    _pending: List[WriteOp]
+    _flushing: List[WriteOp]
+    _flush_lock: asyncio.Lock
+    _timer: Optional[asyncio.Task]
+
+    def __init__(self, model: 'Message', max_size: int = 100, max_delay: float = 1) -> None:
+        self.model = model
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending = []
+        self._flushing = []
+        self._flush_lock = asyncio.Lock()
+        self._timer = None
+
+    @property
+    def _only_inserts(self) -> bool:
+        return all(op[0] == "insert" for op in self._flushing + self._pending)
+
+    async def _push(self, op: str, arg: Any, values: Optional[Dict[str, Any]] = None
+                    ) -> 'asyncio.Future[None]':
+        result = asyncio.get_event_loop().create_future()
+        self._pending.append((op, arg, values, result))
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+        elif not self._timer:
+            self._timer = asyncio.ensure_future(self._flush_later())
+        return result
+
+    async def insert(self, values: Dict[str, Any]) -> 'asyncio.Future[None]':
+        return await self._push("insert", values)
+
+    async def update(self, where: ClauseElement, values: Dict[str, Any]
+                     ) -> 'asyncio.Future[None]':
+        return await self._push("update", where, values)
+
+    async def delete(self, where: ClauseElement) -> 'asyncio.Future[None]':
+        return await self._push("delete", where)
+
+    async def lookup(self, match: Callable[[Dict[str, Any]], bool], latest_edit: bool = False
+                     ) -> Optional['Message']:
+        """Find a row that has been written but may not have been flushed yet.
+
+        If updates or deletions are pending, the queue is flushed instead and ``None`` is
+        returned, which means the caller should query the database.
+        """
+        if not self._pending and not self._flushing:
+            return None
+        elif not self._only_inserts:
+            await self.flush()
+            return None
+        found = None
+        for _, values, _, _ in self._flushing + self._pending:
+            if match(values) and (not found or (latest_edit
+                                                and values["edit_index"] > found["edit_index"])):
+                found = values
+        return self.model(**found) if found else None
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.max_delay)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            self.log.exception("Failed to flush message writes")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            flushing = self._flushing = self._pending
+            self._pending = []
+            WRITE_BATCH_SIZE.observe(len(flushing))
+            try:
+                failed = await run_sync(self._write, flushing)
+            except BaseException as e:
+                # _write handles database errors itself, so this is most likely a cancellation,
+                # in which case the thread may still finish the writes
+                for op in flushing:
+                    self.log.error(f"Message write may have been lost: {op[0]} {op[1]}")
+                    self._set_result(op[3], e)
+                raise
+            finally:
+                self._flushing = []
+            for op in flushing:
+                error = failed.get(id(op))
+                if error and op[0] == "insert" and self.model.cache:
+                    values = op[1]
+                    self.model.cache.remove(values["tgid"], values["tg_space"],
+                                            values["edit_index"])
+                self._set_result(op[3], error)
+
+    @staticmethod
+    def _set_result(result: 'asyncio.Future[None]', error: Optional[BaseException]) -> None:
+        if result.done():
+            return
+        elif not error:
+            result.set_result(None)
+            return
+        elif isinstance(error, asyncio.CancelledError):
+            result.cancel()
+            return
+        result.set_exception(error)
+        # Failed writes are already logged, so don't warn about callers that don't check them
+        result.exception()
+
+    async def stop(self) -> None:
+        await self.flush()
+
+    def _execute(self, conn: Any, ops: List[WriteOp]) -> None:
+        table = self.model.t
+        inserts = []
+        for op, arg, values, _ in ops:
+            if op == "insert":
+                inserts.append(arg)
+                continue
+            elif inserts:
+                conn.execute(table.insert(), inserts)
+                inserts = []
+            if op == "update":
+                conn.execute(table.update().where(arg).values(**values))
+            elif op == "delete":
+                conn.execute(table.delete().where(arg))
+        if inserts:
+            conn.execute(table.insert(), inserts)
+
+    def _write(self, ops: List[WriteOp]) -> Dict[int, Exception]:
+        """Write the operations and return the errors of the failed ones by ``id(op)``."""
+        try:
+            with self.model.db.begin() as conn:
+                self._execute(conn, ops)
+            return {}
+        except Exception as e:
+            self.log.warning(f"{e.__class__.__name__} while flushing {len(ops)} message writes, "
+                             "retrying them one by one")
+        failed = {}
+        for op in ops:
+            try:
+                with self.model.db.begin() as conn:
+                    self._execute(conn, [op])
+            except Exception as e:
+                failed[id(op)] = e
+                self.log.exception(f"{e.__class__.__name__} while saving message mapping. This "
+                                   "might mean that an update was handled after it left the dedup "
+                                   "cache queue. You can try enabling bridge.deduplication."
+                                   "pre_db_check in the config. "
+                                   f"Failed operation: {op[0]} {op[1]}")
+        return failed
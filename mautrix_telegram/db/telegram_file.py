@@ -15,12 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional, cast, Dict, Any, TYPE_CHECKING
 
-from sqlalchemy import (Column, ForeignKey, Integer, BigInteger, String, Boolean, Text,
+from sqlalchemy import (Column, ForeignKey, Index, Integer, BigInteger, String, Boolean, Text,
                         TypeDecorator)
 
 from mautrix.types import ContentURI, EncryptedFile
 from mautrix.util.db import Base
 
+from .executor import in_thread
+
 if TYPE_CHECKING:
     from sqlalchemy.engine.result import RowProxy
 
@@ -60,22 +62,35 @@ class TelegramFile(Base):
     decryption_info: Optional[Dict[str, Any]] = Column(DBEncryptedFile, nullable=True)
     thumbnail_id: str = Column("thumbnail", String, ForeignKey("telegram_file.id"), nullable=True)
     thumbnail: Optional['TelegramFile'] = None
+    # SHA-256 of the uploaded plaintext, only set for unencrypted uploads
+    sha256: Optional[str] = Column(String, nullable=True)
+
+    __table_args__ = (Index("ix_telegram_file_sha256", "sha256"),)
 
     @classmethod
     def scan(cls, row: 'RowProxy') -> 'TelegramFile':
         telegram_file = cast(TelegramFile, super().scan(row))
         if isinstance(telegram_file.thumbnail, str):
-            telegram_file.thumbnail = cls.get(telegram_file.thumbnail)
+            telegram_file.thumbnail = cls._select_one_or_none(
+                cls.c.id == telegram_file.thumbnail)
         return telegram_file
 
     @classmethod
+    @in_thread
     def get(cls, loc_id: str) -> Optional['TelegramFile']:
         return cls._select_one_or_none(cls.c.id == loc_id)
 
+    @classmethod
+    @in_thread
+    def get_by_sha256(cls, sha256: str) -> Optional['TelegramFile']:
+        return cls._select_one_or_none(cls.c.sha256 == sha256)
+
+    @in_thread
     def insert(self) -> None:
         with self.db.begin() as conn:
             conn.execute(self.t.insert().values(
                 id=self.id, mxc=self.mxc, mime_type=self.mime_type,
                 was_converted=self.was_converted, timestamp=self.timestamp, size=self.size,
                 width=self.width, height=self.height, decryption_info=self.decryption_info,
-                thumbnail=self.thumbnail.id if self.thumbnail else self.thumbnail_id))
+                thumbnail=self.thumbnail.id if self.thumbnail else self.thumbnail_id,
+                sha256=self.sha256))
@@ -0,0 +1,132 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional, Union
+import time
+
+from sqlalchemy import Column, Index, BigInteger, String, Boolean, LargeBinary, and_
+
+from telethon.tl.patched import Message
+from telethon.tl.types import (MessageMediaPhoto, MessageMediaDocument, Photo, Document,
+                               InputMediaPhoto, InputMediaDocument, InputPhoto, InputDocument)
+
+from mautrix.types import ContentURI
+from mautrix.util.db import Base
+
+from ..types import TelegramID
+from .executor import in_thread
+
+
+class TelegramMediaRef(Base):
+    """A Telegram photo or document that a Matrix file has already been uploaded as.
+
+    Refs are stored per Telegram user, because the access hash and file reference are only
+    valid for the user who sent the media, and only they can refresh the file reference from
+    the origin message.
+    """
+    __tablename__ = "telegram_media_ref"
+
+    # The MXC URI of the file, or of the ciphertext for encrypted files
+    mxc: ContentURI = Column(String, primary_key=True)
+    # Stickers are converted before uploading, so they're cached separately
+    sticker: bool = Column(Boolean, primary_key=True)
+    # The user whose client sent the media
+    tg_user: TelegramID = Column(BigInteger, primary_key=True)
+    # SHA-256 of the plaintext, only set for files that were downloaded into memory
+    sha256: Optional[str] = Column(String, nullable=True)
+    photo: bool = Column(Boolean, nullable=False)
+    tg_id: int = Column(BigInteger, nullable=False)
+    access_hash: int = Column(BigInteger, nullable=False)
+    file_reference: bytes = Column(LargeBinary, nullable=False)
+    # The message the media was sent in, which is used for refreshing the file reference
+    origin_chat: int = Column(BigInteger, nullable=False)
+    origin_msg_id: int = Column(BigInteger, nullable=False)
+    timestamp: int = Column(BigInteger, nullable=False)
+
+    __table_args__ = (Index("ix_telegram_media_ref_sha256", "sha256"),)
+
+    @property
+    def input_media(self) -> Union[InputMediaPhoto, InputMediaDocument]:
+        if self.photo:
+            return InputMediaPhoto(InputPhoto(self.tg_id, self.access_hash, self.file_reference))
+        return InputMediaDocument(InputDocument(self.tg_id, self.access_hash,
+                                                self.file_reference))
+
+    @staticmethod
+    def _get_media(message: Message) -> Optional[Union[Photo, Document]]:
+        if isinstance(message.media, MessageMediaPhoto) and isinstance(message.media.photo,
+                                                                       Photo):
+            return message.media.photo
+        elif (isinstance(message.media, MessageMediaDocument)
+              and isinstance(message.media.document, Document)):
+            return message.media.document
+        return None
+
+    @classmethod
+    def from_message(cls, mxc: ContentURI, sticker: bool, tg_user: TelegramID,
+                     sha256: Optional[str], message: Message) -> Optional['TelegramMediaRef']:
+        media = cls._get_media(message)
+        if not media:
+            return None
+        return cls(mxc=mxc, sticker=sticker, tg_user=tg_user, sha256=sha256,
+                   photo=isinstance(media, Photo),
+                   tg_id=media.id, access_hash=media.access_hash,
+                   file_reference=media.file_reference, origin_chat=message.chat_id,
+                   origin_msg_id=message.id, timestamp=int(time.time()))
+
+    def update_file_reference(self, message: Message) -> bool:
+        media = self._get_media(message)
+        if not media or media.id != self.tg_id:
+            return False
+        self.file_reference = media.file_reference
+        return True
+
+    @classmethod
+    @in_thread
+    def get(cls, mxc: ContentURI, sticker: bool, tg_user: TelegramID
+            ) -> Optional['TelegramMediaRef']:
+        return cls._select_one_or_none(cls.c.mxc == mxc, cls.c.sticker == sticker,
+                                       cls.c.tg_user == tg_user)
+
+    @classmethod
+    @in_thread
+    def get_by_sha256(cls, sha256: str, sticker: bool, tg_user: TelegramID
+                      ) -> Optional['TelegramMediaRef']:
+        return cls._select_one_or_none(cls.c.sha256 == sha256, cls.c.sticker == sticker,
+                                       cls.c.tg_user == tg_user)
+
+    @property
+    def _edit_identity(self):
+        return and_(self.c.mxc == self.mxc, self.c.sticker == self.sticker,
+                    self.c.tg_user == self.tg_user)
+
+    @in_thread
+    def upsert(self) -> None:
+        with self.db.begin() as conn:
+            conn.execute(self.t.delete().where(self._edit_identity))
+            conn.execute(self.t.insert().values(
+                mxc=self.mxc, sticker=self.sticker, tg_user=self.tg_user, sha256=self.sha256,
+                photo=self.photo, tg_id=self.tg_id, access_hash=self.access_hash,
+                file_reference=self.file_reference, origin_chat=self.origin_chat,
+                origin_msg_id=self.origin_msg_id, timestamp=self.timestamp))
+
+    @in_thread
+    def save_file_reference(self) -> None:
+        self.db.execute(self.t.update().where(self._edit_identity)
+                        .values(file_reference=self.file_reference))
+
+    @in_thread
+    def delete(self) -> None:
+        self.db.execute(self.t.delete().where(self._edit_identity))
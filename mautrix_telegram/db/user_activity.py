@@ -23,6 +23,7 @@ from mautrix.util.db import Base
 from mautrix.util.logging import TraceLogger
 
 from ..types import TelegramID
+from .executor import in_thread
 
 import logging
 import datetime
@@ -50,6 +51,7 @@ class UserActivity(Base):
         self.edit(last_activity_ts=self.last_activity_ts)
 
     @classmethod
+    @in_thread
     def update_for_puppet(cls, puppet: 'Puppet', activity_dt: datetime) -> None:
         activity_ts = int(activity_dt.timestamp() * 1000)
 
@@ -73,6 +75,7 @@ class UserActivity(Base):
         return (self.last_activity_ts - self.first_activity_ts / 1000) / ONE_DAY_MS
 
     @classmethod
+    @in_thread
     def get_active_count(cls, min_activity_days: int, max_activity_days: Optional[int]) -> int:
         current_ms = time.time() * 1000
 
@@ -64,14 +64,14 @@ class FormatError(Exception):
     pass
 
 
-def matrix_reply_to_telegram(content: MessageEventContent, tg_space: TelegramID,
-                             room_id: Optional[RoomID] = None) -> Optional[TelegramID]:
+async def matrix_reply_to_telegram(content: MessageEventContent, tg_space: TelegramID,
+                                   room_id: Optional[RoomID] = None) -> Optional[TelegramID]:
     event_id = content.get_reply_to()
     if not event_id:
         return
     content.trim_reply_fallback()
 
-    message = DBMessage.get_by_mxid(event_id, room_id, tg_space)
+    message = await DBMessage.get_by_mxid(event_id, room_id, tg_space)
     if message:
         return message.tgid
     return None
@@ -44,12 +44,13 @@ if TYPE_CHECKING:
 log: logging.Logger = logging.getLogger("mau.fmt.tg")
 
 
-def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser') -> Optional[RelatesTo]:
+async def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser'
+                                   ) -> Optional[RelatesTo]:
     if evt.reply_to:
         space = (evt.peer_id.channel_id
                  if isinstance(evt, Message) and isinstance(evt.peer_id, PeerChannel)
                  else source.tgid)
-        msg = DBMessage.get_one_by_tgid(TelegramID(evt.reply_to.reply_to_msg_id), space)
+        msg = await DBMessage.get_one_by_tgid(TelegramID(evt.reply_to.reply_to_msg_id), space)
         if msg:
             return RelatesTo(rel_type=RelationType.REPLY, event_id=msg.mxid)
     return None
@@ -122,7 +123,7 @@ async def _add_reply_header(source: 'AbstractUser', content: TextMessageEventCon
              if isinstance(evt, Message) and isinstance(evt.peer_id, PeerChannel)
              else source.tgid)
 
-    msg = DBMessage.get_one_by_tgid(TelegramID(evt.reply_to.reply_to_msg_id), space)
+    msg = await DBMessage.get_one_by_tgid(TelegramID(evt.reply_to.reply_to_msg_id), space)
     if not msg:
         return
 
@@ -153,7 +154,7 @@ async def telegram_to_matrix(evt: Message, source: "AbstractUser",
     entities = override_entities or evt.entities
     if entities:
         content.format = Format.HTML
-        content.formatted_body = _telegram_entities_to_matrix_catch(content.body, entities)
+        content.formatted_body = await _telegram_entities_to_matrix_catch(content.body, entities)
 
     if prefix_html:
         if not content.formatted_body:
@@ -183,9 +184,10 @@ async def telegram_to_matrix(evt: Message, source: "AbstractUser",
     return content
 
 
-def _telegram_entities_to_matrix_catch(text: str, entities: List[TypeMessageEntity]) -> str:
+async def _telegram_entities_to_matrix_catch(text: str, entities: List[TypeMessageEntity]
+                                             ) -> str:
     try:
-        return _telegram_entities_to_matrix(text, entities)
+        return await _telegram_entities_to_matrix(text, entities)
     except Exception:
         log.exception("Failed to convert Telegram format:\n"
                       "message=%s\n"
@@ -194,64 +196,99 @@ def _telegram_entities_to_matrix_catch(text: str, entities: List[TypeMessageEnti
     return "[failed conversion in _telegram_entities_to_matrix]"
 
 
-def _telegram_entities_to_matrix(text: str, entities: List[TypeMessageEntity],
-                                 offset: int = 0, length: int = None) -> str:
+async def _telegram_entities_to_matrix(text: str, entities: List[TypeMessageEntity]) -> str:
     if not entities:
         return escape(text)
-    if length is None:
-        length = len(text)
-    html = []
-    last_offset = 0
-    for i, entity in enumerate(entities):
-        if entity.offset > offset + length:
-            break
-        relative_offset = entity.offset - offset
-        if relative_offset > last_offset:
-            html.append(escape(text[last_offset:relative_offset]))
-        elif relative_offset < last_offset:
+    # Each entity is rendered from the entities after it that start within it. An entity that
+    # starts where the previous one ended is therefore rendered empty inside the previous one, and
+    # overlapping entities are cut off at the end of the first one.
+    entity_count = len(entities)
+    stack = []
+    # The entity whose HTML is being rendered, starting with the whole message. start and end
+    # are the bounds of its text, which are cut off at the end of the parent entity, and limit is
+    # the end of the entity itself. The state of the parent entities is kept in the stack.
+    entity, start, end, offset, limit = None, 0, len(text), 0, len(text)
+    index, relative_offset, last_offset, html = 0, 0, 0, []
+    while True:
+        if index < entity_count:
+            child = entities[index]
+            index += 1
+            if child.offset > limit:
+                index = entity_count
+                continue
+            child_relative_offset = child.offset - offset
+            if child_relative_offset < last_offset:
+                continue
+            child_start = start + child_relative_offset
+            if child_start > end:
+                child_start = end
+            if child_relative_offset > last_offset:
+                text_start = start + last_offset
+                html.append(escape(text[text_start if text_start < end else end:child_start]))
+            child_end = child_start + child.length
+            if child_end > end:
+                child_end = end
+            child_limit = child.offset + child.length
+            if index < entity_count and entities[index].offset <= child_limit:
+                stack.append((entity, start, end, offset, limit, index, relative_offset,
+                              last_offset, html))
+                entity, start, end, offset, limit = (child, child_start, child_end,
+                                                     child.offset, child_limit)
+                relative_offset, last_offset, html = child_relative_offset, 0, []
+                continue
+            # Most entities don't have any others inside them, so they're rendered right away
+            skip_entity = await _entity_to_html(html, child, escape(text[child_start:child_end]))
+            last_offset = child_relative_offset + (0 if skip_entity else child.length)
             continue
 
-        skip_entity = False
-        entity_text = _telegram_entities_to_matrix(
-            text=text[relative_offset:relative_offset + entity.length],
-            entities=entities[i + 1:], offset=entity.offset, length=entity.length)
-        entity_type = type(entity)
-
-        if entity_type == MessageEntityBold:
-            html.append(f"<strong>{entity_text}</strong>")
-        elif entity_type == MessageEntityItalic:
-            html.append(f"<em>{entity_text}</em>")
-        elif entity_type == MessageEntityUnderline:
-            html.append(f"<u>{entity_text}</u>")
-        elif entity_type == MessageEntityStrike:
-            html.append(f"<del>{entity_text}</del>")
-        elif entity_type == MessageEntityBlockquote:
-            html.append(f"<blockquote>{entity_text}</blockquote>")
-        elif entity_type == MessageEntityCode:
-            html.append(f"<pre><code>{entity_text}</code></pre>"
-                        if "\n" in entity_text
-                        else f"<code>{entity_text}</code>")
-        elif entity_type == MessageEntityPre:
-            skip_entity = _parse_pre(html, entity_text, entity.language)
-        elif entity_type == MessageEntityMention:
-            skip_entity = _parse_mention(html, entity_text)
-        elif entity_type == MessageEntityMentionName:
-            skip_entity = _parse_name_mention(html, entity_text, TelegramID(entity.user_id))
-        elif entity_type == MessageEntityEmail:
-            html.append(f"<a href='mailto:{entity_text}'>{entity_text}</a>")
-        elif entity_type in (MessageEntityTextUrl, MessageEntityUrl):
-            skip_entity = _parse_url(html, entity_text,
-                                     entity.url if entity_type == MessageEntityTextUrl else None)
-        elif entity_type == MessageEntityBotCommand:
-            html.append(f"<font color='blue'>!{entity_text[1:]}</font>")
-        elif entity_type in (MessageEntityHashtag, MessageEntityCashtag, MessageEntityPhone):
-            html.append(f"<font color='blue'>{entity_text}</font>")
-        else:
-            skip_entity = True
-        last_offset = relative_offset + (0 if skip_entity else entity.length)
-    html.append(escape(text[last_offset:]))
-
-    return "".join(html)
+        text_start = start + last_offset
+        html.append(escape(text[text_start if text_start < end else end:end]))
+        if not stack:
+            return "".join(html)
+        entity_html, child, child_relative_offset = "".join(html), entity, relative_offset
+        (entity, start, end, offset, limit, index, relative_offset,
+         last_offset, html) = stack.pop()
+        skip_entity = await _entity_to_html(html, child, entity_html)
+        last_offset = child_relative_offset + (0 if skip_entity else child.length)
+
+
+async def _entity_to_html(html: List[str], entity: TypeMessageEntity, entity_text: str) -> bool:
+    skip_entity = False
+    entity_type = type(entity)
+
+    if entity_type == MessageEntityBold:
+        html.append(f"<strong>{entity_text}</strong>")
+    elif entity_type == MessageEntityItalic:
+        html.append(f"<em>{entity_text}</em>")
+    elif entity_type == MessageEntityUnderline:
+        html.append(f"<u>{entity_text}</u>")
+    elif entity_type == MessageEntityStrike:
+        html.append(f"<del>{entity_text}</del>")
+    elif entity_type == MessageEntityBlockquote:
+        html.append(f"<blockquote>{entity_text}</blockquote>")
+    elif entity_type == MessageEntityCode:
+        html.append(f"<pre><code>{entity_text}</code></pre>"
+                    if "\n" in entity_text
+                    else f"<code>{entity_text}</code>")
+    elif entity_type == MessageEntityPre:
+        skip_entity = _parse_pre(html, entity_text, entity.language)
+    elif entity_type == MessageEntityMention:
+        skip_entity = _parse_mention(html, entity_text)
+    elif entity_type == MessageEntityMentionName:
+        skip_entity = _parse_name_mention(html, entity_text, TelegramID(entity.user_id))
+    elif entity_type == MessageEntityEmail:
+        html.append(f"<a href='mailto:{entity_text}'>{entity_text}</a>")
+    elif entity_type in (MessageEntityTextUrl, MessageEntityUrl):
+        skip_entity = await _parse_url(html, entity_text,
+                                       entity.url if entity_type == MessageEntityTextUrl
+                                       else None)
+    elif entity_type == MessageEntityBotCommand:
+        html.append(f"<font color='blue'>!{entity_text[1:]}</font>")
+    elif entity_type in (MessageEntityHashtag, MessageEntityCashtag, MessageEntityPhone):
+        html.append(f"<font color='blue'>{entity_text}</font>")
+    else:
+        skip_entity = True
+    return skip_entity
 
 
 def _parse_pre(html: List[str], entity_text: str, language: str) -> bool:
@@ -299,7 +336,7 @@ message_link_regex = re.compile(r"https?://t(?:elegram)?\.(?:me|dog)/"
                                 r"([A-Za-z][A-Za-z0-9_]{3,}[A-Za-z0-9])/([0-9]{1,50})")
 
 
-def _parse_url(html: List[str], entity_text: str, url: str) -> bool:
+async def _parse_url(html: List[str], entity_text: str, url: str) -> bool:
     url = escape(url) if url else entity_text
     if not url.startswith(("https://", "http://", "ftp://", "magnet://")):
         url = "http://" + url
@@ -311,7 +348,7 @@ def _parse_url(html: List[str], entity_text: str, url: str) -> bool:
 
         portal = po.Portal.find_by_username(group)
         if portal:
-            message = DBMessage.get_one_by_tgid(TelegramID(msgid), portal.tgid)
+            message = await DBMessage.get_one_by_tgid(TelegramID(msgid), portal.tgid)
             if message:
                 url = f"https://matrix.to/#/{portal.mxid}/{message.mxid}"
 
@@ -40,10 +40,11 @@ from mautrix.bridge import BasePortal as MautrixBasePortal
 
 from ..types import TelegramID
 from ..context import Context
-from ..db import Portal as DBPortal, Message as DBMessage
+from ..db import Portal as DBPortal, Message as DBMessage, DedupState
 from .. import puppet as p, user as u, util
 from .deduplication import PortalDedup
 from .send_lock import PortalSendLock
+from .work_queue import PortalWorkQueue
 
 if TYPE_CHECKING:
     from ..bot import Bot
@@ -105,6 +106,7 @@ class BasePortal(MautrixBasePortal, ABC):
 
     dedup: PortalDedup
     send_lock: PortalSendLock
+    work_queue: PortalWorkQueue
     _pin_lock: asyncio.Lock
 
     _db_instance: DBPortal
@@ -140,6 +142,7 @@ class BasePortal(MautrixBasePortal, ABC):
 
         self.dedup = PortalDedup(self)
         self.send_lock = PortalSendLock()
+        self.work_queue = PortalWorkQueue(self)
         self._pin_lock = asyncio.Lock()
 
         if tgid:
@@ -343,9 +346,6 @@ class BasePortal(MautrixBasePortal, ABC):
                               encrypted=self.encrypted)
 
     async def delete(self) -> None:
-        self.delete_sync()
-
-    def delete_sync(self) -> None:
         try:
             del self.by_tgid[self.tgid_full]
         except KeyError:
@@ -356,7 +356,9 @@ class BasePortal(MautrixBasePortal, ABC):
             pass
         if self._db_instance:
             self._db_instance.delete()
-        DBMessage.delete_all(self.mxid)
+        await DBMessage.delete_all(self.mxid)
+        if self.dedup.persist:
+            await DedupState.delete_by_tgid(self.tgid, self.tg_receiver)
         self.deleted = True
 
     @classmethod
@@ -517,7 +519,7 @@ class BasePortal(MautrixBasePortal, ABC):
         pass
 
     @abstractmethod
-    def _migrate_and_save_telegram(self, new_id: TelegramID) -> None:
+    async def _migrate_and_save_telegram(self, new_id: TelegramID) -> None:
         pass
 
     @abstractmethod
@@ -549,6 +551,7 @@ def init(context: Context) -> None:
     BasePortal.matrix = context.mx
     MautrixBasePortal.bridge = context.bridge
     BasePortal.max_initial_member_sync = config["bridge.max_initial_member_sync"]
+    PortalWorkQueue.max_size = config["bridge.portal_queue_size"]
     BasePortal.sync_channel_members = config["bridge.sync_channel_members"]
     BasePortal.sync_matrix_state = config["bridge.sync_matrix_state"]
     BasePortal.public_portals = config["bridge.public_portals"]
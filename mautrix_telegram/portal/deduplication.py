@@ -13,111 +13,275 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Deque, Dict, Tuple, TYPE_CHECKING
-from collections import deque
-import hashlib
+from typing import (Any, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, Union,
+                    TYPE_CHECKING)
+from collections import OrderedDict
+import asyncio
+import logging
+import json
+import time
+import zlib
 
 from telethon.tl.patched import Message, MessageService
 from telethon.tl.types import (MessageMediaContact, MessageMediaDocument, MessageMediaGeo,
-                               MessageMediaPhoto, TypeMessage, TypeUpdates, UpdateNewMessage,
-                               UpdateNewChannelMessage)
+                               MessageMediaPhoto, TypeMessage, TypeUpdates, TypeUpdate,
+                               UpdateNewMessage, UpdateNewChannelMessage, UpdateEditChannelMessage,
+                               UpdateDeleteChannelMessages, PeerChannel)
 
 from mautrix.types import EventID
+from mautrix.util.opt_prometheus import Counter
 
 from ..context import Context
+from ..db import DedupState
 from ..types import TelegramID
 
 if TYPE_CHECKING:
     from .base import BasePortal
 
 DedupMXID = Tuple[EventID, TelegramID]
+# Either a message ID or a (timestamp, content checksum) fingerprint
+DedupKey = Union[int, Tuple[int, int]]
+
+TEMPORARY_SUFFIXES = ("TGBRIDGETEMP", "TGBRIDGEDITEMP")
+
+# Marks missing keys in DedupWindow.get, as None is a valid value
+_MISSING = object()
+
+SHARED_DEDUP_CHECKED = Counter("bridge_telegram_shared_dedup_checked",
+                               "Number of Telegram updates checked by the shared dedup cache",
+                               ("portal",))
+SHARED_DEDUP_DUPLICATES = Counter("bridge_telegram_shared_dedup_duplicates",
+                                  "Number of duplicate Telegram updates dropped by the shared "
+                                  "dedup cache", ("portal",))
+
+
+def fingerprint(event: TypeMessage) -> Tuple[int, int]:
+    """Get a fingerprint of the content of a message.
+
+    Non-channel messages are unique per-user (wtf telegram), so we have no other choice than to
+    deduplicate based on the message content. The timestamp is only accurate to the second, so we
+    can't rely solely on that either.
+
+    The fingerprint is cached in the event object, as the same event is usually checked several
+    times.
+    """
+    cached = getattr(event, "_mxtg_fingerprint", None)
+    if cached:
+        return cached
+    if isinstance(event, MessageService):
+        content, extra = str(event.action), [event.from_id]
+    else:
+        content, extra = event.message.strip(), []
+        if event.fwd_from:
+            extra.append(event.fwd_from.from_id)
+        elif event.media and isinstance(event, Message):
+            try:
+                extra += {
+                    MessageMediaContact: lambda media: [media.user_id],
+                    MessageMediaDocument: lambda media: [media.document.id],
+                    MessageMediaPhoto: lambda media: [media.photo.id if media.photo else 0],
+                    MessageMediaGeo: lambda media: [media.geo.long, media.geo.lat],
+                }[type(event.media)](event.media)
+            except KeyError:
+                pass
+    checksum = zlib.crc32(content.encode("utf-8"))
+    for value in extra:
+        checksum = zlib.crc32(str(value).encode("utf-8"), checksum)
+    event._mxtg_fingerprint = result = (int(event.date.timestamp()), checksum)
+    return result
+
+
+class DedupWindow:
+    """An insertion-ordered set of dedup keys that forgets keys by count and by age.
+
+    Membership checks and insertions are O(1). Each key can have a value attached to it.
+    """
+    max_size: int
+    max_age: float
+
+    _items: 'OrderedDict[Hashable, Tuple[float, Any]]'
+
+    def __init__(self, max_size: int, max_age: float = 0) -> None:
+        self.max_size = max_size
+        self.max_age = max_age
+        self._items = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        self._expire()
+        return key in self._items
+
+    def get(self, key: Hashable, default: Any = _MISSING) -> Any:
+        self._expire()
+        item = self._items.get(key)
+        return item[1] if item is not None else default
+
+    def add(self, key: Hashable, value: Any = None) -> None:
+        """Add a key, or move an existing key to the end of the window as if it was new."""
+        self._items[key] = (time.time(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def replace(self, key: Hashable, value: Any) -> None:
+        """Change the value of a key without moving it in the window."""
+        added_at, _ = self._items[key]
+        self._items[key] = (added_at, value)
+
+    def items(self) -> Iterator[Tuple[Hashable, float, Any]]:
+        self._expire()
+        return ((key, added_at, value) for key, (added_at, value) in self._items.items())
+
+    def restore(self, items: List[Tuple[Hashable, float, Any]]) -> None:
+        """Add old items (oldest first) behind the items that are already in the window."""
+        cutoff = time.time() - self.max_age if self.max_age > 0 else 0
+        for key, added_at, value in reversed(items):
+            if key in self._items or added_at < cutoff:
+                continue
+            self._items[key] = (added_at, value)
+            self._items.move_to_end(key, last=False)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def _expire(self) -> None:
+        if self.max_age <= 0:
+            return
+        cutoff = time.time() - self.max_age
+        items = self._items
+        while items:
+            # The first item is always the oldest one
+            key = next(iter(items))
+            if items[key][0] >= cutoff:
+                break
+            del items[key]
+
+
+def _load_key(key: Union[int, List[int]]) -> DedupKey:
+    return tuple(key) if isinstance(key, list) else key
 
 
 class PortalDedup:
+    log: logging.Logger = logging.getLogger("mau.portal.dedup")
+
     pre_db_check: bool = False
     cache_queue_length: int = 20
+    cache_max_age: float = 0
+    persist: bool = False
 
-    _dedup: Deque[str]
-    _dedup_mxid: Dict[str, DedupMXID]
-    _dedup_action: Deque[str]
+    _dedup: DedupWindow
+    _dedup_action: DedupWindow
+    _saved_temporary: Set[EventID]
     _portal: 'BasePortal'
+    _loaded: bool
+    _load_lock: Optional[asyncio.Lock]
+    _changes: int
+    _saved_changes: int
 
     def __init__(self, portal: 'BasePortal') -> None:
-        self._dedup = deque()
-        self._dedup_mxid = {}
-        self._dedup_action = deque()
+        self._dedup = DedupWindow(self.cache_queue_length, self.cache_max_age)
+        self._dedup_action = DedupWindow(self.cache_queue_length, self.cache_max_age)
+        self._saved_temporary = set()
         self._portal = portal
+        self._loaded = not self.persist
+        self._load_lock = None
+        self._changes = 0
+        self._saved_changes = 0
+
+    @property
+    def dirty(self) -> bool:
+        return self._changes != self._saved_changes
+
+    async def load(self) -> None:
+        """Load the dedup state saved before the last restart, if it hasn't been loaded yet.
+
+        Entries that were added before loading are kept in front of the loaded ones.
+        """
+        if self._loaded:
+            return
+        if not self._load_lock:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._loaded:
+                return
+            portal = self._portal
+            try:
+                saved = await DedupState.get(portal.tgid, portal.tg_receiver)
+                if saved:
+                    data = json.loads(saved.state)
+                    self._dedup.restore([(_load_key(key), added_at,
+                                          tuple(mxid) if mxid else None)
+                                         for key, added_at, mxid in data["messages"]])
+                    self._dedup_action.restore([(_load_key(key), added_at, None)
+                                                for key, added_at in data["actions"]])
+            except Exception:
+                self.log.exception(f"Failed to load dedup state of {portal.tgid_log}")
+            self._loaded = True
+
+    def serialize(self) -> DedupState:
+        # Temporary identifiers belong to messages that were still being sent, so they wouldn't
+        # get replaced with the real event ID after a restart.
+        messages = [[key, added_at, mxid] for key, added_at, mxid in self._dedup.items()
+                    if not mxid or not mxid[0].endswith(TEMPORARY_SUFFIXES)]
+        actions = [[key, added_at] for key, added_at, _ in self._dedup_action.items()]
+        return DedupState(tgid=self._portal.tgid, tg_receiver=self._portal.tg_receiver,
+                          state=json.dumps({"messages": messages, "actions": actions}))
 
     @property
     def _always_force_hash(self) -> bool:
         return self._portal.peer_type == 'chat'
 
-    @staticmethod
-    def _hash_event(event: TypeMessage) -> str:
-        # Non-channel messages are unique per-user (wtf telegram), so we have no other choice than
-        # to deduplicate based on a hash of the message content.
-
-        # The timestamp is only accurate to the second, so we can't rely solely on that either.
-        if isinstance(event, MessageService):
-            hash_content = [event.date.timestamp(), event.from_id, event.action]
-        else:
-            hash_content = [event.date.timestamp(), event.message.strip()]
-            if event.fwd_from:
-                hash_content += [event.fwd_from.from_id]
-            elif isinstance(event, Message) and event.media:
-                try:
-                    hash_content += {
-                        MessageMediaContact: lambda media: [media.user_id],
-                        MessageMediaDocument: lambda media: [media.document.id],
-                        MessageMediaPhoto: lambda media: [media.photo.id if media.photo else 0],
-                        MessageMediaGeo: lambda media: [media.geo.long, media.geo.lat],
-                    }[type(event.media)](event.media)
-                except KeyError:
-                    pass
-        return hashlib.md5("-"
-                           .join(str(a) for a in hash_content)
-                           .encode("utf-8")
-                           ).hexdigest()
+    def _key(self, event: TypeMessage, force_hash: bool = False) -> DedupKey:
+        return fingerprint(event) if self._always_force_hash or force_hash else event.id
 
     def check_action(self, event: TypeMessage) -> bool:
-        evt_hash = self._hash_event(event) if self._always_force_hash else event.id
-        if evt_hash in self._dedup_action:
+        evt_key = self._key(event)
+        if evt_key in self._dedup_action:
             return True
-
-        self._dedup_action.append(evt_hash)
-
-        if len(self._dedup_action) > self.cache_queue_length:
-            self._dedup_action.popleft()
+        self._dedup_action.add(evt_key)
+        self._changes += 1
         return False
 
     def update(self, event: TypeMessage, mxid: DedupMXID = None,
                expected_mxid: Optional[DedupMXID] = None, force_hash: bool = False
                ) -> Optional[DedupMXID]:
-        evt_hash = self._hash_event(event) if self._always_force_hash or force_hash else event.id
-        try:
-            found_mxid = self._dedup_mxid[evt_hash]
-        except KeyError:
+        evt_key = self._key(event, force_hash)
+        found_mxid = self._dedup.get(evt_key)
+        if found_mxid is _MISSING:
             return EventID("None"), TelegramID(0)
 
         if found_mxid != expected_mxid:
             return found_mxid
-        self._dedup_mxid[evt_hash] = mxid
+        self._dedup.replace(evt_key, mxid)
+        self._changes += 1
         return None
 
     def check(self, event: TypeMessage, mxid: DedupMXID = None, force_hash: bool = False
               ) -> Optional[DedupMXID]:
-        evt_hash = (self._hash_event(event)
-                    if self._always_force_hash or force_hash
-                    else event.id)
-        if evt_hash in self._dedup:
-            return self._dedup_mxid[evt_hash]
+        evt_key = self._key(event, force_hash)
+        found_mxid = self._dedup.get(evt_key)
+        if found_mxid is not _MISSING:
+            return found_mxid
+        self._dedup.add(evt_key, mxid)
+        self._changes += 1
+        return None
 
-        self._dedup_mxid[evt_hash] = mxid
-        self._dedup.append(evt_hash)
+    def mark_saved(self, mxid: EventID) -> None:
+        """Remember that a duplicate's message mapping was saved with the given event ID.
 
-        if len(self._dedup) > self.cache_queue_length:
-            del self._dedup_mxid[self._dedup.popleft()]
-        return None
+        Only temporary identifiers are remembered: those rows have to be fixed up with the real
+        event ID once the original message has been sent.
+        """
+        if mxid.endswith(TEMPORARY_SUFFIXES):
+            self._saved_temporary.add(mxid)
+
+    def pop_saved_temporary(self, mxid: EventID) -> bool:
+        try:
+            self._saved_temporary.remove(mxid)
+            return True
+        except KeyError:
+            return False
 
     def register_outgoing_actions(self, response: TypeUpdates) -> None:
         for update in response.updates:
@@ -127,7 +291,63 @@ class PortalDedup:
                 self.check(update.message)
 
 
+class SharedDedup:
+    """Drops channel updates that another client of the bridge has already received.
+
+    Every logged-in user gets their own copy of every update in channels and supergroups, and
+    all copies are identical. Messages in normal groups have a different ID for every receiver
+    and each copy needs its own message mapping, so those are left to :class:`PortalDedup`.
+    """
+    _seen: DedupWindow
+
+    def __init__(self, max_size: int = 10000, max_age: float = 0) -> None:
+        self._seen = DedupWindow(max_size, max_age)
+
+    @staticmethod
+    def _key(update: TypeUpdate) -> Optional[Tuple[int, Hashable]]:
+        if isinstance(update, UpdateDeleteChannelMessages):
+            return update.channel_id, ("delete", tuple(update.messages))
+        elif not isinstance(update, (UpdateNewChannelMessage, UpdateEditChannelMessage)):
+            return None
+        msg = update.message
+        if not isinstance(msg, (Message, MessageService)) or not isinstance(msg.peer_id,
+                                                                             PeerChannel):
+            return None
+        elif isinstance(update, UpdateEditChannelMessage):
+            edit_ts = int(msg.edit_date.timestamp()) if msg.edit_date else 0
+            return msg.peer_id.channel_id, ("edit", msg.id, edit_ts, fingerprint(msg))
+        return msg.peer_id.channel_id, ("new", msg.id)
+
+    def is_duplicate(self, update: TypeUpdate) -> bool:
+        key = self._key(update)
+        if not key:
+            return False
+        portal = str(key[0])
+        SHARED_DEDUP_CHECKED.labels(portal=portal).inc()
+        if key in self._seen:
+            SHARED_DEDUP_DUPLICATES.labels(portal=portal).inc()
+            return True
+        self._seen.add(key)
+        return False
+
+
+async def save_all(portals: Iterable['BasePortal']) -> None:
+    """Save the dedup state of all portals that have changed since they were last saved."""
+    changed = [portal.dedup for portal in portals if portal.dedup.dirty]
+    for dedup in changed:
+        # Make sure saving doesn't overwrite the state from before the restart
+        await dedup.load()
+    # Serialize here rather than in the database thread, the windows keep changing meanwhile
+    saved = [(dedup, dedup._changes, dedup.serialize()) for dedup in changed]
+    await DedupState.save_all(state for _, _, state in saved)
+    # Only forget the changes after they've been saved, so a failed save is retried later
+    for dedup, changes, _ in saved:
+        dedup._saved_changes = changes
+
+
 def init(context: Context) -> None:
     cfg = context.config
-    PortalDedup.dedup_pre_db_check = cfg["bridge.deduplication.pre_db_check"]
-    PortalDedup.dedup_cache_queue_length = cfg["bridge.deduplication.cache_queue_length"]
+    PortalDedup.pre_db_check = cfg["bridge.deduplication.pre_db_check"]
+    PortalDedup.cache_queue_length = cfg["bridge.deduplication.cache_queue_length"]
+    PortalDedup.cache_max_age = cfg["bridge.deduplication.cache_max_age"]
+    PortalDedup.persist = cfg["bridge.deduplication.persist_interval"] > 0
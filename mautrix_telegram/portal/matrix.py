@@ -15,6 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Awaitable, Dict, Optional, Union, Any, TYPE_CHECKING
 from html import escape as escape_html
+import hashlib
 from string import Template
 from abc import ABC
 
@@ -25,13 +26,14 @@ from telethon.tl.functions.messages import (EditChatPhotoRequest, EditChatTitleR
                                             EditChatAboutRequest, UnpinAllMessagesRequest)
 from telethon.tl.functions.channels import EditPhotoRequest, EditTitleRequest, JoinChannelRequest
 from telethon.errors import (ChatNotModifiedError, PhotoExtInvalidError, MessageIdInvalidError,
-                             PhotoInvalidDimensionsError, PhotoSaveFileInvalidError, RPCError)
+                             PhotoInvalidDimensionsError, PhotoSaveFileInvalidError, RPCError,
+                             FileReferenceExpiredError, MediaEmptyError)
 from telethon.tl.patched import Message, MessageService
 from telethon.tl.types import (DocumentAttributeFilename, DocumentAttributeImageSize, GeoPoint,
                                InputChatUploadedPhoto, MessageActionChatEditPhoto, MessageMediaGeo,
                                SendMessageCancelAction, SendMessageTypingAction, TypeInputPeer,
                                UpdateNewMessage, InputMediaUploadedDocument,
-                               InputMediaUploadedPhoto)
+                               InputMediaUploadedPhoto, TypeInputMedia)
 
 from mautrix.types import (EventID, EventType, RoomID, UserID, ContentURI, MessageType,
                            MessageEventContent, TextMessageEventContent, MediaMessageEventContent,
@@ -39,7 +41,7 @@ from mautrix.types import (EventID, EventType, RoomID, UserID, ContentURI, Messa
 from mautrix.util.message_send_checkpoint import MessageSendCheckpointStatus
 
 from ..types import TelegramID
-from ..db import Message as DBMessage
+from ..db import Message as DBMessage, TelegramMediaRef
 from ..util import sane_mimetypes, parallel_transfer_to_telegram
 from ..context import Context
 from .. import puppet as p, user as u, formatter, util
@@ -111,9 +113,9 @@ class PortalMatrix(BasePortal, ABC):
         if user.is_bot:
             return
         space = self.tgid if self.peer_type == "channel" else user.tgid
-        message = DBMessage.get_by_mxid(event_id, self.mxid, space)
+        message = await DBMessage.get_by_mxid(event_id, self.mxid, space)
         if not message:
-            message = DBMessage.find_last(self.mxid, space)
+            message = await DBMessage.find_last(self.mxid, space)
             if not message:
                 self.log.debug(f"Dropping Matrix read receipt from {user.mxid}: "
                                f"target message {event_id} not known and last message"
@@ -236,12 +238,12 @@ class PortalMatrix(BasePortal, ABC):
         async with self.send_lock(sender_id):
             lp = self.get_config("telegram_link_preview")
             if content.get_edit():
-                orig_msg = DBMessage.get_by_mxid(content.get_edit(), self.mxid, space)
+                orig_msg = await DBMessage.get_by_mxid(content.get_edit(), self.mxid, space)
                 if orig_msg:
                     response = await client.edit_message(self.peer, orig_msg.tgid, message,
                                                          formatting_entities=entities,
                                                          link_preview=lp)
-                    self._add_telegram_message_to_db(event_id, space, -1, response)
+                    await self._add_telegram_message_to_db(event_id, space, -1, response)
                     return
             try:
                 response = await client.send_message(self.peer, message, reply_to=reply_to,
@@ -257,7 +259,7 @@ class PortalMatrix(BasePortal, ABC):
                     EventType.ROOM_MESSAGE,
                     message_type=content.msgtype,
                 )
-                self._add_telegram_message_to_db(event_id, space, 0, response)
+                await self._add_telegram_message_to_db(event_id, space, 0, response)
                 await self._send_delivery_receipt(event_id)
 
     async def _handle_matrix_file(self, sender: 'u.User', logged_in: bool, event_id: EventID,
@@ -272,82 +274,139 @@ class PortalMatrix(BasePortal, ABC):
             w = h = None
         file_name = content["net.maunium.telegram.internal.filename"]
         max_image_size = config["bridge.image_as_file_size"] * 1000 ** 2
-
-        if config["bridge.parallel_file_transfer"] and content.url:
-            file_handle, file_size = await parallel_transfer_to_telegram(client, self.main_intent,
-                                                                         content.url, sender_id)
-        else:
-            if content.file:
-                if not decrypt_attachment:
-                    raise Exception(f"Can't bridge encrypted media event {event_id}: "
-                                    "encryption dependencies not installed")
-                file = await self.main_intent.download_media(content.file.url)
-                file = decrypt_attachment(file, content.file.key.key,
-                                          content.file.hashes.get("sha256"), content.file.iv)
+        attributes = []
+
+        use_media_cache = config["bridge.reverse_media_cache"]
+        is_sticker = content.msgtype == MessageType.STICKER
+        cache_key = content.file.url if content.file else content.url
+        media_ref = cached_by_mxc = sha256 = None
+        if use_media_cache:
+            media_ref = cached_by_mxc = await TelegramMediaRef.get(cache_key, is_sticker,
+                                                                   sender_id)
+
+        async def upload(reuse_by_hash: bool = True) -> TypeInputMedia:
+            nonlocal mime, w, h, file_name, attributes, media_ref, sha256
+            if config["bridge.parallel_file_transfer"] and content.url:
+                file_handle, file_size = await parallel_transfer_to_telegram(
+                    client, self.main_intent, content.url, sender_id)
             else:
-                file = await self.main_intent.download_media(content.url)
-
-            if content.msgtype == MessageType.STICKER:
-                if mime != "image/gif":
-                    mime, file, w, h = util.convert_image(file, source_mime=mime,
-                                                          target_type="webp")
+                if content.file:
+                    if not decrypt_attachment:
+                        raise Exception(f"Can't bridge encrypted media event {event_id}: "
+                                        "encryption dependencies not installed")
+                    file = await self.main_intent.download_media(content.file.url)
+                    file = decrypt_attachment(file, content.file.key.key,
+                                              content.file.hashes.get("sha256"), content.file.iv)
                 else:
-                    # Remove sticker description
-                    file_name = "sticker.gif"
-
-            file_handle = await client.upload_file(file)
-            file_size = len(file)
-
-        file_handle.name = file_name
-
-        attributes = [DocumentAttributeFilename(file_name=file_name)]
-        if w and h:
-            attributes.append(DocumentAttributeImageSize(w, h))
+                    file = await self.main_intent.download_media(content.url)
+
+                if use_media_cache:
+                    sha256 = hashlib.sha256(file).hexdigest()
+                if use_media_cache and reuse_by_hash:
+                    # The same file may have been sent before with a different MXC URI, e.g.
+                    # when it was re-encrypted or uploaded again by another client.
+                    media_ref = await TelegramMediaRef.get_by_sha256(sha256, is_sticker,
+                                                                     sender_id)
+                    if media_ref:
+                        return media_ref.input_media
+
+                if is_sticker:
+                    if mime != "image/gif":
+                        mime, file, w, h = await util.convert_image(file, source_mime=mime,
+                                                                    target_type="webp")
+                    else:
+                        # Remove sticker description
+                        file_name = "sticker.gif"
+
+                file_handle = await client.upload_file(file)
+                file_size = len(file)
+
+            file_handle.name = file_name
+
+            attributes = [DocumentAttributeFilename(file_name=file_name)]
+            if w and h:
+                attributes.append(DocumentAttributeImageSize(w, h))
+
+            if (mime == "image/png" or mime == "image/jpeg") and file_size < max_image_size:
+                return InputMediaUploadedPhoto(file_handle)
+            else:
+                return InputMediaUploadedDocument(file=file_handle, attributes=attributes,
+                                                  mime_type=mime or "application/octet-stream")
 
-        if (mime == "image/png" or mime == "image/jpeg") and file_size < max_image_size:
-            media = InputMediaUploadedPhoto(file_handle)
-        else:
-            media = InputMediaUploadedDocument(file=file_handle, attributes=attributes,
-                                               mime_type=mime or "application/octet-stream")
+        media = media_ref.input_media if media_ref else await upload()
 
         capt, entities = (await formatter.matrix_to_telegram(client, text=caption.body,
                                                              html=caption.formatted(Format.HTML))
                           if caption else (None, None))
 
+        async def send(media: TypeInputMedia) -> Message:
+            try:
+                return await client.send_media(self.peer, media, reply_to=reply_to,
+                                               caption=capt, entities=entities)
+            except (PhotoInvalidDimensionsError, PhotoSaveFileInvalidError, PhotoExtInvalidError):
+                if not isinstance(media, InputMediaUploadedPhoto):
+                    raise
+                media = InputMediaUploadedDocument(file=media.file, mime_type=mime,
+                                                   attributes=attributes)
+                return await client.send_media(self.peer, media, reply_to=reply_to,
+                                               caption=capt, entities=entities)
+
         async with self.send_lock(sender_id):
             if await self._matrix_document_edit(client, content, space, capt, media, event_id):
                 return
             try:
-                try:
-                    response = await client.send_media(self.peer, media, reply_to=reply_to,
-                                                       caption=capt, entities=entities)
-                except (PhotoInvalidDimensionsError, PhotoSaveFileInvalidError, PhotoExtInvalidError):
-                    media = InputMediaUploadedDocument(file=media.file, mime_type=mime,
-                                                       attributes=attributes)
-                    response = await client.send_media(self.peer, media, reply_to=reply_to,
-                                                       caption=capt, entities=entities)
-            except Exception:
-                raise
-            else:
-                sender.send_remote_checkpoint(
-                    MessageSendCheckpointStatus.SUCCESS,
-                    event_id,
-                    self.mxid,
-                    EventType.ROOM_MESSAGE,
-                    message_type=content.msgtype,
-                )
-                self._add_telegram_message_to_db(event_id, space, 0, response)
-                await self._send_delivery_receipt(event_id)
+                response = await send(media)
+            except (FileReferenceExpiredError, MediaEmptyError):
+                if not media_ref:
+                    raise
+                elif await self._refresh_media_ref(client, media_ref):
+                    response = await send(media_ref.input_media)
+                else:
+                    self.log.debug(f"Cached Telegram media for {cache_key} is no longer usable, "
+                                   "uploading it again")
+                    await media_ref.delete()
+                    media_ref = cached_by_mxc = None
+                    # Other refs with the same contents likely have the same expired reference
+                    response = await send(await upload(reuse_by_hash=False))
+            sender.send_remote_checkpoint(
+                MessageSendCheckpointStatus.SUCCESS,
+                event_id,
+                self.mxid,
+                EventType.ROOM_MESSAGE,
+                message_type=content.msgtype,
+            )
+            await self._add_telegram_message_to_db(event_id, space, 0, response)
+            await self._send_delivery_receipt(event_id)
+
+        if use_media_cache and not cached_by_mxc:
+            new_ref = TelegramMediaRef.from_message(cache_key, is_sticker, sender_id, sha256,
+                                                    response)
+            if new_ref:
+                await new_ref.upsert()
+
+    async def _refresh_media_ref(self, client: 'MautrixTelegramClient',
+                                 media_ref: TelegramMediaRef) -> bool:
+        try:
+            message = await client.get_messages(media_ref.origin_chat,
+                                                ids=media_ref.origin_msg_id)
+        except (RPCError, ValueError) as e:
+            self.log.debug(f"Failed to get {media_ref.origin_msg_id}@{media_ref.origin_chat} "
+                           f"to refresh file reference: {e}")
+            return False
+        if not message or not media_ref.update_file_reference(message):
+            return False
+        await media_ref.save_file_reference()
+        return True
 
     async def _matrix_document_edit(self, client: 'MautrixTelegramClient',
                                     content: MessageEventContent, space: TelegramID,
                                     caption: str, media: Any, event_id: EventID) -> bool:
         if content.get_edit():
-            orig_msg = DBMessage.get_by_mxid(content.get_edit(), self.mxid, space)
+            orig_msg = await DBMessage.get_by_mxid(content.get_edit(), self.mxid, space)
             if orig_msg:
                 response = await client.edit_message(self.peer, orig_msg.tgid,
                                                      caption, file=media)
-                self._add_telegram_message_to_db(event_id, space, -1, response)
+                await self._add_telegram_message_to_db(event_id, space, -1, response)
                 await self._send_delivery_receipt(event_id)
                 return True
         return False
@@ -375,7 +434,7 @@ class PortalMatrix(BasePortal, ABC):
             except Exception:
                 raise
             else:
-                self._add_telegram_message_to_db(event_id, space, 0, response)
+                await self._add_telegram_message_to_db(event_id, space, 0, response)
                 sender.send_remote_checkpoint(
                     MessageSendCheckpointStatus.SUCCESS,
                     event_id,
@@ -385,14 +444,14 @@ class PortalMatrix(BasePortal, ABC):
                 )
                 await self._send_delivery_receipt(event_id)
 
-    def _add_telegram_message_to_db(self, event_id: EventID, space: TelegramID,
-                                    edit_index: int, response: TypeMessage) -> None:
+    async def _add_telegram_message_to_db(self, event_id: EventID, space: TelegramID,
+                                          edit_index: int, response: TypeMessage) -> None:
         self.log.trace("Handled Matrix message: %s", response)
         self.dedup.check(response, (event_id, space), force_hash=edit_index != 0)
         if edit_index < 0:
-            prev_edit = DBMessage.get_one_by_tgid(TelegramID(response.id), space, -1)
+            prev_edit = await DBMessage.get_one_by_tgid(TelegramID(response.id), space, -1)
             edit_index = prev_edit.edit_index + 1
-        DBMessage(
+        await DBMessage(
             tgid=TelegramID(response.id),
             tg_space=space,
             mx_room=self.mxid,
@@ -456,7 +515,7 @@ class PortalMatrix(BasePortal, ABC):
         client = sender.client if logged_in else self.bot.client
         space = (self.tgid if self.peer_type == "channel"  # Channels have their own ID space
                  else (sender.tgid if logged_in else self.bot.tgid))
-        reply_to = formatter.matrix_reply_to_telegram(content, space, room_id=self.mxid)
+        reply_to = await formatter.matrix_reply_to_telegram(content, space, room_id=self.mxid)
 
         media = (MessageType.STICKER, MessageType.IMAGE, MessageType.FILE, MessageType.AUDIO,
                  MessageType.VIDEO)
@@ -479,8 +538,8 @@ class PortalMatrix(BasePortal, ABC):
             content["net.maunium.telegram.internal.filename"] = content.body
             try:
                 caption_content: MessageEventContent = sender.command_status["caption"]
-                reply_to = reply_to or formatter.matrix_reply_to_telegram(caption_content, space,
-                                                                          room_id=self.mxid)
+                reply_to = reply_to or await formatter.matrix_reply_to_telegram(
+                    caption_content, space, room_id=self.mxid)
                 sender.command_status = None
             except (KeyError, TypeError):
                 caption_content = None if logged_in else TextMessageEventContent(body=content.body)
@@ -502,8 +561,8 @@ class PortalMatrix(BasePortal, ABC):
                                 pin_event_id: EventID) -> None:
         tg_space = self.tgid if self.peer_type == "channel" else sender.tgid
         ids = {msg.mxid: msg.tgid
-               for msg in DBMessage.get_by_mxids(list(changes.keys()),
-                                                 mx_room=self.mxid, tg_space=tg_space)}
+               for msg in await DBMessage.get_by_mxids(list(changes.keys()),
+                                                       mx_room=self.mxid, tg_space=tg_space)}
         for event_id, pinned in changes.items():
             try:
                 await sender.client(UpdatePinnedMessageRequest(peer=self.peer, id=ids[event_id],
@@ -531,18 +590,18 @@ class PortalMatrix(BasePortal, ABC):
     async def _handle_matrix_deletion(self, deleter: 'u.User', event_id: EventID) -> None:
         real_deleter = deleter if not await deleter.needs_relaybot(self) else self.bot
         space = self.tgid if self.peer_type == "channel" else real_deleter.tgid
-        message = DBMessage.get_by_mxid(event_id, self.mxid, space)
+        message = await DBMessage.get_by_mxid(event_id, self.mxid, space)
         if not message:
             raise Exception(f"Ignoring Matrix redaction of unknown event {event_id}")
         elif message.redacted:
             raise Exception("Ignoring Matrix redaction of already redacted event "
                             f"{message.mxid} in {message.mx_room}")
         elif message.edit_index != 0:
-            message.edit(redacted=True)
+            await message.edit(redacted=True)
             raise Exception("Ignoring Matrix redaction of edit event "
                             f"{message.mxid} in {message.mx_room}")
         else:
-            message.edit(redacted=True)
+            await message.edit(redacted=True)
             await real_deleter.client.delete_messages(self.peer, [message.tgid])
 
     async def _update_telegram_power_level(self, sender: 'u.User', user_id: TelegramID,
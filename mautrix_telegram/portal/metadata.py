@@ -37,6 +37,7 @@ from mautrix.types import (RoomID, UserID, RoomCreatePreset, EventType, Membersh
 
 from ..types import TelegramID
 from ..context import Context
+from ..db import DedupState
 from .. import puppet as p, user as u, util
 from .base import BasePortal, InviteList, TypeParticipant, TypeChatPhoto
 
@@ -97,21 +98,25 @@ class PortalMetadata(BasePortal, ABC):
         if not entity:
             raise ValueError("Upgrade may have failed: output channel not found.")
         self.peer_type = "channel"
-        self._migrate_and_save_telegram(TelegramID(entity.id))
+        await self._migrate_and_save_telegram(TelegramID(entity.id))
         await self.update_info(source, entity)
 
-    def _migrate_and_save_telegram(self, new_id: TelegramID) -> None:
+    async def _migrate_and_save_telegram(self, new_id: TelegramID) -> None:
         try:
             del self.by_tgid[self.tgid_full]
         except KeyError:
             pass
         try:
             existing = self.by_tgid[(new_id, new_id)]
-            existing.delete_sync()
+            await existing.delete()
         except KeyError:
             pass
         self.db_instance.edit(tgid=new_id, tg_receiver=new_id, peer_type=self.peer_type)
-        old_id = self.tgid
+        old_id, old_receiver = self.tgid, self.tg_receiver
+        if self.dedup.persist:
+            # The saved state is keyed by the old chat ID, and the old chat doesn't get any more
+            # messages after the upgrade
+            await DedupState.delete_by_tgid(old_id, old_receiver)
         self.tgid = new_id
         self.tg_receiver = new_id
         self.by_tgid[self.tgid_full] = self
@@ -38,14 +38,16 @@ from telethon.tl.types import (
     UpdateChannelUserTyping, SendMessageTypingAction)
 
 from mautrix.appservice import IntentAPI
+from mautrix.errors import MatrixError
 from mautrix.types import (EventID, UserID, ImageInfo, ThumbnailInfo, RelatesTo, MessageType,
                            EventType, MediaMessageEventContent, TextMessageEventContent,
                            LocationMessageEventContent, Format)
 from mautrix.bridge import NotificationDisabler
+from mautrix.util.opt_prometheus import Counter
 
 from ..types import TelegramID
 from ..db import Message as DBMessage, TelegramFile as DBTelegramFile, UserActivity
-from ..util import sane_mimetypes
+from ..util import sane_mimetypes, sticker_prewarm
 from ..context import Context
 from ..tgclient import TelegramClient
 from .. import puppet as p, user as u, formatter, util
@@ -63,6 +65,10 @@ DocAttrs = NamedTuple("DocAttrs", name=Optional[str], mime_type=Optional[str], i
 
 config: Optional['Config'] = None
 
+TEMPORARY_ID_FIXUPS = Counter("bridge_telegram_temporary_id_fixups",
+                              "Number of message mappings that were saved with a temporary "
+                              "dedup event ID and had to be updated after sending")
+
 
 class PortalTelegram(BasePortal, ABC):
     async def handle_telegram_typing(self, user: p.Puppet, update: UpdateTyping) -> None:
@@ -229,6 +235,8 @@ class PortalTelegram(BasePortal, ABC):
                                                   encrypt=self.encrypted)
         if not file:
             return None
+        if attrs.is_sticker:
+            sticker_prewarm.schedule(source.client, intent, document, self.encrypted)
 
         info, name = self._parse_telegram_document_meta(evt, file, attrs, thumb_size)
 
@@ -466,6 +474,7 @@ class PortalTelegram(BasePortal, ABC):
             self.log.debug("Ignoring game message edit event")
             return
 
+        await self.dedup.load()
         async with self.send_lock(sender.tgid if sender else None, required=False):
             tg_space = self.tgid if self.peer_type == "channel" else source.tgid
 
@@ -476,36 +485,48 @@ class PortalTelegram(BasePortal, ABC):
             if duplicate_found:
                 mxid, other_tg_space = duplicate_found
                 if tg_space != other_tg_space:
-                    prev_edit_msg = DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space, -1)
+                    prev_edit_msg = await DBMessage.get_one_by_tgid(TelegramID(evt.id),
+                                                                    tg_space, -1)
                     if not prev_edit_msg:
                         return
-                    DBMessage(mxid=mxid, mx_room=self.mxid, tg_space=tg_space,
-                              tgid=TelegramID(evt.id), edit_index=prev_edit_msg.edit_index + 1
-                              ).insert()
+                    self.dedup.mark_saved(mxid)
+                    await DBMessage(mxid=mxid, mx_room=self.mxid, tg_space=tg_space,
+                                    tgid=TelegramID(evt.id),
+                                    edit_index=prev_edit_msg.edit_index + 1).insert()
                 return
 
-        content = await formatter.telegram_to_matrix(evt, source, self.main_intent,
-                                                     no_reply_fallback=True)
-        editing_msg = DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space)
-        if not editing_msg:
-            self.log.info(f"Didn't find edited message {evt.id}@{tg_space} (src {source.tgid}) "
-                          "in database.")
-            return
-
-        content.msgtype = (MessageType.NOTICE if (sender and sender.is_bot
-                                                  and self.get_config("bot_messages_as_notices"))
-                           else MessageType.TEXT)
-        content.external_url = self._get_external_url(evt)
-        content.set_edit(editing_msg.mxid)
+        try:
+            content = await formatter.telegram_to_matrix(evt, source, self.main_intent,
+                                                         no_reply_fallback=True)
+            editing_msg = await DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space)
+            if not editing_msg:
+                self.log.info(f"Didn't find edited message {evt.id}@{tg_space} "
+                              f"(src {source.tgid}) in database.")
+                return
 
-        intent = sender.intent_for(self) if sender else self.main_intent
-        await intent.set_typing(self.mxid, is_typing=False)
-        event_id = await self._send_message(intent, content)
+            content.msgtype = (MessageType.NOTICE
+                               if (sender and sender.is_bot
+                                   and self.get_config("bot_messages_as_notices"))
+                               else MessageType.TEXT)
+            content.external_url = self._get_external_url(evt)
+            content.set_edit(editing_msg.mxid)
 
-        prev_edit_msg = DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space, -1) or editing_msg
-        DBMessage(mxid=event_id, mx_room=self.mxid, tg_space=tg_space, tgid=TelegramID(evt.id),
-                  edit_index=prev_edit_msg.edit_index + 1).insert()
-        DBMessage.update_by_mxid(temporary_identifier, self.mxid, mxid=event_id)
+            intent = sender.intent_for(self) if sender else self.main_intent
+            await intent.set_typing(self.mxid, is_typing=False)
+            event_id = await self._send_message(intent, content)
+            self.dedup.update(evt, (event_id, tg_space), (temporary_identifier, tg_space),
+                              force_hash=True)
+
+            prev_edit_msg = (await DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space, -1)
+                             or editing_msg)
+            await DBMessage(mxid=event_id, mx_room=self.mxid, tg_space=tg_space,
+                            tgid=TelegramID(evt.id),
+                            edit_index=prev_edit_msg.edit_index + 1).insert()
+            await self._fix_temporary_mapping(temporary_identifier, event_id)
+        finally:
+            # Duplicates saved with the temporary identifier have been fixed up by now if the
+            # edit was sent
+            self.dedup.pop_saved_temporary(temporary_identifier)
 
     @property
     def _takeout_options(self) -> Dict[str, Union[bool, int]]:
@@ -531,8 +552,8 @@ class PortalTelegram(BasePortal, ABC):
             return
         if not config["bridge.backfill.normal_groups"] and self.peer_type == "chat":
             return
-        last = DBMessage.find_last(self.mxid, (source.tgid if self.peer_type != "channel"
-                                               else self.tgid))
+        last = await DBMessage.find_last(self.mxid, (source.tgid if self.peer_type != "channel"
+                                                     else self.tgid))
         min_id = last.tgid if last else 0
         if last_id is None:
             messages = await source.client.get_messages(self.peer, limit=1)
@@ -628,6 +649,7 @@ class PortalTelegram(BasePortal, ABC):
                            " not have matrix puppeting and their default puppet isn't in the room")
             return
 
+        await self.dedup.load()
         async with self.send_lock(sender.tgid if sender else None, required=False):
             tg_space = self.tgid if self.peer_type == "channel" else source.tgid
 
@@ -639,88 +661,123 @@ class PortalTelegram(BasePortal, ABC):
                 self.log.debug(f"Ignoring message {evt.id}@{tg_space} (src {source.tgid}) "
                                f"as it was already handled (in space {other_tg_space})")
                 if tg_space != other_tg_space:
-                    DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
-                              tg_space=tg_space, edit_index=0).insert()
+                    self.dedup.mark_saved(mxid)
+                    await DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=mxid,
+                                    tg_space=tg_space, edit_index=0).insert()
                 return
 
-        if self.backfill_lock.locked or (self.dedup.pre_db_check and self.peer_type == "channel"):
-            msg = DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space)
-            if msg:
-                self.log.debug(f"Ignoring message {evt.id} (src {source.tgid}) as it was already "
-                               f"handled into {msg.mxid}. This duplicate was catched in the db "
-                               "check. If you get this message often, consider increasing "
-                               "bridge.deduplication.cache_queue_length in the config.")
+        try:
+            if self.backfill_lock.locked or (self.dedup.pre_db_check
+                                             and self.peer_type == "channel"):
+                msg = await DBMessage.get_one_by_tgid(TelegramID(evt.id), tg_space)
+                if msg:
+                    self.log.debug(f"Ignoring message {evt.id} (src {source.tgid}) as it was "
+                                   f"already handled into {msg.mxid}. This duplicate was catched "
+                                   "in the db check. If you get this message often, consider "
+                                   "increasing bridge.deduplication.cache_queue_length in the "
+                                   "config.")
+                    return
+
+            self.log.trace("Handling Telegram message %s", evt)
+
+            if sender and not sender.displayname:
+                self.log.debug(f"Telegram user {sender.tgid} sent a message, but doesn't have a "
+                               "displayname, updating info...")
+                entity = await source.client.get_entity(PeerUser(sender.tgid))
+                await sender.update_info(source, entity)
+                if not sender.displayname:
+                    self.log.debug(f"Telegram user {sender.tgid} doesn't have a displayname even "
+                                   f"after updating with data {entity!s}")
+
+            allowed_media = (MessageMediaPhoto, MessageMediaDocument, MessageMediaGeo,
+                             MessageMediaGame, MessageMediaDice, MessageMediaPoll,
+                             MessageMediaUnsupported)
+            media = evt.media if hasattr(evt, "media") and isinstance(evt.media,
+                                                                      allowed_media) else None
+            if sender:
+                intent = sender.intent_for(self)
+                if ((self.backfill_lock.locked and intent != sender.default_mxid_intent
+                     and config["bridge.backfill.invite_own_puppet"])):
+                    intent = sender.default_mxid_intent
+                    self.backfill_leave.add(intent)
+            else:
+                intent = self.main_intent
+            if not media and evt.message:
+                is_bot = sender.is_bot if sender else False
+                event_id = await self.handle_telegram_text(source, intent, is_bot, evt)
+            elif media:
+                event_id = await {
+                    MessageMediaPhoto: self.handle_telegram_photo,
+                    MessageMediaDocument: self.handle_telegram_document,
+                    MessageMediaGeo: self.handle_telegram_location,
+                    MessageMediaPoll: self.handle_telegram_poll,
+                    MessageMediaDice: self.handle_telegram_dice,
+                    MessageMediaUnsupported: self.handle_telegram_unsupported,
+                    MessageMediaGame: self.handle_telegram_game,
+                }[type(media)](source, intent, evt,
+                               relates_to=await formatter.telegram_reply_to_matrix(evt, source))
+            else:
+                self.log.debug("Unhandled Telegram message %d", evt.id)
                 return
 
-        self.log.trace("Handling Telegram message %s", evt)
-
-        if sender and not sender.displayname:
-            self.log.debug(f"Telegram user {sender.tgid} sent a message, but doesn't have a "
-                           "displayname, updating info...")
-            entity = await source.client.get_entity(PeerUser(sender.tgid))
-            await sender.update_info(source, entity)
-            if not sender.displayname:
-                self.log.debug(f"Telegram user {sender.tgid} doesn't have a displayname even after"
-                               f" updating with data {entity!s}")
-
-        allowed_media = (MessageMediaPhoto, MessageMediaDocument, MessageMediaGeo,
-                         MessageMediaGame, MessageMediaDice, MessageMediaPoll,
-                         MessageMediaUnsupported)
-        media = evt.media if hasattr(evt, "media") and isinstance(evt.media,
-                                                                  allowed_media) else None
-        if sender:
-            intent = sender.intent_for(self)
-            if ((self.backfill_lock.locked and intent != sender.default_mxid_intent
-                 and config["bridge.backfill.invite_own_puppet"])):
-                intent = sender.default_mxid_intent
-                self.backfill_leave.add(intent)
-        else:
-            intent = self.main_intent
-        if not media and evt.message:
-            is_bot = sender.is_bot if sender else False
-            event_id = await self.handle_telegram_text(source, intent, is_bot, evt)
-        elif media:
-            event_id = await {
-                MessageMediaPhoto: self.handle_telegram_photo,
-                MessageMediaDocument: self.handle_telegram_document,
-                MessageMediaGeo: self.handle_telegram_location,
-                MessageMediaPoll: self.handle_telegram_poll,
-                MessageMediaDice: self.handle_telegram_dice,
-                MessageMediaUnsupported: self.handle_telegram_unsupported,
-                MessageMediaGame: self.handle_telegram_game,
-            }[type(media)](source, intent, evt,
-                           relates_to=formatter.telegram_reply_to_matrix(evt, source))
-        else:
-            self.log.debug("Unhandled Telegram message %d", evt.id)
-            return
-
-        if not event_id:
-            return
+            if not event_id:
+                return
 
-        prev_id = self.dedup.update(evt, (event_id, tg_space), (temporary_identifier, tg_space))
-        if prev_id:
-            self.log.debug(f"Sent message {evt.id}@{tg_space} to Matrix as {event_id}. "
-                           f"Temporary dedup identifier was {temporary_identifier}, "
-                           f"but dedup map contained {prev_id[1]} instead! -- "
-                           "This was probably a race condition caused by Telegram sending updates"
-                           "to other clients before responding to the sender. I'll just redact "
-                           "the likely duplicate message now.")
-            await intent.redact(self.mxid, event_id)
-            return
-        if sender is not None:
-            UserActivity.update_for_puppet(sender, evt.date)
-        self.log.debug("Handled telegram message %d -> %s", evt.id, event_id)
+            prev_id = self.dedup.update(evt, (event_id, tg_space),
+                                        (temporary_identifier, tg_space))
+            if prev_id:
+                self.log.debug(f"Sent message {evt.id}@{tg_space} to Matrix as {event_id}. "
+                               f"Temporary dedup identifier was {temporary_identifier}, "
+                               f"but dedup map contained {prev_id[1]} instead! -- "
+                               "This was probably a race condition caused by Telegram sending "
+                               "updates to other clients before responding to the sender. I'll "
+                               "just redact the likely duplicate message now.")
+                await intent.redact(self.mxid, event_id)
+                return
+            if sender is not None:
+                await UserActivity.update_for_puppet(sender, evt.date)
+            self.log.debug("Handled telegram message %d -> %s", evt.id, event_id)
+            try:
+                written = await DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid,
+                                          mxid=event_id, tg_space=tg_space,
+                                          edit_index=0).insert()
+                await self._fix_temporary_mapping(temporary_identifier, event_id)
+            except IntegrityError as e:
+                await self._redact_unsaved_message(intent, event_id, e)
+            else:
+                # With write batching, the insert only fails after it's flushed
+                written.add_done_callback(lambda _: self._check_message_saved(written, intent,
+                                                                              event_id))
+            await self._send_delivery_receipt(event_id)
+        finally:
+            # Duplicates saved with the temporary identifier have been fixed up by now if the
+            # message was sent
+            self.dedup.pop_saved_temporary(temporary_identifier)
+
+    def _check_message_saved(self, written: 'asyncio.Future[None]', intent: IntentAPI,
+                             event_id: EventID) -> None:
+        if not written.cancelled() and isinstance(written.exception(), IntegrityError):
+            asyncio.create_task(self._redact_unsaved_message(intent, event_id,
+                                                             written.exception()))
+
+    async def _redact_unsaved_message(self, intent: IntentAPI, event_id: EventID,
+                                      error: IntegrityError) -> None:
+        self.log.error(f"{error.__class__.__name__} while saving message mapping of {event_id}. "
+                       "This might mean that an update was handled after it left the dedup "
+                       "cache queue. You can try enabling bridge.deduplication.pre_db_check in "
+                       "the config.")
         try:
-            DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=event_id,
-                      tg_space=tg_space, edit_index=0).insert()
-            DBMessage.update_by_mxid(temporary_identifier, self.mxid, mxid=event_id)
-        except IntegrityError as e:
-            self.log.exception(f"{e.__class__.__name__} while saving message mapping. "
-                               "This might mean that an update was handled after it left the "
-                               "dedup cache queue. You can try enabling bridge.deduplication."
-                               "pre_db_check in the config.")
             await intent.redact(self.mxid, event_id)
-        await self._send_delivery_receipt(event_id)
+        except MatrixError:
+            self.log.exception(f"Failed to redact duplicate message {event_id}")
+
+    async def _fix_temporary_mapping(self, temporary_identifier: EventID, event_id: EventID
+                                     ) -> None:
+        # Duplicates from other users' clients that arrived while the message was being sent were
+        # saved with the temporary identifier, so they need to be pointed at the real event.
+        if self.dedup.pop_saved_temporary(temporary_identifier):
+            TEMPORARY_ID_FIXUPS.inc()
+            await DBMessage.update_by_mxid(temporary_identifier, self.mxid, mxid=event_id)
 
     async def _create_room_on_action(self, source: 'AbstractUser',
                                      action: TypeMessageAction) -> bool:
@@ -738,6 +795,7 @@ class PortalTelegram(BasePortal, ABC):
     async def handle_telegram_action(self, source: 'AbstractUser', sender: p.Puppet,
                                      update: MessageService) -> None:
         action = update.action
+        await self.dedup.load()
         should_ignore = ((not self.mxid and not await self._create_room_on_action(source, action))
                          or self.dedup.check_action(update))
         if should_ignore or not self.mxid:
@@ -760,7 +818,7 @@ class PortalTelegram(BasePortal, ABC):
             await self._delete_telegram_user(TelegramID(action.user_id), sender)
         elif isinstance(action, MessageActionChatMigrateTo):
             self.peer_type = "channel"
-            self._migrate_and_save_telegram(TelegramID(action.channel_id))
+            await self._migrate_and_save_telegram(TelegramID(action.channel_id))
             # TODO encrypt
             await sender.intent_for(self).send_emote(self.mxid,
                                                      "upgraded this group to a supergroup.")
@@ -788,7 +846,7 @@ class PortalTelegram(BasePortal, ABC):
             tg_space = receiver if self.peer_type != "channel" else self.tgid
             previously_pinned = await self.main_intent.get_pinned_messages(self.mxid)
             currently_pinned_dict = {event_id: True for event_id in previously_pinned}
-            for message in DBMessage.get_first_by_tgids(msg_ids, tg_space):
+            for message in await DBMessage.get_first_by_tgids(msg_ids, tg_space):
                 if remove:
                     currently_pinned_dict.pop(message.mxid, None)
                 else:
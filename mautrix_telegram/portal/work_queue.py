@@ -0,0 +1,170 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import (Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple,
+                    TYPE_CHECKING)
+import asyncio
+import time
+
+from mautrix.util.opt_prometheus import Gauge, Histogram
+
+if TYPE_CHECKING:
+    from .base import BasePortal
+
+QUEUE_DEPTH = Gauge("bridge_portal_queue_depth",
+                    "Number of Telegram updates waiting to be handled in a portal", ("portal",))
+QUEUE_WAIT_TIME = Histogram("bridge_portal_queue_wait_time",
+                            "Time Telegram updates spent waiting in the portal queue",
+                            ("portal",))
+
+WorkItem = Tuple[int, float, Callable[..., Awaitable[Any]], Tuple[Any, ...]]
+
+
+class PortalWorkQueue:
+    """Runs the Telegram update handlers of a single portal one by one in the received order.
+
+    The queue is bounded: when it's full, :meth:`push` waits for free space, which stalls the
+    Telethon update handler that received the update instead of piling up coroutines.
+
+    Every pushed update gets a sequence number, which can be passed to :meth:`wait_for_pending`
+    to wait until that update and everything before it has been handled. Handlers can move slow
+    work like file transfers out of the queue with :meth:`run_in_background`, in which case the
+    update only counts as handled once the background task is done.
+    """
+    max_size: int = 100
+
+    _portal: 'BasePortal'
+    _queue: Optional['asyncio.Queue[WorkItem]']
+    _consumer: Optional[asyncio.Task]
+    _last_seq: int
+    _current_seq: Optional[int]
+    _unhandled: Set[int]
+    _waiters: List[Tuple[int, 'asyncio.Future[None]']]
+    _background: Dict[Hashable, asyncio.Task]
+
+    def __init__(self, portal: 'BasePortal') -> None:
+        self._portal = portal
+        self._queue = None
+        self._consumer = None
+        self._last_seq = 0
+        self._current_seq = None
+        self._unhandled = set()
+        self._waiters = []
+        self._background = {}
+
+    @property
+    def _label(self) -> str:
+        return self._portal.tgid_log
+
+    async def push(self, func: Callable[..., Awaitable[Any]], *args: Any) -> int:
+        """Queue an update handler. Returns the sequence number of the update."""
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_size)
+        self._last_seq += 1
+        seq = self._last_seq
+        self._unhandled.add(seq)
+        try:
+            await self._queue.put((seq, time.time(), func, args))
+        except BaseException:
+            self._mark_handled(seq)
+            raise
+        QUEUE_DEPTH.labels(portal=self._label).set(self._queue.qsize())
+        if not self._consumer or self._consumer.done():
+            self._consumer = asyncio.create_task(self._consume())
+        return seq
+
+    async def _consume(self) -> None:
+        while True:
+            if self._queue.empty():
+                # The consumer is recreated by the next push(), so idle portals have no task
+                self._consumer = None
+                return
+            seq, enqueued_at, func, args = self._queue.get_nowait()
+            QUEUE_DEPTH.labels(portal=self._label).set(self._queue.qsize())
+            QUEUE_WAIT_TIME.labels(portal=self._label).observe(time.time() - enqueued_at)
+            self._current_seq = seq
+            try:
+                await func(*args)
+            except Exception:
+                self._portal.log.exception("Failed to handle Telegram update")
+            finally:
+                if self._current_seq is not None:
+                    self._mark_handled(seq)
+                self._current_seq = None
+
+    def run_in_background(self, key: Hashable, coro: Awaitable[Any]) -> None:
+        """Finish handling the current update outside the queue.
+
+        Must be called from an update handler. The queue continues with the next update right
+        away, but :meth:`wait_for_pending` still waits for the background task. ``key`` can be
+        passed to :meth:`wait_for_background` to wait for this specific task.
+        """
+        seq, self._current_seq = self._current_seq, None
+        task = asyncio.create_task(self._run_background(seq, key, coro))
+        self._background[key] = task
+
+    async def _run_background(self, seq: Optional[int], key: Hashable, coro: Awaitable[Any]
+                              ) -> None:
+        try:
+            await coro
+        except Exception:
+            self._portal.log.exception("Failed to handle Telegram update")
+        finally:
+            if self._background.get(key) is asyncio.current_task():
+                del self._background[key]
+            if seq is not None:
+                self._mark_handled(seq)
+
+    async def wait_for_background(self, key: Hashable) -> None:
+        """Wait for the background task started with the given key, if there is one."""
+        task = self._background.get(key)
+        if task:
+            await asyncio.wait([task])
+
+    def _is_handled(self, seq: int) -> bool:
+        return not any(pending <= seq for pending in self._unhandled)
+
+    def _mark_handled(self, seq: int) -> None:
+        self._unhandled.discard(seq)
+        waiters, self._waiters = self._waiters, []
+        for waiting_for, waiter in waiters:
+            if waiter.done():
+                continue
+            elif self._is_handled(waiting_for):
+                waiter.set_result(None)
+            else:
+                self._waiters.append((waiting_for, waiter))
+
+    @property
+    def busy(self) -> bool:
+        return len(self._unhandled) > 0
+
+    async def wait_for_pending(self, seq: Optional[int] = None) -> None:
+        """Wait until the update with the given sequence number and all updates pushed before it
+        have been handled. By default, waits for the updates pushed before this call."""
+        if seq is None:
+            seq = self._last_seq
+        if self._is_handled(seq):
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append((seq, waiter))
+        await waiter
+
+    async def stop(self) -> None:
+        """Wait until all queued updates have been handled."""
+        if self.busy:
+            self._portal.log.debug(f"Handling {len(self._unhandled)} queued updates "
+                                   "before stopping")
+        await self.wait_for_pending()
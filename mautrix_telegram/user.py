@@ -533,10 +533,10 @@ class User(AbstractUser, BaseUser):
             if dialog.unread_count == 0:
                 # This is usually more reliable than finding a specific message
                 # e.g. if the last read message is a service message that isn't in the message db
-                last_read = DBMessage.find_last(portal.mxid, tg_space)
+                last_read = await DBMessage.find_last(portal.mxid, tg_space)
             else:
-                last_read = DBMessage.get_one_by_tgid(portal.tgid, tg_space,
-                                                      dialog.dialog.read_inbox_max_id)
+                last_read = await DBMessage.get_one_by_tgid(portal.tgid, tg_space,
+                                                            dialog.dialog.read_inbox_max_id)
             if last_read:
                 await puppet.intent.mark_read(last_read.mx_room, last_read.mxid)
             if was_created or not config["bridge.tag_only_on_create"]:
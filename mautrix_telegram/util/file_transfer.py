@@ -13,12 +13,15 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Tuple, Union, Dict
+from typing import (Optional, Tuple, Union, Dict, Deque, List, Iterable, AsyncIterator,
+                    AsyncGenerator, TYPE_CHECKING)
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
 from io import BytesIO
+import hashlib
 import time
 import logging
 import asyncio
-import tempfile
 
 import magic
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
@@ -30,12 +33,16 @@ from telethon.errors import (AuthBytesInvalidError, AuthKeyInvalidError, Locatio
                              SecurityError, FileIdInvalidError)
 
 from mautrix.appservice import IntentAPI
+from mautrix.types import EncryptedFile
+from mautrix.util.opt_prometheus import Counter
 
 from ..tgclient import MautrixTelegramClient
 from ..db import TelegramFile as DBTelegramFile
 from ..util import sane_mimetypes
 from .parallel_file_transfer import parallel_transfer_to_matrix
-from .tgs_converter import convert_tgs_to
+from .sticker_cache import convert_tgs_cached
+from .video_thumbnail import extract_thumbnail
+from . import process_pool
 
 try:
     from PIL import Image
@@ -43,26 +50,39 @@ except ImportError:
     Image = None
 
 try:
-    from moviepy.editor import VideoFileClip
+    from mautrix.crypto.attachments import encrypt_attachment, async_encrypt_attachment
 except ImportError:
-    VideoFileClip = None
+    encrypt_attachment = async_encrypt_attachment = None
 
-try:
-    from mautrix.crypto.attachments import encrypt_attachment
-except ImportError:
-    encrypt_attachment = None
+if TYPE_CHECKING:
+    from ..config import Config
 
 log: logging.Logger = logging.getLogger("mau.util")
 
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
+MIN_STREAM_CHUNK_SIZE = 4 * 1024
+MAX_STREAM_CHUNK_SIZE = 512 * 1024
 
-def convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
-                  thumbnail_to: Optional[Tuple[int, int]] = None
-                  ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
-    if not Image:
-        return source_mime, file, None, None
+# Files up to this size are downloaded into memory, bigger files are streamed to the media repo
+stream_buffer_size: int = 4 * 1024 * 1024
+# How much of the beginning of streamed videos is kept for extracting the thumbnail. ffmpeg
+# usually finds the first frame well within this.
+VIDEO_THUMBNAIL_PREFIX_SIZE = 1024 * 1024
+# Whether to reuse earlier unencrypted uploads of files with identical contents
+content_dedup: bool = True
+
+DEDUP_HITS = Counter("bridge_media_dedup_hits",
+                     "Number of Telegram files that reused an upload of identical contents")
+DEDUP_SAVED_BYTES = Counter("bridge_media_dedup_saved_bytes",
+                            "Bytes that didn't have to be uploaded to and stored in the media "
+                            "repo thanks to content deduplication")
+
+
+def _convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
+                   thumbnail_to: Optional[Tuple[int, int]] = None
+                   ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
     try:
         image: Image.Image = Image.open(BytesIO(file)).convert("RGBA")
         if thumbnail_to:
@@ -76,25 +96,17 @@ def convert_image(file: bytes, source_mime: str = "image/webp", target_type: str
         return source_mime, file, None, None
 
 
-def _read_video_thumbnail(data: bytes, video_ext: str = "mp4", frame_ext: str = "png",
-                          max_size: Tuple[int, int] = (1024, 720)) -> Tuple[bytes, int, int]:
-    with tempfile.NamedTemporaryFile(prefix="mxtg_video_", suffix=f".{video_ext}") as file:
-        # We don't have any way to read the video from memory, so save it to disk.
-        file.write(data)
-
-        # Read temp file and get frame
-        frame = VideoFileClip(file.name).get_frame(0)
-
-    # Convert to png and save to BytesIO
-    image = Image.fromarray(frame).convert("RGBA")
-
-    thumbnail_file = BytesIO()
-    if max_size:
-        image.thumbnail(max_size, Image.ANTIALIAS)
-    image.save(thumbnail_file, frame_ext)
-
-    w, h = image.size
-    return thumbnail_file.getvalue(), w, h
+async def convert_image(file: bytes, source_mime: str = "image/webp", target_type: str = "png",
+                        thumbnail_to: Optional[Tuple[int, int]] = None
+                        ) -> Tuple[str, bytes, Optional[int], Optional[int]]:
+    if not Image:
+        return source_mime, file, None, None
+    try:
+        return await process_pool.run(_convert_image, file, source_mime, target_type,
+                                      thumbnail_to)
+    except (asyncio.TimeoutError, BrokenProcessPool):
+        log.warning(f"Failed to convert {source_mime} to {target_type} in worker process")
+        return source_mime, file, None, None
 
 
 def _location_to_id(location: TypeLocation) -> str:
@@ -110,12 +122,11 @@ def _location_to_id(location: TypeLocation) -> str:
 
 async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
                                        thumbnail_loc: TypeLocation, mime_type: str, encrypt: bool,
-                                       video: Optional[bytes], custom_data: Optional[bytes] = None,
-                                       width: Optional[int] = None, height: [int] = None
+                                       video: Optional[List[bytes]],
+                                       custom_data: Optional[bytes] = None,
+                                       width: Optional[int] = None, height: [int] = None,
+                                       video_complete: bool = True
                                        ) -> Optional[DBTelegramFile]:
-    if not Image or not VideoFileClip:
-        return None
-
     loc_id = _location_to_id(thumbnail_loc)
     if not loc_id:
         return None
@@ -123,18 +134,18 @@ async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: In
     if custom_data:
         loc_id += "-mau_custom_thumbnail"
 
-    db_file = DBTelegramFile.get(loc_id)
+    db_file = await DBTelegramFile.get(loc_id)
     if db_file:
         return db_file
 
     video_ext = sane_mimetypes.guess_extension(mime_type)
+    thumbnail = None
+    if not custom_data and video_ext and video:
+        thumbnail = await extract_thumbnail(video, video_complete, video_ext.lstrip("."))
     if custom_data:
         file = custom_data
-    elif VideoFileClip and video_ext and video:
-        try:
-            file, width, height = _read_video_thumbnail(video, video_ext, frame_ext="png")
-        except OSError:
-            return None
+    elif thumbnail:
+        file, width, height = thumbnail
         mime_type = "image/png"
     else:
         file = await client.download_file(thumbnail_loc)
@@ -154,7 +165,7 @@ async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: In
                              was_converted=False, timestamp=int(time.time()), size=len(file),
                              width=width, height=height, decryption_info=decryption_info)
     try:
-        db_file.insert()
+        await db_file.insert()
     except (IntegrityError, InvalidRequestError) as e:
         log.exception(f"{e.__class__.__name__} while saving transferred file thumbnail data. "
                       "This was probably caused by two simultaneous transfers of the same file, "
@@ -162,6 +173,118 @@ async def transfer_thumbnail_to_matrix(client: MautrixTelegramClient, intent: In
     return db_file
 
 
+def _stream_chunk_size() -> int:
+    # Leave room for at least two chunks in the buffer, so that downloading the next chunk can
+    # happen while the previous one is being uploaded.
+    chunk_size = MAX_STREAM_CHUNK_SIZE
+    while chunk_size > MIN_STREAM_CHUNK_SIZE and chunk_size * 2 > stream_buffer_size:
+        chunk_size //= 2
+    return chunk_size
+
+
+async def _read_head(stream: AsyncIterator[bytes], max_size: int
+                     ) -> Tuple[Deque[bytes], bool]:
+    head = deque()
+    size = 0
+    while size < max_size:
+        try:
+            chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            return head, True
+        head.append(chunk)
+        size += len(chunk)
+    return head, False
+
+
+def _leading_chunks(chunks: Iterable[bytes], max_size: int) -> List[bytes]:
+    prefix = []
+    size = 0
+    for chunk in chunks:
+        if size >= max_size:
+            break
+        prefix.append(chunk)
+        size += len(chunk)
+    return prefix
+
+
+async def _read_rest(stream: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    while True:
+        try:
+            yield await stream.__anext__()
+        except StopAsyncIteration:
+            return
+
+
+async def _prefetch(stream: AsyncIterator[bytes], max_chunks: int
+                    ) -> AsyncGenerator[bytes, None]:
+    queue: asyncio.Queue = asyncio.Queue(max(max_chunks, 1))
+
+    async def produce() -> None:
+        try:
+            async for chunk in stream:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def _stream_file_to_matrix(intent: IntentAPI, loc_id: str, head: Deque[bytes],
+                                 stream: AsyncIterator[bytes], mime_type: str,
+                                 filename: Optional[str], encrypt: bool, size: Optional[int]
+                                 ) -> DBTelegramFile:
+    transferred = 0
+
+    async def data() -> AsyncGenerator[bytes, None]:
+        nonlocal transferred
+        # Popping the chunks lets them be freed as soon as they've been uploaded
+        while head:
+            chunk = head.popleft()
+            transferred += len(chunk)
+            yield chunk
+        # The head already filled the buffer, so only the chunks in flight are buffered from here
+        async for chunk in _prefetch(_read_rest(stream),
+                                     stream_buffer_size // _stream_chunk_size() - 2):
+            transferred += len(chunk)
+            yield chunk
+
+    upload = data()
+    decryption_info = None
+    upload_mime_type = mime_type
+    upload_size = size
+    if encrypt and async_encrypt_attachment:
+        async def encrypted(plaintext: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+            nonlocal decryption_info
+            async for chunk in async_encrypt_attachment(plaintext):
+                if isinstance(chunk, EncryptedFile):
+                    decryption_info = chunk
+                else:
+                    yield chunk
+
+        upload = encrypted(upload)
+        upload_mime_type = "application/octet-stream"
+        upload_size = None
+    content_uri = await intent.upload_media(upload, upload_mime_type, filename=filename,
+                                            size=upload_size)
+    if decryption_info:
+        decryption_info.url = content_uri
+    return DBTelegramFile(id=loc_id, mxc=content_uri, decryption_info=decryption_info,
+                          mime_type=mime_type, was_converted=False, timestamp=int(time.time()),
+                          size=size or transferred, width=None, height=None)
+
+
 transfer_locks: Dict[str, asyncio.Lock] = {}
 
 TypeThumbnail = Optional[Union[TypeLocation, TypePhotoSize]]
@@ -176,7 +299,7 @@ async def transfer_file_to_matrix(client: MautrixTelegramClient, intent: IntentA
     if not location_id:
         return None
 
-    db_file = DBTelegramFile.get(location_id)
+    db_file = await DBTelegramFile.get(location_id)
     if db_file:
         return db_file
 
@@ -197,7 +320,7 @@ async def _unlocked_transfer_file_to_matrix(client: MautrixTelegramClient, inten
                                             tgs_convert: Optional[dict], filename: Optional[str],
                                             encrypt: bool, parallel_id: Optional[int]
                                             ) -> Optional[DBTelegramFile]:
-    db_file = DBTelegramFile.get(loc_id)
+    db_file = await DBTelegramFile.get(loc_id)
     if db_file:
         return db_file
 
@@ -207,53 +330,94 @@ async def _unlocked_transfer_file_to_matrix(client: MautrixTelegramClient, inten
         db_file = await parallel_transfer_to_matrix(client, intent, loc_id, location, filename,
                                                     encrypt, parallel_id)
         mime_type = location.mime_type
-        file = None
+        video, video_complete = None, False
     else:
+        size = location.size if isinstance(location, Document) else None
+        stream = client.iter_download(location, request_size=_stream_chunk_size(),
+                                      file_size=size)
         try:
-            file = await client.download_file(location)
-        except (LocationInvalidError, FileIdInvalidError):
-            return None
-        except (AuthBytesInvalidError, AuthKeyInvalidError, SecurityError) as e:
-            log.exception(f"{e.__class__.__name__} while downloading a file.")
-            return None
-
+            try:
+                head, complete = await _read_head(stream, stream_buffer_size)
+            except (LocationInvalidError, FileIdInvalidError):
+                return None
+            except (AuthBytesInvalidError, AuthKeyInvalidError, SecurityError) as e:
+                log.exception(f"{e.__class__.__name__} while downloading a file.")
+                return None
+
+            first_chunk = head[0] if head else b""
+            mime_type = magic.from_buffer(first_chunk, mime=True)
+            # A weird bug in alpine/magic makes it return application/octet-stream for gzips...
+            is_tgs = (mime_type == "application/gzip"
+                      or (mime_type == "application/octet-stream"
+                          and magic.from_buffer(first_chunk).startswith("gzip")))
+            if not complete and is_sticker and tgs_convert and is_tgs:
+                head += [chunk async for chunk in _read_rest(stream)]
+                complete = True
+            if not complete:
+                # Files that don't fit in the buffer are streamed to the media repo. The video is
+                # never fully in memory then, so the thumbnail is extracted from the beginning.
+                video, video_complete = None, False
+                if thumbnail and (mime_type.startswith("video/") or mime_type == "image/gif"):
+                    video = _leading_chunks(head, VIDEO_THUMBNAIL_PREFIX_SIZE)
+                db_file = await _stream_file_to_matrix(intent, loc_id, head, stream, mime_type,
+                                                       filename, encrypt, size)
+        finally:
+            await stream.close()
+
+    if not db_file:
+        file = b"".join(head)
+        del head
+        video, video_complete = [file], True
         width, height = None, None
-        mime_type = magic.from_buffer(file, mime=True)
-
         image_converted = False
-        # A weird bug in alpine/magic makes it return application/octet-stream for gzips...
-        is_tgs = (mime_type == "application/gzip"
-                  or (mime_type == "application/octet-stream"
-                      and magic.from_buffer(file).startswith("gzip")))
         if is_sticker and tgs_convert and is_tgs:
-            converted_anim = await convert_tgs_to(file, tgs_convert["target"],
-                                                  **tgs_convert["args"])
+            document_id = location.id if isinstance(location, Document) else None
+            converted_anim = await convert_tgs_cached(document_id, file, tgs_convert["target"],
+                                                      **tgs_convert["args"])
             mime_type = converted_anim.mime
             file = converted_anim.data
             width, height = converted_anim.width, converted_anim.height
             image_converted = mime_type != "application/gzip"
             thumbnail = None
 
+        sha256 = duplicate = None
+        if content_dedup and not encrypt:
+            sha256 = hashlib.sha256(file).hexdigest()
+            duplicate = await DBTelegramFile.get_by_sha256(sha256)
+
         decryption_info = None
-        upload_mime_type = mime_type
-        if encrypt and encrypt_attachment:
-            file, decryption_info = encrypt_attachment(file)
-            upload_mime_type = "application/octet-stream"
-        content_uri = await intent.upload_media(file, upload_mime_type)
-        if decryption_info:
-            decryption_info.url = content_uri
+        if duplicate:
+            content_uri = duplicate.mxc
+            saved_bytes = len(file)
+            if duplicate.thumbnail:
+                saved_bytes += duplicate.thumbnail.size or 0
+            DEDUP_HITS.inc()
+            DEDUP_SAVED_BYTES.inc(saved_bytes)
+            log.debug(f"Reusing {content_uri} for {loc_id}, which has the same contents as "
+                      f"{duplicate.id}")
+        else:
+            upload_mime_type = mime_type
+            if encrypt and encrypt_attachment:
+                file, decryption_info = encrypt_attachment(file)
+                upload_mime_type = "application/octet-stream"
+            content_uri = await intent.upload_media(file, upload_mime_type)
+            if decryption_info:
+                decryption_info.url = content_uri
 
         db_file = DBTelegramFile(id=loc_id, mxc=content_uri, decryption_info=decryption_info,
                                  mime_type=mime_type, was_converted=image_converted,
                                  timestamp=int(time.time()), size=len(file),
-                                 width=width, height=height)
+                                 width=width, height=height, sha256=sha256)
+        if duplicate and duplicate.thumbnail:
+            db_file.thumbnail = duplicate.thumbnail
+            thumbnail = converted_anim = None
     if thumbnail and (mime_type.startswith("video/") or mime_type == "image/gif"):
         if isinstance(thumbnail, (PhotoSize, PhotoCachedSize)):
             thumbnail = thumbnail.location
         try:
-            db_file.thumbnail = await transfer_thumbnail_to_matrix(client, intent, thumbnail,
-                                                                   video=file, mime_type=mime_type,
-                                                                   encrypt=encrypt)
+            db_file.thumbnail = await transfer_thumbnail_to_matrix(
+                client, intent, thumbnail, video=video, video_complete=video_complete,
+                mime_type=mime_type, encrypt=encrypt)
         except FileIdInvalidError:
             log.warning(f"Failed to transfer thumbnail for {thumbnail!s}", exc_info=True)
     elif converted_anim and converted_anim.thumbnail_data:
@@ -263,9 +427,15 @@ async def _unlocked_transfer_file_to_matrix(client: MautrixTelegramClient, inten
             width=converted_anim.width, height=converted_anim.height)
 
     try:
-        db_file.insert()
+        await db_file.insert()
     except (IntegrityError, InvalidRequestError) as e:
         log.exception(f"{e.__class__.__name__} while saving transferred file data. "
                       "This was probably caused by two simultaneous transfers of the same file, "
                       "and should not cause any problems.")
     return db_file
+
+
+def init(cfg: 'Config') -> None:
+    global stream_buffer_size, content_dedup
+    stream_buffer_size = cfg["bridge.media_stream_buffer"] * 1024
+    content_dedup = cfg["bridge.media_content_dedup"]
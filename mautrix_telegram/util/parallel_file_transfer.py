@@ -13,26 +13,23 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, cast
-from collections import defaultdict
+from typing import (Optional, List, Dict, AsyncGenerator, Union, Awaitable, Tuple, Iterator,
+                    Callable, Sequence, cast, TYPE_CHECKING)
 import hashlib
 import asyncio
 import logging
 import time
 import math
 
-from aiohttp import ClientResponse
+from aiohttp import ClientResponse, ClientError
 
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
                                InputPhotoFileLocation, InputPeerPhotoFileLocation, TypeInputFile,
                                InputFileBig, InputFile)
-from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
-from telethon.tl.functions import InvokeWithLayerRequest
 from telethon.tl.functions.upload import (GetFileRequest, SaveFilePartRequest,
                                           SaveBigFilePartRequest)
-from telethon.tl.alltlobjects import LAYER
 from telethon.network import MTProtoSender
-from telethon.crypto import AuthKey
+from telethon.errors import FloodWaitError, ServerError
 from telethon import utils, helpers
 
 from mautrix.appservice import IntentAPI
@@ -41,79 +38,232 @@ from mautrix.util.logging import TraceLogger
 
 from ..tgclient import MautrixTelegramClient
 from ..db import TelegramFile as DBTelegramFile
+from .transfer_scheduler import TransferScheduler
+from .sender_pool import SenderPool
+from .transfer_spool import TransferSpool, SpooledTransfer
 
 try:
     from mautrix.crypto.attachments import async_encrypt_attachment
 except ImportError:
     async_encrypt_attachment = None
 
+if TYPE_CHECKING:
+    from ..config import Config
+
 log: TraceLogger = cast(TraceLogger, logging.getLogger("mau.util"))
 
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
+# Files bigger than this are uploaded to Telegram with SaveBigFilePartRequest
+LARGE_FILE_SIZE = 10 * 1024 * 1024
+# Spooled transfers retry the parts that haven't been transferred yet after these errors
+RETRYABLE_ERRORS = (OSError, asyncio.TimeoutError, ClientError, ServerError, FloodWaitError)
+TRANSFER_ATTEMPTS = 3
+# Longer flood waits fail the transfer instead of waiting while holding the connection budget.
+# The spooled parts are kept, so the transfer resumes when the file is bridged again.
+MAX_RETRY_DELAY = 30
+
 
 class DownloadSender:
     sender: MTProtoSender
-    request: GetFileRequest
-    remaining: int
-    stride: int
+    file: TypeLocation
+    part_size: int
 
-    def __init__(self, sender: MTProtoSender, file: TypeLocation, offset: int, limit: int,
-                 stride: int, count: int) -> None:
+    def __init__(self, sender: MTProtoSender, file: TypeLocation, part_size: int) -> None:
         self.sender = sender
-        self.request = GetFileRequest(file, offset=offset, limit=limit)
-        self.stride = stride
-        self.remaining = count
-
-    async def next(self) -> Optional[bytes]:
-        if not self.remaining:
-            return None
-        result = await self.sender.send(self.request)
-        self.remaining -= 1
-        self.request.offset += self.stride
+        self.file = file
+        self.part_size = part_size
+
+    async def fetch(self, part: int) -> bytes:
+        result = await self.sender.send(GetFileRequest(self.file, offset=part * self.part_size,
+                                                       limit=self.part_size))
         return result.bytes
 
-    def disconnect(self) -> Awaitable[None]:
-        return self.sender.disconnect()
+    async def release(self, pool: SenderPool) -> None:
+        pool.put(self.sender)
+
+
+class DownloadWindow:
+    """Hands out part numbers to download and puts the downloaded parts back in order.
+
+    Parts are only handed out up to :attr:`size` parts ahead of the oldest part that hasn't been
+    consumed yet, which bounds the memory used for reordering.
+    """
+    part_numbers: Sequence[int]
+    size: int
+    next_request: int
+    next_consume: int
+    parts: Dict[int, bytes]
+    error: Optional[BaseException]
+    received_bytes: int
+    _cond: asyncio.Condition
+
+    def __init__(self, part_numbers: Sequence[int], size: int) -> None:
+        self.part_numbers = part_numbers
+        self.size = size
+        self.next_request = 0
+        self.next_consume = 0
+        self.parts = {}
+        self.error = None
+        self.received_bytes = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def requested_all(self) -> bool:
+        return self.next_request >= len(self.part_numbers)
+
+    async def resize(self, size: int) -> None:
+        async with self._cond:
+            self.size = size
+            self._cond.notify_all()
+
+    async def take(self) -> Optional[int]:
+        async with self._cond:
+            await self._cond.wait_for(lambda: (self.requested_all or self.error is not None
+                                               or self.next_request < self.next_consume
+                                               + self.size))
+            if self.requested_all or self.error is not None:
+                return None
+            part = self.part_numbers[self.next_request]
+            self.next_request += 1
+            return part
+
+    async def complete(self, part: int, data: bytes) -> None:
+        async with self._cond:
+            self.parts[part] = data
+            self.received_bytes += len(data)
+            self._cond.notify_all()
+
+    async def fail(self, error: BaseException) -> None:
+        async with self._cond:
+            self.error = error
+            self._cond.notify_all()
+
+    async def consume(self) -> Tuple[int, bytes]:
+        async with self._cond:
+            part = self.part_numbers[self.next_consume]
+            await self._cond.wait_for(lambda: part in self.parts or self.error is not None)
+            if self.error is not None:
+                raise self.error
+            data = self.parts.pop(part)
+            self.next_consume += 1
+            self._cond.notify_all()
+            return part, data
+
+
+def _serialize_part(data: Union[bytes, memoryview]) -> bytes:
+    # Same as TLObject.serialize_bytes, but also accepts memoryviews of upload parts, so that
+    # the serialized request is the only copy made of them.
+    if len(data) < 254:
+        header = bytes([len(data)])
+        padding = (4 - (len(data) + 1) % 4) % 4
+    else:
+        header = bytes([254, len(data) % 256, (len(data) >> 8) % 256, (len(data) >> 16) % 256])
+        padding = (4 - len(data) % 4) % 4
+    return b"".join((header, data, bytes(padding)))
+
+
+class SaveFilePartViewRequest(SaveFilePartRequest):
+    serialize_bytes = staticmethod(_serialize_part)
+
+
+class SaveBigFilePartViewRequest(SaveBigFilePartRequest):
+    serialize_bytes = staticmethod(_serialize_part)
+
+
+class UploadPartAssembler:
+    """Cuts a stream of chunks into upload parts without copying them more than necessary.
+
+    Parts are returned as memoryviews. Parts that are entirely inside one chunk are views of the
+    chunk itself, and parts that span several chunks are assembled in a ring of preallocated
+    part-sized buffers. A buffer is reused after ``ring_size`` more parts, so the parts must be
+    sent before that.
+    """
+    part_size: int
+    copied_bytes: int
+
+    _ring: List[bytearray]
+    _slot: int
+    _filled: int
+
+    def __init__(self, part_size: int, ring_size: int) -> None:
+        self.part_size = part_size
+        self.copied_bytes = 0
+        self._ring = [bytearray(part_size) for _ in range(ring_size)]
+        self._slot = 0
+        self._filled = 0
+
+    def _next_buffer(self) -> memoryview:
+        buffer = memoryview(self._ring[self._slot])[:self._filled]
+        self._slot = (self._slot + 1) % len(self._ring)
+        self._filled = 0
+        return buffer
+
+    def feed(self, data: bytes) -> Iterator[memoryview]:
+        view = memoryview(data)
+        while len(view) > 0:
+            if self._filled == 0 and len(view) >= self.part_size:
+                yield view[:self.part_size]
+                view = view[self.part_size:]
+                continue
+            count = min(len(view), self.part_size - self._filled)
+            self._ring[self._slot][self._filled:self._filled + count] = view[:count]
+            self.copied_bytes += count
+            self._filled += count
+            view = view[count:]
+            if self._filled == self.part_size:
+                yield self._next_buffer()
+
+    def flush(self) -> Optional[memoryview]:
+        return self._next_buffer() if self._filled > 0 else None
 
 
 class UploadSender:
     sender: MTProtoSender
-    request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
+    request: Union[SaveFilePartViewRequest, SaveBigFilePartViewRequest]
     part_count: int
+    next_part: int
     stride: int
+    on_part_sent: Optional[Callable[[int], Awaitable[None]]]
     previous: Optional[asyncio.Task]
     loop: asyncio.AbstractEventLoop
 
     def __init__(self, sender: MTProtoSender, file_id: int, part_count: int, big: bool, index: int,
-                 stride: int, loop: asyncio.AbstractEventLoop) -> None:
+                 stride: int, loop: asyncio.AbstractEventLoop,
+                 on_part_sent: Optional[Callable[[int], Awaitable[None]]] = None) -> None:
         self.sender = sender
         self.part_count = part_count
         if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
+            self.request = SaveBigFilePartViewRequest(file_id, index, part_count, b"")
         else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
+            self.request = SaveFilePartViewRequest(file_id, index, b"")
+        self.next_part = index
         self.stride = stride
+        self.on_part_sent = on_part_sent
         self.previous = None
         self.loop = loop
 
-    async def next(self, data: bytes) -> None:
+    async def next(self, data: Union[bytes, memoryview], part: Optional[int] = None) -> None:
         if self.previous:
             await self.previous
-        self.previous = self.loop.create_task(self._next(data))
+        if part is None:
+            part = self.next_part
+            self.next_part += self.stride
+        self.previous = self.loop.create_task(self._next(part, data))
 
-    async def _next(self, data: bytes) -> None:
+    async def _next(self, part: int, data: Union[bytes, memoryview]) -> None:
+        self.request.file_part = part
         self.request.bytes = data
-        log.trace(f"Sending file part {self.request.file_part}/{self.part_count}"
-                  f" with {len(data)} bytes")
+        log.trace(f"Sending file part {part}/{self.part_count} with {len(data)} bytes")
         await self.sender.send(self.request)
-        self.request.file_part += self.stride
+        if self.on_part_sent:
+            await self.on_part_sent(part)
 
-    async def disconnect(self) -> None:
+    async def release(self, pool: SenderPool) -> None:
         if self.previous:
             await self.previous
-        return await self.sender.disconnect()
+        pool.put(self.sender)
 
 
 class ParallelTransferrer:
@@ -121,20 +271,27 @@ class ParallelTransferrer:
     loop: asyncio.AbstractEventLoop
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
-    auth_key: AuthKey
+    pool: SenderPool
     upload_ticker: int
 
+    # Number of parts to keep requested at the same time on each download connection
+    requests_per_connection: int = 4
+    # Download connections are added one by one every adapt_interval seconds until the speed
+    # doesn't increase by at least adapt_min_gain anymore
+    initial_connections: int = 2
+    adapt_interval: float = 0.5
+    adapt_min_gain: float = 0.1
+
     def __init__(self, client: MautrixTelegramClient, dc_id: Optional[int] = None) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
-        self.auth_key = (None if dc_id and self.client.session.dc_id != dc_id
-                         else self.client.session.auth_key)
+        self.pool = SenderPool.get_pool(client, self.dc_id)
         self.senders = None
         self.upload_ticker = 0
 
     async def _cleanup(self) -> None:
-        await asyncio.gather(*(sender.disconnect() for sender in self.senders))
+        await asyncio.gather(*(sender.release(self.pool) for sender in self.senders))
         self.senders = None
 
     @staticmethod
@@ -144,108 +301,175 @@ class ParallelTransferrer:
             return max_count
         return math.ceil((file_size / full_size) * max_count)
 
-    async def _init_download(self, connections: int, file: TypeLocation, part_count: int,
-                             part_size: int) -> None:
-        minimum, remainder = divmod(part_count, connections)
-
-        def get_part_count() -> int:
-            nonlocal remainder
-            if remainder > 0:
-                remainder -= 1
-                return minimum + 1
-            return minimum
-
-        # The first cross-DC sender will export+import the authorization, so we always create it
-        # before creating any other senders.
-        self.senders = [
-            await self._create_download_sender(file, 0, part_size, connections * part_size,
-                                               get_part_count()),
-            *await asyncio.gather(
-                *(self._create_download_sender(file, i, part_size, connections * part_size,
-                                               get_part_count())
-                  for i in range(1, connections)))
-        ]
-
-    async def _create_download_sender(self, file: TypeLocation, index: int, part_size: int,
-                                      stride: int,
-                                      part_count: int) -> DownloadSender:
-        return DownloadSender(await self._create_sender(), file, index * part_size, part_size,
-                              stride, part_count)
-
-    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool
-                           ) -> None:
+    async def _download_lane(self, sender: DownloadSender, window: DownloadWindow) -> None:
+        try:
+            while True:
+                part = await window.take()
+                if part is None:
+                    return
+                await window.complete(part, await sender.fetch(part))
+                log.trace(f"Part {part} downloaded")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await window.fail(e)
+
+    async def _add_download_connection(self, file: TypeLocation, part_size: int,
+                                       window: DownloadWindow, lanes: List[asyncio.Task]) -> None:
+        sender = DownloadSender(await self._create_sender(), file, part_size)
+        self.senders.append(sender)
+        await window.resize(len(self.senders) * self.requests_per_connection)
+        lanes += [self.loop.create_task(self._download_lane(sender, window))
+                  for _ in range(self.requests_per_connection)]
+
+    async def _adapt_connections(self, file: TypeLocation, part_size: int, max_count: int,
+                                 window: DownloadWindow, lanes: List[asyncio.Task]) -> None:
+        # Add connections one by one for as long as each new one makes the download faster
+        previous_speed = 0.0
+        while len(self.senders) < max_count and not window.requested_all:
+            start_bytes, start_time = window.received_bytes, time.monotonic()
+            await asyncio.sleep(self.adapt_interval)
+            speed = (window.received_bytes - start_bytes) / (time.monotonic() - start_time)
+            if previous_speed and speed < previous_speed * (1 + self.adapt_min_gain):
+                log.debug(f"Parallel download speed stopped improving at {len(self.senders)}"
+                          f" connections ({speed / 1024:.0f} KiB/s)")
+                return
+            previous_speed = speed
+            await self._add_download_connection(file, part_size, window, lanes)
+
+    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool,
+                           on_part_sent: Optional[Callable[[int], Awaitable[None]]]) -> None:
         self.senders = [
-            await self._create_upload_sender(file_id, part_count, big, 0, connections),
+            await self._create_upload_sender(file_id, part_count, big, 0, connections,
+                                             on_part_sent),
             *await asyncio.gather(
-                *(self._create_upload_sender(file_id, part_count, big, i, connections)
+                *(self._create_upload_sender(file_id, part_count, big, i, connections,
+                                             on_part_sent)
                   for i in range(1, connections)))
         ]
 
     async def _create_upload_sender(self, file_id: int, part_count: int, big: bool, index: int,
-                                    stride: int) -> UploadSender:
+                                    stride: int,
+                                    on_part_sent: Optional[Callable[[int], Awaitable[None]]]
+                                    ) -> UploadSender:
         return UploadSender(await self._create_sender(), file_id, part_count, big, index, stride,
-                            loop=self.loop)
-
-    async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
-        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
-                                                     loggers=self.client._log,
-                                                     proxy=self.client._proxy))
-        if not self.auth_key:
-            log.debug(f"Exporting auth to DC {self.dc_id}")
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            self.client._init_request.query = ImportAuthorizationRequest(id=auth.id,
-                                                                         bytes=auth.bytes)
-            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
-            await sender.send(req)
-            self.auth_key = sender.auth_key
-        return sender
+                            loop=self.loop, on_part_sent=on_part_sent)
+
+    def _create_sender(self) -> Awaitable[MTProtoSender]:
+        return self.pool.get()
 
     async def init_upload(self, file_id: int, file_size: int, part_size_kb: Optional[float] = None,
-                          connection_count: Optional[int] = None) -> Tuple[int, int, bool]:
+                          connection_count: Optional[int] = None,
+                          on_part_sent: Optional[Callable[[int], Awaitable[None]]] = None
+                          ) -> Tuple[int, int, bool]:
         connection_count = connection_count or self._get_connection_count(file_size)
         part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
         part_count = (file_size + part_size - 1) // part_size
-        is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+        is_large = file_size > LARGE_FILE_SIZE
+        await self._init_upload(connection_count, file_id, part_count, is_large, on_part_sent)
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
+    async def upload(self, data: Union[bytes, memoryview], part: Optional[int] = None) -> None:
+        await self.senders[self.upload_ticker].next(data, part)
         self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
 
     async def finish_upload(self) -> None:
         await self._cleanup()
 
+    async def abort_upload(self) -> None:
+        # Senders whose last part failed aren't returned to the pool
+        await asyncio.gather(*(sender.release(self.pool) for sender in self.senders),
+                             return_exceptions=True)
+        self.senders = None
+
     async def download(self, file: TypeLocation, file_size: int,
                        part_size_kb: Optional[float] = None,
                        connection_count: Optional[int] = None) -> AsyncGenerator[bytes, None]:
-        connection_count = connection_count or self._get_connection_count(file_size)
         part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
-        part_count = math.ceil(file_size / part_size)
+        parts = range(math.ceil(file_size / part_size))
+        async for _, data in self.download_parts(file, file_size, parts, part_size_kb,
+                                                 connection_count):
+            yield data
+
+    async def download_parts(self, file: TypeLocation, file_size: int, parts: Sequence[int],
+                             part_size_kb: Optional[float] = None,
+                             connection_count: Optional[int] = None
+                             ) -> AsyncGenerator[Tuple[int, bytes], None]:
+        max_count = connection_count or self._get_connection_count(file_size)
+        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        part_count = len(parts)
         log.debug("Starting parallel download: "
-                  f"{connection_count} {part_size} {part_count} {file!s}")
-        await self._init_download(connection_count, file, part_count, part_size)
-
-        part = 0
-        while part < part_count:
-            tasks = []
-            for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
-            for task in tasks:
-                data = await task
-                if not data:
-                    break
+                  f"up to {max_count} {part_size} {part_count} {file!s}")
+
+        self.senders = []
+        window = DownloadWindow(parts, 0)
+        lanes: List[asyncio.Task] = []
+        adapter = None
+        try:
+            for _ in range(min(self.initial_connections, max_count)):
+                await self._add_download_connection(file, part_size, window, lanes)
+            adapter = self.loop.create_task(self._adapt_connections(file, part_size, max_count,
+                                                                    window, lanes))
+            for _ in range(part_count):
+                yield await window.consume()
+        finally:
+            # Wait for the tasks to stop, so that they can't add connections or use them after
+            # the connections have been returned to the pool
+            if adapter:
+                adapter.cancel()
+                error, = await asyncio.gather(adapter, return_exceptions=True)
+                if error and not isinstance(error, asyncio.CancelledError):
+                    log.warning("Failed to add connections to parallel download",
+                                exc_info=error)
+            for lane in lanes:
+                lane.cancel()
+            # Lanes report their errors through the window
+            await asyncio.gather(*lanes, return_exceptions=True)
+            log.debug("Parallel download finished with "
+                      f"{len(self.senders)} connections, returning them to the pool")
+            await self._cleanup()
+
+
+# Telegram has connection count limits, so all parallel transfers share a connection budget
+transfer_scheduler = TransferScheduler()
+transfer_spool: Optional[TransferSpool] = None
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    if isinstance(error, FloodWaitError):
+        return error.seconds
+    return 2 ** attempt
+
+
+async def _spooled_download(downloader: ParallelTransferrer, location: TypeLocation,
+                            spooled: SpooledTransfer, connection_count: int
+                            ) -> AsyncGenerator[bytes, None]:
+    # Parts are yielded in order as soon as they're on disk. If the download fails, only the
+    # parts that aren't on disk yet are downloaded again, and the consumer doesn't notice.
+    next_part = 0
+    attempt = 1
+    while True:
+        try:
+            async for part, data in downloader.download_parts(
+                    location, spooled.size, spooled.missing_parts(),
+                    part_size_kb=spooled.part_size // 1024, connection_count=connection_count):
+                await spooled.write_part(part, data)
+                while next_part < part:
+                    yield await spooled.read_part(next_part)
+                    next_part += 1
                 yield data
-                part += 1
-                log.trace(f"Part {part} downloaded")
-
-        log.debug("Parallel download finished, cleaning up connections")
-        await self._cleanup()
-
-
-parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(lambda: asyncio.Lock())
+                next_part += 1
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt >= TRANSFER_ATTEMPTS or _retry_delay(e, attempt) > MAX_RETRY_DELAY:
+                raise
+            log.warning(f"Parallel download failed ({e!r}), retrying "
+                        f"{len(spooled.missing_parts())} missing parts")
+            await asyncio.sleep(_retry_delay(e, attempt))
+            attempt += 1
+    while next_part < spooled.part_count:
+        yield await spooled.read_part(next_part)
+        next_part += 1
 
 
 async def parallel_transfer_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
@@ -254,10 +478,22 @@ async def parallel_transfer_to_matrix(client: MautrixTelegramClient, intent: Int
     size = location.size
     mime_type = location.mime_type
     dc_id, location = utils.get_input_location(location)
-    # We lock the transfers because telegram has connection count limits
-    async with parallel_transfer_locks[parallel_id]:
+    part_size = utils.get_appropriated_part_size(size) * 1024
+    # Each download connection has several parts in flight
+    async with transfer_scheduler.reserve(
+            parallel_id, dc_id or client.session.dc_id, size,
+            ParallelTransferrer._get_connection_count(size),
+            part_size * ParallelTransferrer.requests_per_connection) as connection_count:
         downloader = ParallelTransferrer(client, dc_id)
-        data = downloader.download(location, size)
+        spooled = None
+        if transfer_spool:
+            spooled = await transfer_spool.open(TransferSpool.make_key("download", loc_id), size,
+                                                part_size)
+        if spooled:
+            data = _spooled_download(downloader, location, spooled, connection_count)
+        else:
+            data = downloader.download(location, size, part_size_kb=part_size // 1024,
+                                       connection_count=connection_count)
         decryption_info = None
         up_mime_type = mime_type
         if encrypt and async_encrypt_attachment:
@@ -271,8 +507,17 @@ async def parallel_transfer_to_matrix(client: MautrixTelegramClient, intent: Int
 
             data = encrypted(data)
             up_mime_type = "application/octet-stream"
-        content_uri = await intent.upload_media(data, mime_type=up_mime_type, filename=filename,
-                                                size=size if not encrypt else None)
+        try:
+            content_uri = await intent.upload_media(data, mime_type=up_mime_type,
+                                                    filename=filename,
+                                                    size=size if not encrypt else None)
+        except BaseException:
+            if spooled:
+                # Keep the downloaded parts for when the file is bridged again
+                await transfer_spool.release(spooled)
+            raise
+        if spooled:
+            await spooled.remove()
         if decryption_info:
             decryption_info.url = content_uri
     return DBTelegramFile(id=loc_id, mxc=content_uri, mime_type=mime_type,
@@ -280,32 +525,29 @@ async def parallel_transfer_to_matrix(client: MautrixTelegramClient, intent: Int
                           width=None, height=None, decryption_info=decryption_info)
 
 
-async def _internal_transfer_to_telegram(client: MautrixTelegramClient, response: ClientResponse
+async def _internal_transfer_to_telegram(client: MautrixTelegramClient, response: ClientResponse,
+                                         part_size: int, connection_count: int
                                          ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
     file_size = response.content_length
 
     hash_md5 = hashlib.md5()
     uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
-    buffer = bytearray()
+    part_size, part_count, is_large = await uploader.init_upload(
+        file_id, file_size, part_size_kb=part_size // 1024, connection_count=connection_count)
+    # Each sender waits for its previous part to be sent before taking the next one, so a
+    # buffer is free again after two parts per sender.
+    assembler = UploadPartAssembler(part_size, 2 * len(uploader.senders))
     async for data in response.content:
+        for part in assembler.feed(data):
+            if not is_large:
+                hash_md5.update(part)
+            await uploader.upload(part)
+    part = assembler.flush()
+    if part is not None:
         if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
-            await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
+            hash_md5.update(part)
+        await uploader.upload(part)
     await uploader.finish_upload()
     if is_large:
         return InputFileBig(file_id, part_count, "upload"), file_size
@@ -313,10 +555,112 @@ async def _internal_transfer_to_telegram(client: MautrixTelegramClient, response
         return InputFile(file_id, part_count, "upload", hash_md5.hexdigest()), file_size
 
 
+async def _upload_spooled_stream(uploader: ParallelTransferrer, spooled: SpooledTransfer,
+                                 response: ClientResponse, part: int) -> None:
+    # A ring of two parts per sender is enough, see _internal_transfer_to_telegram
+    assembler = UploadPartAssembler(spooled.part_size, 2 * len(uploader.senders))
+
+    async def upload(data: memoryview) -> None:
+        nonlocal part
+        if not spooled.is_stored(part):
+            await spooled.write_part(part, data)
+            await uploader.upload(data, part)
+        part += 1
+
+    async for chunk in response.content:
+        for data in assembler.feed(chunk):
+            await upload(data)
+    data = assembler.flush()
+    if data is not None:
+        await upload(data)
+
+
+async def _spooled_transfer_to_telegram(client: MautrixTelegramClient, intent: IntentAPI,
+                                        url: str, response: Optional[ClientResponse],
+                                        spooled: SpooledTransfer, connection_count: int
+                                        ) -> InputFileBig:
+    # Telegram keeps the parts of a big file for a while, so an interrupted upload continues
+    # with the same file ID and only sends the parts that weren't acknowledged yet.
+    uploader = ParallelTransferrer(client)
+    attempt = 1
+    while True:
+        await uploader.init_upload(spooled.file_id, spooled.size,
+                                   part_size_kb=spooled.part_size // 1024,
+                                   connection_count=connection_count,
+                                   on_part_sent=spooled.mark_done)
+        try:
+            for part in range(spooled.part_count):
+                if spooled.is_stored(part) and not spooled.is_done(part):
+                    await uploader.upload(await spooled.read_part(part), part)
+            missing = spooled.missing_parts()
+            if missing:
+                if missing[0] > 0 or not response:
+                    response = await intent.api.session.get(url, headers={
+                        "Range": f"bytes={missing[0] * spooled.part_size}-"})
+                async with response:
+                    # The Range header is optional for servers, parts that are already on disk
+                    # are skipped if it's ignored
+                    start = missing[0] if response.status == 206 else 0
+                    await _upload_spooled_stream(uploader, spooled, response, start)
+            await uploader.finish_upload()
+            return InputFileBig(spooled.file_id, spooled.part_count, "upload")
+        except RETRYABLE_ERRORS as e:
+            await uploader.abort_upload()
+            if attempt >= TRANSFER_ATTEMPTS or _retry_delay(e, attempt) > MAX_RETRY_DELAY:
+                raise
+            unsent = sum(not spooled.is_done(part) for part in range(spooled.part_count))
+            log.warning(f"Parallel upload failed ({e!r}), retrying {unsent} unsent parts")
+            await asyncio.sleep(_retry_delay(e, attempt))
+            attempt += 1
+            response = None
+
+
 async def parallel_transfer_to_telegram(client: MautrixTelegramClient, intent: IntentAPI,
                                         uri: ContentURI, parallel_id: int
                                         ) -> Tuple[TypeInputFile, int]:
     url = intent.api.get_download_url(uri)
-    async with parallel_transfer_locks[parallel_id]:
-        async with intent.api.session.get(url) as response:
-            return await _internal_transfer_to_telegram(client, response)
+    async with intent.api.session.get(url) as response:
+        size = response.content_length
+        part_size = utils.get_appropriated_part_size(size) * 1024
+        async with transfer_scheduler.reserve(parallel_id, client.session.dc_id, size,
+                                              ParallelTransferrer._get_connection_count(size),
+                                              part_size) as connection_count:
+            spooled = None
+            if transfer_spool and size > LARGE_FILE_SIZE:
+                spooled = await transfer_spool.open(TransferSpool.make_key("upload", uri), size,
+                                                    part_size,
+                                                    file_id=helpers.generate_random_long())
+            if not spooled:
+                return await _internal_transfer_to_telegram(client, response, part_size,
+                                                            connection_count)
+            try:
+                file = await _spooled_transfer_to_telegram(client, intent, url, response,
+                                                           spooled, connection_count)
+            except BaseException:
+                await transfer_spool.release(spooled)
+                raise
+            await spooled.remove()
+            return file, size
+
+
+def init(cfg: 'Config') -> None:
+    global transfer_scheduler
+    transfer_scheduler = TransferScheduler(
+        max_connections=cfg["bridge.parallel_transfer_budget.max_connections"],
+        max_connections_per_dc=cfg["bridge.parallel_transfer_budget.max_connections_per_dc"],
+        max_connections_per_user=cfg["bridge.parallel_transfer_budget.max_connections_per_user"],
+        max_connections_per_transfer=cfg[
+            "bridge.parallel_transfer_budget.max_connections_per_transfer"],
+        max_bytes_in_flight=cfg["bridge.parallel_transfer_budget.max_bytes_in_flight"] * 1024,
+    )
+    SenderPool.idle_timeout = cfg["bridge.parallel_transfer_budget.connection_idle_timeout"]
+
+    global transfer_spool
+    if cfg["bridge.transfer_spool.directory"]:
+        transfer_spool = TransferSpool(
+            directory=cfg["bridge.transfer_spool.directory"],
+            max_size=cfg["bridge.transfer_spool.max_size"] * 1024 * 1024,
+            max_age=cfg["bridge.transfer_spool.max_age"])
+        transfer_spool.cleanup()
+    else:
+        transfer_spool = None
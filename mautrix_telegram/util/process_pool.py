@@ -0,0 +1,118 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, AsyncIterator, Callable, Optional, TypeVar, TYPE_CHECKING
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+import functools
+import logging
+import asyncio
+import time
+
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+
+if TYPE_CHECKING:
+    from ..config import Config
+
+T = TypeVar("T")
+
+log: logging.Logger = logging.getLogger("mau.util.process_pool")
+
+QUEUED_JOBS = Gauge("bridge_media_process_queue_length",
+                    "Number of media conversions waiting for a worker process")
+RUNNING_JOBS = Gauge("bridge_media_process_running",
+                     "Number of media conversions running in worker processes")
+JOB_TIME = Histogram("bridge_media_process_time", "Time spent converting media in worker "
+                     "processes", ("job",))
+JOB_TIMEOUTS = Counter("bridge_media_process_timeouts", "Number of media conversions that were "
+                       "killed for taking too long", ("job",))
+
+workers: int = 2
+timeout: float = 30
+
+_executor: Optional[ProcessPoolExecutor] = None
+_slots: Optional[asyncio.Semaphore] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if not _executor:
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def _kill_executor() -> None:
+    # A worker that's stuck in native code can't be interrupted, so the only way to get it back
+    # is to terminate the processes. Other jobs in the same pool fail with BrokenProcessPool.
+    global _executor
+    executor, _executor = _executor, None
+    if not executor:
+        return
+    for process in list(getattr(executor, "_processes", {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False)
+
+
+@asynccontextmanager
+async def slot(job: str) -> AsyncIterator[None]:
+    """Wait for a free worker slot and hold it for the duration of the block.
+
+    This is used by :func:`run`, and can also be used to limit media conversions that run in
+    their own subprocesses (e.g. ffmpeg) with the same :data:`workers` budget and metrics.
+    """
+    global _slots
+    if not _slots:
+        _slots = asyncio.Semaphore(workers)
+    QUEUED_JOBS.inc()
+    try:
+        await _slots.acquire()
+    finally:
+        QUEUED_JOBS.dec()
+    RUNNING_JOBS.inc()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        JOB_TIME.labels(job=job).observe(time.monotonic() - start)
+        RUNNING_JOBS.dec()
+        _slots.release()
+
+
+async def run(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a CPU-bound function in a worker process so that it doesn't block the event loop.
+
+    At most :data:`workers` jobs run at a time and the rest wait in a queue. A job that runs for
+    longer than :data:`timeout` seconds is killed and :class:`asyncio.TimeoutError` is raised.
+    The function and its arguments must be picklable.
+    """
+    job = func.__name__
+    async with slot(job):
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"{job} took longer than {timeout} seconds, killing worker processes")
+            JOB_TIMEOUTS.labels(job=job).inc()
+            _kill_executor()
+            raise
+
+
+def init(cfg: 'Config') -> None:
+    global workers, timeout, _slots
+    workers = cfg["bridge.media_process_pool.workers"]
+    timeout = cfg["bridge.media_process_pool.timeout"]
+    _slots = None
+    _kill_executor()
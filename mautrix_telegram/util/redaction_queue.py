@@ -0,0 +1,118 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Tuple
+import asyncio
+import logging
+import time
+
+from mautrix.appservice import IntentAPI
+from mautrix.errors import MatrixError
+from mautrix.types import RoomID, EventID
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Gauge, Counter, Histogram
+
+PENDING_REDACTIONS = Gauge("bridge_pending_redactions",
+                           "Number of Telegram deletions waiting to be redacted on Matrix")
+FAILED_REDACTIONS = Counter("bridge_failed_redactions",
+                            "Number of Telegram deletions that couldn't be redacted on Matrix")
+REDACTION_TIME = Histogram("bridge_redaction_time",
+                           "Time from queueing a redaction of a deleted Telegram message to "
+                           "sending it")
+
+Redaction = Tuple[IntentAPI, RoomID, EventID, float]
+
+
+class RedactionQueue:
+    """Sends redactions in the background with limited concurrency and rate.
+
+    Deleting a large number of Telegram messages at once (e.g. clearing the history of a chat)
+    would otherwise send thousands of redactions to the homeserver at the same time.
+    """
+    log: TraceLogger = logging.getLogger("mau.redaction_queue")
+
+    concurrency: int
+    rate_limit: float
+
+    _queue: 'asyncio.Queue[Redaction]'
+    _workers: List[asyncio.Task]
+    _next_slot: float
+
+    def __init__(self, concurrency: int = 5, rate_limit: float = 10) -> None:
+        self.concurrency = max(concurrency, 1)
+        self.rate_limit = rate_limit
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._next_slot = 0
+
+    def push(self, intent: IntentAPI, room_id: RoomID, event_id: EventID) -> None:
+        self._queue.put_nowait((intent, room_id, event_id, time.time()))
+        PENDING_REDACTIONS.set(self._queue.qsize())
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker())
+                             for _ in range(self.concurrency)]
+
+    async def _wait_for_slot(self) -> None:
+        if self.rate_limit <= 0:
+            return
+        now = asyncio.get_event_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate_limit
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _worker(self) -> None:
+        while True:
+            intent, room_id, event_id, queued_at = await self._queue.get()
+            try:
+                await self._wait_for_slot()
+                await intent.redact(room_id, event_id)
+                REDACTION_TIME.observe(time.time() - queued_at)
+            except asyncio.CancelledError:
+                FAILED_REDACTIONS.inc()
+                self.log.warning(f"Dropped redaction of {event_id} in {room_id} at shutdown")
+                raise
+            except MatrixError as e:
+                FAILED_REDACTIONS.inc()
+                self.log.debug(f"Failed to redact {event_id} in {room_id}: {e}")
+            except Exception:
+                FAILED_REDACTIONS.inc()
+                self.log.exception(f"Failed to redact {event_id} in {room_id}")
+            finally:
+                self._queue.task_done()
+                PENDING_REDACTIONS.set(self._queue.qsize())
+
+    async def stop(self, timeout: float = 60) -> None:
+        """Send the queued redactions and stop the workers.
+
+        The message mappings are deleted before the redactions are queued, so redactions that
+        aren't sent here can't be retried later. The rate limit is lifted to send them before
+        the bridge exits.
+        """
+        if self._workers and self._queue.qsize() > 0:
+            self.log.info(f"Sending {self._queue.qsize()} queued redactions before stopping")
+            self.rate_limit = 0
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        while not self._queue.empty():
+            _, room_id, event_id, _ = self._queue.get_nowait()
+            FAILED_REDACTIONS.inc()
+            self.log.warning(f"Dropped redaction of {event_id} in {room_id} at shutdown")
+        PENDING_REDACTIONS.set(0)
@@ -0,0 +1,167 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Optional, Tuple, cast
+from weakref import WeakKeyDictionary
+import asyncio
+import logging
+import random
+import time
+
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions import InvokeWithLayerRequest, PingRequest
+from telethon.tl.alltlobjects import LAYER
+from telethon.network import MTProtoSender
+from telethon.crypto import AuthKey
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+from ..tgclient import MautrixTelegramClient
+
+IDLE_SENDERS = Gauge("bridge_sender_pool_idle", "Number of idle file transfer connections",
+                     ("dc",))
+SENDER_POOL_HITS = Counter("bridge_sender_pool_hits",
+                           "Number of file transfer connections reused from the pool", ("dc",))
+SENDER_POOL_MISSES = Counter("bridge_sender_pool_misses",
+                             "Number of new file transfer connections", ("dc",))
+
+
+class SenderPool:
+    """A pool of connected and authorized MTProto senders of one client to one DC.
+
+    Parallel file transfers borrow senders with :meth:`get` and give them back with :meth:`put`,
+    so back-to-back transfers don't have to connect, handshake and export the authorization to
+    another DC every time. Senders that are idle for longer than :attr:`idle_timeout` are
+    disconnected, and senders that have been idle for a while are pinged before they're reused.
+    """
+    log: TraceLogger = cast(TraceLogger, logging.getLogger("mau.sender_pool"))
+    _pools: 'WeakKeyDictionary[MautrixTelegramClient, Dict[int, SenderPool]]' = \
+        WeakKeyDictionary()
+
+    idle_timeout: float = 60
+    ping_after: float = 15
+    ping_timeout: float = 5
+
+    client: MautrixTelegramClient
+    dc_id: int
+    auth_key: Optional[AuthKey]
+
+    _idle: List[Tuple[float, MTProtoSender]]
+    _auth_lock: asyncio.Lock
+    _expire_task: Optional[asyncio.Task]
+
+    def __init__(self, client: MautrixTelegramClient, dc_id: int) -> None:
+        self.client = client
+        self.dc_id = dc_id
+        self.auth_key = (client.session.auth_key if client.session.dc_id == dc_id else None)
+        self._idle = []
+        self._auth_lock = asyncio.Lock()
+        self._expire_task = None
+
+    @classmethod
+    def get_pool(cls, client: MautrixTelegramClient, dc_id: Optional[int] = None
+                 ) -> 'SenderPool':
+        dc_id = dc_id or client.session.dc_id
+        pools = cls._pools.setdefault(client, {})
+        try:
+            return pools[dc_id]
+        except KeyError:
+            pool = pools[dc_id] = cls(client, dc_id)
+            return pool
+
+    @classmethod
+    async def close_all(cls, client: MautrixTelegramClient) -> None:
+        pools = cls._pools.pop(client, {})
+        await asyncio.gather(*(pool.close() for pool in pools.values()))
+
+    async def get(self) -> MTProtoSender:
+        while self._idle:
+            idle_since, sender = self._idle.pop()
+            IDLE_SENDERS.labels(dc=self.dc_id).set(len(self._idle))
+            if await self._is_healthy(sender, idle_since):
+                SENDER_POOL_HITS.labels(dc=self.dc_id).inc()
+                return sender
+            await sender.disconnect()
+        SENDER_POOL_MISSES.labels(dc=self.dc_id).inc()
+        return await self._create()
+
+    def put(self, sender: MTProtoSender) -> None:
+        if not sender.is_connected():
+            return
+        self._idle.append((time.monotonic(), sender))
+        IDLE_SENDERS.labels(dc=self.dc_id).set(len(self._idle))
+        if not self._expire_task or self._expire_task.done():
+            self._expire_task = asyncio.ensure_future(self._expire_loop())
+
+    async def close(self) -> None:
+        if self._expire_task:
+            self._expire_task.cancel()
+            self._expire_task = None
+        senders, self._idle = self._idle, []
+        IDLE_SENDERS.labels(dc=self.dc_id).set(0)
+        await asyncio.gather(*(sender.disconnect() for _, sender in senders))
+
+    async def _is_healthy(self, sender: MTProtoSender, idle_since: float) -> bool:
+        if not sender.is_connected():
+            return False
+        elif time.monotonic() - idle_since < self.ping_after:
+            return True
+        try:
+            await asyncio.wait_for(sender.send(PingRequest(random.randrange(2 ** 63))),
+                                   self.ping_timeout)
+            return True
+        except Exception as e:
+            self.log.debug(f"Dropping file transfer connection to DC {self.dc_id} that failed "
+                           f"health check: {e}")
+            return False
+
+    async def _expire_loop(self) -> None:
+        while self._idle:
+            await asyncio.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            expired = [sender for idle_since, sender in self._idle if idle_since < deadline]
+            self._idle = [(idle_since, sender) for idle_since, sender in self._idle
+                          if idle_since >= deadline]
+            IDLE_SENDERS.labels(dc=self.dc_id).set(len(self._idle))
+            if expired:
+                self.log.debug(f"Disconnecting {len(expired)} idle file transfer connections "
+                               f"to DC {self.dc_id}")
+                await asyncio.gather(*(sender.disconnect() for sender in expired))
+
+    async def _connect(self) -> MTProtoSender:
+        dc = await self.client._get_dc(self.dc_id)
+        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
+        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
+                                                     loggers=self.client._log,
+                                                     proxy=self.client._proxy))
+        return sender
+
+    async def _create(self) -> MTProtoSender:
+        if self.auth_key:
+            return await self._connect()
+        async with self._auth_lock:
+            # Only the first sender to another DC needs to export+import the authorization
+            if self.auth_key:
+                return await self._connect()
+            sender = await self._connect()
+            self.log.debug(f"Exporting auth to DC {self.dc_id}")
+            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
+            self.client._init_request.query = ImportAuthorizationRequest(id=auth.id,
+                                                                         bytes=auth.bytes)
+            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
+            await sender.send(req)
+            self.auth_key = sender.auth_key
+            return sender
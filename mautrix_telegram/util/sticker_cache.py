@@ -0,0 +1,186 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Optional, TYPE_CHECKING
+from collections import OrderedDict
+import asyncio
+import logging
+import json
+import os
+
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+from .tgs_converter import ConvertedSticker, convert_tgs_to, converters
+
+if TYPE_CHECKING:
+    from ..config import Config
+
+log: logging.Logger = logging.getLogger("mau.util.sticker_cache")
+
+CACHE_HITS = Counter("bridge_sticker_cache_hits",
+                     "Number of animated sticker conversions served from the disk cache")
+CACHE_MISSES = Counter("bridge_sticker_cache_misses",
+                       "Number of animated sticker conversions that weren't in the disk cache")
+CACHE_SIZE = Gauge("bridge_sticker_cache_bytes", "Size of the converted sticker disk cache")
+
+
+class StickerCache:
+    """A size-bounded disk cache of converted animated stickers.
+
+    Entries are keyed by the sticker document and the conversion settings, so the same sticker
+    is only rendered once per setting no matter which portal it's bridged to or whether the
+    result is encrypted afterwards. The least recently used entries are evicted first.
+    """
+    directory: str
+    max_size: int
+    loop: asyncio.AbstractEventLoop
+
+    _entries: 'OrderedDict[str, int]'
+    _size: int
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.loop = asyncio.get_event_loop()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._load()
+
+    @staticmethod
+    def make_key(document_id: int, convert_to: str, width: int, height: int,
+                 fps: Optional[int]) -> str:
+        return f"{document_id}-{convert_to}-{width}x{height}-{fps or 'default'}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.sticker")
+
+    def _load(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                elif name.endswith(".sticker"):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, name[:-len(".sticker")], stat.st_size))
+            except OSError:
+                log.warning(f"Failed to load cached sticker file {path}", exc_info=True)
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        CACHE_SIZE.set(self._size)
+
+    def _read(self, key: str) -> Optional[ConvertedSticker]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                meta = json.loads(file.readline())
+                data = file.read(meta["size"])
+                thumbnail_data = file.read(meta["thumbnail_size"]) or None
+            # The modification time is the last use for restoring the LRU order after a restart
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            log.warning(f"Failed to read cached sticker {key}", exc_info=True)
+            return None
+        return ConvertedSticker(meta["mime"], data, meta["thumbnail_mime"], thumbnail_data,
+                                meta["width"], meta["height"])
+
+    def _write(self, key: str, sticker: ConvertedSticker) -> int:
+        path = self._path(key)
+        meta = {"mime": sticker.mime, "size": len(sticker.data),
+                "thumbnail_mime": sticker.thumbnail_mime,
+                "thumbnail_size": len(sticker.thumbnail_data or b""),
+                "width": sticker.width, "height": sticker.height}
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(json.dumps(meta).encode("utf-8") + b"\n")
+            file.write(sticker.data)
+            file.write(sticker.thumbnail_data or b"")
+        os.replace(f"{path}.tmp", path)
+        return os.path.getsize(path)
+
+    def _delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _remove_entry(self, key: str) -> None:
+        self._size -= self._entries.pop(key, 0)
+        CACHE_SIZE.set(self._size)
+
+    async def get(self, key: str) -> Optional[ConvertedSticker]:
+        if key not in self._entries:
+            CACHE_MISSES.inc()
+            return None
+        self._entries.move_to_end(key)
+        sticker = await self.loop.run_in_executor(None, self._read, key)
+        if not sticker:
+            self._remove_entry(key)
+            await self.loop.run_in_executor(None, self._delete, key)
+            CACHE_MISSES.inc()
+            return None
+        CACHE_HITS.inc()
+        return sticker
+
+    async def put(self, key: str, sticker: ConvertedSticker) -> None:
+        try:
+            size = await self.loop.run_in_executor(None, self._write, key, sticker)
+        except OSError:
+            log.warning(f"Failed to write converted sticker {key} to cache", exc_info=True)
+            return
+        self._remove_entry(key)
+        self._entries[key] = size
+        self._size += size
+        evicted = []
+        while self._size > self.max_size and len(self._entries) > 1:
+            old_key, old_size = self._entries.popitem(last=False)
+            self._size -= old_size
+            evicted.append(old_key)
+        CACHE_SIZE.set(self._size)
+        for old_key in evicted:
+            await self.loop.run_in_executor(None, self._delete, old_key)
+
+
+cache: Optional[StickerCache] = None
+
+
+async def convert_tgs_cached(document_id: Optional[int], file: bytes, convert_to: str,
+                             width: int, height: int, **kwargs: Any) -> ConvertedSticker:
+    if not cache or document_id is None or convert_to not in converters:
+        return await convert_tgs_to(file, convert_to, width, height, **kwargs)
+    key = StickerCache.make_key(document_id, convert_to, width, height, kwargs.get("fps"))
+    converted = await cache.get(key)
+    if converted:
+        return converted
+    converted = await convert_tgs_to(file, convert_to, width, height, **kwargs)
+    # Failed conversions return the original sticker, which isn't worth caching
+    if converted.mime != "application/gzip":
+        await cache.put(key, converted)
+    return converted
+
+
+def init(cfg: 'Config') -> None:
+    global cache
+    directory = cfg["bridge.sticker_cache.directory"]
+    if not directory:
+        cache = None
+        return
+    try:
+        cache = StickerCache(directory, cfg["bridge.sticker_cache.max_size"] * 1024 * 1024)
+    except OSError as e:
+        log.warning(f"Failed to open sticker cache in {directory}, disabling cache: {e}")
+        cache = None
@@ -0,0 +1,186 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Deque, NamedTuple, Optional, Tuple, Union, TYPE_CHECKING
+from collections import OrderedDict, deque
+import logging
+import asyncio
+import time
+
+from telethon.tl.functions.messages import GetStickerSetRequest
+from telethon.tl.types import (Document, DocumentAttributeSticker, InputStickerSetID,
+                               InputStickerSetShortName, TypeInputStickerSet)
+from telethon.errors import RPCError
+
+from mautrix.appservice import IntentAPI
+from mautrix.util.opt_prometheus import Counter
+
+from ..tgclient import MautrixTelegramClient
+from ..db import TelegramFile as DBTelegramFile
+from .file_transfer import transfer_file_to_matrix, _location_to_id
+from . import tgs_converter
+
+if TYPE_CHECKING:
+    from ..config import Config
+
+log: logging.Logger = logging.getLogger("mau.util.sticker_prewarm")
+
+PREWARMED_SETS = Counter("bridge_sticker_prewarm_sets", "Number of sticker sets pre-warmed")
+PREWARMED_STICKERS = Counter("bridge_sticker_prewarm_stickers",
+                             "Number of stickers transferred ahead of time by pre-warming")
+PREWARMED_BYTES = Counter("bridge_sticker_prewarm_bytes",
+                          "Bytes of stickers downloaded from Telegram by pre-warming")
+PREWARM_SKIPPED = Counter("bridge_sticker_prewarm_skipped",
+                          "Number of sticker sets that weren't pre-warmed", ("reason",))
+
+# Only stickers that are bridged as-is or converted from lottie are pre-warmed, video stickers
+# would need their thumbnails too
+PREWARM_MIME_TYPES = ("application/x-tgsticker", "image/webp")
+QUEUE_SIZE = 16
+# Sticker sets aren't pre-warmed again for this many seconds
+RECENT_TIMEOUT = 24 * 60 * 60
+
+PrewarmJob = NamedTuple("PrewarmJob", client=MautrixTelegramClient, intent=IntentAPI,
+                        stickerset=TypeInputStickerSet, encrypt=bool)
+
+enabled: bool = False
+max_sets_per_hour: int = 10
+max_bytes_per_day: int = 100 * 1024 * 1024
+tgs_convert: Optional[dict] = None
+
+_queue: Optional['asyncio.Queue[PrewarmJob]'] = None
+_worker: Optional[asyncio.Task] = None
+_recent: 'OrderedDict[Union[int, str], float]' = OrderedDict()
+_set_times: Deque[float] = deque()
+_byte_log: Deque[Tuple[float, int]] = deque()
+
+
+def _set_key(stickerset: TypeInputStickerSet) -> Optional[Union[int, str]]:
+    if isinstance(stickerset, InputStickerSetID):
+        return stickerset.id
+    elif isinstance(stickerset, InputStickerSetShortName):
+        return stickerset.short_name.lower()
+    return None
+
+
+def _bytes_today() -> int:
+    deadline = time.monotonic() - 24 * 60 * 60
+    while _byte_log and _byte_log[0][0] < deadline:
+        _byte_log.popleft()
+    return sum(size for _, size in _byte_log)
+
+
+def _forget_old_sets(now: float) -> None:
+    # The sets are in the order they were last scheduled, so the old ones are at the start
+    while _recent and next(iter(_recent.values())) <= now - RECENT_TIMEOUT:
+        _recent.popitem(last=False)
+
+
+def _take_set_budget() -> bool:
+    deadline = time.monotonic() - 60 * 60
+    while _set_times and _set_times[0] < deadline:
+        _set_times.popleft()
+    if len(_set_times) >= max_sets_per_hour:
+        return False
+    _set_times.append(time.monotonic())
+    return True
+
+
+def schedule(client: MautrixTelegramClient, intent: IntentAPI, document: Document,
+             encrypt: bool) -> None:
+    """Queue the sticker set of a bridged sticker for converting and uploading in the background.
+
+    The other stickers in the set are then already in the telegram_file table when they're
+    sent, so they're bridged without downloading or converting anything.
+    """
+    global _queue, _worker
+    if not enabled:
+        return
+    stickerset = next((attr.stickerset for attr in document.attributes
+                       if isinstance(attr, DocumentAttributeSticker)), None)
+    key = _set_key(stickerset)
+    if key is None:
+        return
+    now = time.monotonic()
+    _forget_old_sets(now)
+    if key in _recent:
+        return
+    if not _queue:
+        _queue = asyncio.Queue(QUEUE_SIZE)
+    try:
+        _queue.put_nowait(PrewarmJob(client, intent, stickerset, encrypt))
+    except asyncio.QueueFull:
+        PREWARM_SKIPPED.labels(reason="queue_full").inc()
+        return
+    _recent[key] = now
+    if not _worker or _worker.done():
+        _worker = asyncio.ensure_future(_work())
+
+
+async def _work() -> None:
+    while not _queue.empty():
+        job = _queue.get_nowait()
+        try:
+            await _prewarm(job)
+        except Exception:
+            log.exception(f"Failed to pre-warm sticker set {_set_key(job.stickerset)}")
+
+
+async def _wait_for_idle_converters() -> None:
+    # Pre-warming is low priority, so stay out of the way of stickers that are actually sent
+    while tgs_converter.is_busy():
+        await asyncio.sleep(1)
+
+
+async def _prewarm(job: PrewarmJob) -> None:
+    key = _set_key(job.stickerset)
+    if _bytes_today() >= max_bytes_per_day:
+        PREWARM_SKIPPED.labels(reason="bytes_per_day").inc()
+        return
+    elif not _take_set_budget():
+        PREWARM_SKIPPED.labels(reason="sets_per_hour").inc()
+        return
+    try:
+        sticker_set = await job.client(GetStickerSetRequest(job.stickerset))
+    except RPCError as e:
+        log.debug(f"Failed to get sticker set {key} for pre-warming: {e}")
+        return
+    PREWARMED_SETS.inc()
+    transferred = 0
+    for document in sticker_set.documents:
+        if document.mime_type not in PREWARM_MIME_TYPES:
+            continue
+        elif await DBTelegramFile.get(_location_to_id(document)):
+            continue
+        elif _bytes_today() + document.size > max_bytes_per_day:
+            log.debug(f"Stopping pre-warm of sticker set {key}: daily byte budget used up")
+            PREWARM_SKIPPED.labels(reason="bytes_per_day").inc()
+            break
+        await _wait_for_idle_converters()
+        _byte_log.append((time.monotonic(), document.size))
+        PREWARMED_BYTES.inc(document.size)
+        await transfer_file_to_matrix(job.client, job.intent, document, is_sticker=True,
+                                      tgs_convert=tgs_convert, encrypt=job.encrypt)
+        PREWARMED_STICKERS.inc()
+        transferred += 1
+    log.debug(f"Pre-warmed {transferred} stickers of sticker set {key}")
+
+
+def init(cfg: 'Config') -> None:
+    global enabled, max_sets_per_hour, max_bytes_per_day, tgs_convert
+    enabled = cfg["bridge.sticker_prewarm.enabled"]
+    max_sets_per_hour = cfg["bridge.sticker_prewarm.max_sets_per_hour"]
+    max_bytes_per_day = cfg["bridge.sticker_prewarm.max_bytes_per_day"] * 1024 * 1024
+    tgs_convert = cfg["bridge.animated_sticker"]
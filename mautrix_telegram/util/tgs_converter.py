@@ -14,17 +14,51 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Callable, Awaitable, Optional, Tuple, Any
+from typing import Dict, Callable, Awaitable, Optional, Tuple, Any, TYPE_CHECKING
 import asyncio.subprocess
+import hashlib
+import gzip
 import logging
 import shutil
+import time
 import os.path
 import tempfile
 
 from attr import dataclass
 
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+
+try:
+    from rlottie_python import LottieAnimation
+except ImportError:
+    LottieAnimation = None
+
+if TYPE_CHECKING:
+    from ..config import Config
+
 log: logging.Logger = logging.getLogger("mau.util.tgs")
 
+QUEUED_CONVERSIONS = Gauge("bridge_sticker_conversion_queue_length",
+                           "Number of animated sticker conversions waiting for a free slot")
+RUNNING_CONVERSIONS = Gauge("bridge_sticker_conversion_running",
+                            "Number of animated sticker conversions running")
+CONVERSION_TIME = Histogram("bridge_sticker_conversion_time",
+                            "Time spent converting animated stickers", ("target",))
+CONVERSION_TIMEOUTS = Counter("bridge_sticker_conversion_timeouts",
+                              "Number of converter processes that were killed for taking too "
+                              "long", ("program",))
+COALESCED_CONVERSIONS = Counter("bridge_sticker_conversion_coalesced",
+                                "Number of animated sticker conversions that shared the result "
+                                "of an identical conversion in progress")
+
+# Maximum number of conversions to run at the same time
+max_parallel: int = 4
+# Number of seconds after which a converter process is killed
+timeout: float = 60
+
+_slots: Optional[asyncio.Semaphore] = None
+_in_flight: Dict[Tuple[bytes, str, int, int, str], 'asyncio.Future[ConvertedSticker]'] = {}
+
 
 @dataclass
 class ConvertedSticker:
@@ -48,34 +82,51 @@ def abswhich(program: Optional[str]) -> Optional[str]:
 lottieconverter = abswhich("lottieconverter")
 ffmpeg = abswhich("ffmpeg")
 
+
+async def _run(program: str, *args: str, stdin: Optional[bytes] = None
+               ) -> Tuple[int, bytes, bytes]:
+    proc = await asyncio.create_subprocess_exec(program, *args,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                stdin=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(stdin), timeout)
+    except BaseException as e:
+        if isinstance(e, asyncio.TimeoutError):
+            name = os.path.basename(program)
+            log.warning(f"{name} took longer than {timeout} seconds, killing it")
+            CONVERSION_TIMEOUTS.labels(program=name).inc()
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout, stderr
+
+
+def _error(program: str, returncode: int, stderr: Optional[bytes]) -> str:
+    return (f"{program} error: " + (stderr.decode("utf-8") if stderr
+                                     else f"unknown ({returncode})"))
+
+
 if lottieconverter:
     async def tgs_to_png(file: bytes, width: int, height: int, **_: Any) -> ConvertedSticker:
         frame = 1
-        proc = await asyncio.create_subprocess_exec(lottieconverter, "-", "-", "png",
-                                                    f"{width}x{height}", str(frame),
-                                                    stdout=asyncio.subprocess.PIPE,
-                                                    stdin=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate(file)
-        if proc.returncode == 0:
+        returncode, stdout, stderr = await _run(lottieconverter, "-", "-", "png",
+                                                f"{width}x{height}", str(frame), stdin=file)
+        if returncode == 0:
             return ConvertedSticker("image/png", stdout)
         else:
-            log.error("lottieconverter error: " + (stderr.decode("utf-8") if stderr is not None
-                                                   else f"unknown ({proc.returncode})"))
+            log.error(_error("lottieconverter", returncode, stderr))
             return ConvertedSticker("application/gzip", file)
 
 
     async def tgs_to_gif(file: bytes, width: int, height: int, fps: int = 25,
                          **_: Any) -> ConvertedSticker:
-        proc = await asyncio.create_subprocess_exec(lottieconverter, "-", "-", "gif",
-                                                    f"{width}x{height}", str(fps),
-                                                    stdout=asyncio.subprocess.PIPE,
-                                                    stdin=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate(file)
-        if proc.returncode == 0:
+        returncode, stdout, stderr = await _run(lottieconverter, "-", "-", "gif",
+                                                f"{width}x{height}", str(fps), stdin=file)
+        if returncode == 0:
             return ConvertedSticker("image/gif", stdout)
         else:
-            log.error("lottieconverter error: " + (stderr.decode("utf-8") if stderr is not None
-                                                   else f"unknown ({proc.returncode})"))
+            log.error(_error("lottieconverter", returncode, stderr))
             return ConvertedSticker("application/gzip", file)
 
 
@@ -87,45 +138,158 @@ if lottieconverter and ffmpeg:
                           **_: Any) -> ConvertedSticker:
         with tempfile.TemporaryDirectory(prefix="tgs_") as tmpdir:
             file_template = tmpdir + "/out_"
-            proc = await asyncio.create_subprocess_exec(lottieconverter, "-", file_template,
-                                                        "pngs", f"{width}x{height}", str(fps),
-                                                        stdout=asyncio.subprocess.PIPE,
-                                                        stdin=asyncio.subprocess.PIPE)
-            _, stderr = await proc.communicate(file)
-            if proc.returncode == 0:
+            returncode, _, stderr = await _run(lottieconverter, "-", file_template, "pngs",
+                                               f"{width}x{height}", str(fps), stdin=file)
+            if returncode == 0:
                 with open(f"{file_template}00.png", "rb") as first_frame_file:
                     first_frame_data = first_frame_file.read()
-                proc = await asyncio.create_subprocess_exec(ffmpeg, "-hide_banner", "-loglevel",
-                                                            "error", "-framerate", str(fps),
-                                                            "-pattern_type", "glob", "-i",
-                                                            file_template + "*.png",
-                                                            "-c:v", "libvpx-vp9", "-pix_fmt",
-                                                            "yuva420p", "-f", "webm", "-",
-                                                            stdout=asyncio.subprocess.PIPE,
-                                                            stdin=asyncio.subprocess.PIPE)
-                stdout, stderr = await proc.communicate()
-                if proc.returncode == 0:
+                returncode, stdout, stderr = await _run(ffmpeg, "-hide_banner", "-loglevel",
+                                                        "error", "-framerate", str(fps),
+                                                        "-pattern_type", "glob", "-i",
+                                                        file_template + "*.png",
+                                                        "-c:v", "libvpx-vp9", "-pix_fmt",
+                                                        "yuva420p", "-f", "webm", "-")
+                if returncode == 0:
                     return ConvertedSticker("video/webm", stdout, "image/png", first_frame_data)
                 else:
-                    log.error("ffmpeg error: " + (stderr.decode("utf-8") if stderr is not None
-                                                  else f"unknown ({proc.returncode})"))
+                    log.error(_error("ffmpeg", returncode, stderr))
             else:
-                log.error("lottieconverter error: " + (stderr.decode("utf-8") if stderr is not None
-                                                       else f"unknown ({proc.returncode})"))
+                log.error(_error("lottieconverter", returncode, stderr))
         return ConvertedSticker("application/gzip", file)
 
 
     converters["webm"] = tgs_to_webm
 
+if LottieAnimation and ffmpeg:
+    def _render_frames(file: bytes, fd: int, width: int, height: int, fps: int) -> None:
+        # This runs in a thread and writes to the pipe directly, so that the animation can't be
+        # destroyed while a frame is being rendered. rlottie doesn't hold the GIL while
+        # rendering, and ffmpeg encodes the previous frame in the meantime.
+        with open(fd, "wb") as pipe:
+            animation = LottieAnimation.from_data(gzip.decompress(file).decode("utf-8"))
+            try:
+                # Same frame selection as lottieconverter
+                frame_count = max(1, round(animation.lottie_animation_get_duration() * fps))
+                for i in range(frame_count):
+                    frame = animation.lottie_animation_get_frame_at_pos(i / frame_count)
+                    pipe.write(animation.lottie_animation_render(frame, None, width, height))
+            finally:
+                animation.lottie_animation_destroy()
+
+
+    def _read_fd(fd: int) -> bytes:
+        with open(fd, "rb") as file:
+            return file.read()
+
+
+    async def tgs_to_webm_pipe(file: bytes, width: int, height: int, fps: int = 30,
+                               **_: Any) -> ConvertedSticker:
+        loop = asyncio.get_event_loop()
+        # Frames are piped into ffmpeg as raw premultiplied BGRA, and ffmpeg writes the first
+        # frame to a second pipe as a PNG for the thumbnail, so nothing touches the disk.
+        frames_read, frames_write = os.pipe()
+        thumbnail_read, thumbnail_write = os.pipe()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                ffmpeg, "-hide_banner", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgra", "-s", f"{width}x{height}",
+                "-framerate", str(fps), "-i", "pipe:0",
+                "-filter_complex", "[0:v]unpremultiply=inplace=1,split[webm][thumbnail]",
+                "-map", "[webm]", "-c:v", "libvpx-vp9", "-pix_fmt", "yuva420p", "-f", "webm",
+                "pipe:1",
+                "-map", "[thumbnail]", "-frames:v", "1", "-c:v", "png", "-f", "image2pipe",
+                f"pipe:{thumbnail_write}",
+                stdin=frames_read, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, pass_fds=(thumbnail_write,))
+        except BaseException:
+            os.close(frames_write)
+            os.close(thumbnail_read)
+            raise
+        finally:
+            os.close(frames_read)
+            os.close(thumbnail_write)
+        render = loop.run_in_executor(None, _render_frames, file, frames_write, width, height,
+                                      fps)
+        thumbnail = loop.run_in_executor(None, _read_fd, thumbnail_read)
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                asyncio.gather(proc.stdout.read(), proc.stderr.read()), timeout)
+            await proc.wait()
+        except BaseException as e:
+            if isinstance(e, asyncio.TimeoutError):
+                log.warning(f"ffmpeg took longer than {timeout} seconds, killing it")
+                CONVERSION_TIMEOUTS.labels(program="ffmpeg").inc()
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            # Both threads finish as soon as ffmpeg has closed its ends of the pipes
+            render_error, thumbnail_data = await asyncio.gather(render, thumbnail,
+                                                                return_exceptions=True)
+        if render_error and not isinstance(render_error, BrokenPipeError):
+            log.error("Failed to render animated sticker", exc_info=render_error)
+        elif proc.returncode != 0:
+            log.error(_error("ffmpeg", proc.returncode, stderr))
+        elif isinstance(thumbnail_data, bytes):
+            return ConvertedSticker("video/webm", stdout, "image/png", thumbnail_data or None)
+        return ConvertedSticker("application/gzip", file)
+
+
+    converters["webm"] = tgs_to_webm_pipe
+
+
+async def _convert(file: bytes, convert_to: str, width: int, height: int, **kwargs: Any
+                   ) -> ConvertedSticker:
+    global _slots
+    if not _slots:
+        _slots = asyncio.Semaphore(max_parallel)
+    QUEUED_CONVERSIONS.inc()
+    try:
+        await _slots.acquire()
+    finally:
+        QUEUED_CONVERSIONS.dec()
+    RUNNING_CONVERSIONS.inc()
+    start = time.monotonic()
+    try:
+        converted = await converters[convert_to](file, width, height, **kwargs)
+    except asyncio.TimeoutError:
+        converted = ConvertedSticker("application/gzip", file)
+    finally:
+        CONVERSION_TIME.labels(target=convert_to).observe(time.monotonic() - start)
+        RUNNING_CONVERSIONS.dec()
+        _slots.release()
+    converted.width = width
+    converted.height = height
+    return converted
+
+
+def is_busy() -> bool:
+    return bool(_slots and _slots.locked())
+
 
 async def convert_tgs_to(file: bytes, convert_to: str, width: int, height: int, **kwargs: Any
                          ) -> ConvertedSticker:
     if convert_to in converters:
-        converter = converters[convert_to]
-        converted = await converter(file, width, height, **kwargs)
-        converted.width = width
-        converted.height = height
-        return converted
+        # Identical conversions that are requested at the same time, e.g. when the same sticker
+        # is sent to many chats, share the result of one converter process.
+        key = (hashlib.sha256(file).digest(), convert_to, width, height,
+               repr(sorted(kwargs.items())))
+        try:
+            conversion = _in_flight[key]
+            COALESCED_CONVERSIONS.inc()
+        except KeyError:
+            conversion = _in_flight[key] = asyncio.ensure_future(
+                _convert(file, convert_to, width, height, **kwargs))
+            conversion.add_done_callback(lambda _: _in_flight.pop(key, None))
+        # The conversion is shared, so one caller being cancelled mustn't cancel it
+        return await asyncio.shield(conversion)
     elif convert_to != "disable":
         log.warning(f"Unable to convert animated sticker, type {convert_to} not supported")
     return ConvertedSticker("application/gzip", file)
+
+
+def init(cfg: 'Config') -> None:
+    global max_parallel, timeout, _slots
+    max_parallel = cfg["bridge.sticker_conversion.max_parallel"]
+    timeout = cfg["bridge.sticker_conversion.timeout"]
+    _slots = None
@@ -0,0 +1,183 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncIterator, List
+from collections import Counter
+from contextlib import asynccontextmanager
+import itertools
+import asyncio
+import logging
+import time
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Gauge, Histogram
+
+QUEUED_TRANSFERS = Gauge("bridge_transfer_queue_length",
+                         "Number of parallel file transfers waiting for connections")
+ACTIVE_CONNECTIONS = Gauge("bridge_transfer_connections",
+                           "Number of connections reserved for parallel file transfers", ("dc",))
+BYTES_IN_FLIGHT = Gauge("bridge_transfer_bytes_in_flight",
+                        "Maximum number of file part bytes in flight for parallel file transfers")
+QUEUE_WAIT_TIME = Histogram("bridge_transfer_queue_wait_time",
+                            "Time parallel file transfers spent waiting for connections")
+
+
+class _Job:
+    user_id: int
+    dc_id: int
+    size: int
+    connections: int
+    part_size: int
+    seq: int
+    future: 'asyncio.Future[int]'
+
+    def __init__(self, user_id: int, dc_id: int, size: int, connections: int, part_size: int,
+                 seq: int) -> None:
+        self.user_id = user_id
+        self.dc_id = dc_id
+        self.size = size
+        self.connections = connections
+        self.part_size = part_size
+        self.seq = seq
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class TransferScheduler:
+    """Shares the Telegram connections of parallel file transfers between all users.
+
+    Transfers wait in a queue until connections are free in all budgets: total, per DC and per
+    user, and the parts that the connections have in flight fit in the byte budget. Waiting
+    transfers are admitted starting from the user with the fewest reserved connections, and
+    within that, the smallest file, so that stickers and thumbnails don't wait behind big
+    documents. A transfer gets fewer connections than it asked for if the budgets are tight, and
+    transfers that want more than one connection never take the last one in the user's budget
+    unless the budget only has one.
+    """
+    log: TraceLogger = logging.getLogger("mau.transfer_scheduler")
+
+    max_connections: int
+    max_connections_per_dc: int
+    max_connections_per_user: int
+    max_connections_per_transfer: int
+    max_bytes_in_flight: int
+
+    _waiting: List[_Job]
+    _seq: 'itertools.count[int]'
+    _total: int
+    _bytes: int
+    _per_dc: 'Counter[int]'
+    _per_user: 'Counter[int]'
+
+    def __init__(self, max_connections: int = 40, max_connections_per_dc: int = 20,
+                 max_connections_per_user: int = 20, max_connections_per_transfer: int = 10,
+                 max_bytes_in_flight: int = 32 * 1024 * 1024) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_dc = max_connections_per_dc
+        self.max_connections_per_user = max_connections_per_user
+        self.max_connections_per_transfer = max_connections_per_transfer
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self._waiting = []
+        self._seq = itertools.count()
+        self._total = 0
+        self._bytes = 0
+        self._per_dc = Counter()
+        self._per_user = Counter()
+
+    def _available(self, job: _Job) -> int:
+        user_free = self.max_connections_per_user - self._per_user[job.user_id]
+        if job.connections > 1 and self.max_connections_per_user > 1:
+            # Keep a connection free for the small files of the same user
+            user_free -= 1
+        shared_free = min(self.max_connections - self._total,
+                          self.max_connections_per_dc - self._per_dc[job.dc_id],
+                          (self.max_bytes_in_flight - self._bytes) // job.part_size)
+        count = min(job.connections, self.max_connections_per_transfer, shared_free, user_free)
+        if count < 1 and (self._total == 0
+                          or (self._per_user[job.user_id] == 0 and shared_free > 0)):
+            # Nothing is running, or nothing is running for the user and there's room in the
+            # shared budgets, so let the transfer through even if it's bigger than a budget
+            return 1
+        return count
+
+    def _dispatch(self) -> None:
+        # Cancelled transfers only leave the queue when their task runs again, which may be
+        # after this
+        self._waiting = [job for job in self._waiting if not job.future.done()]
+        while self._waiting:
+            candidates = [job for job in self._waiting if self._available(job) > 0]
+            if not candidates:
+                break
+            job = min(candidates, key=lambda c: (self._per_user[c.user_id], c.size, c.seq))
+            self._waiting.remove(job)
+            self._acquire(job, self._available(job))
+            job.future.set_result(job.connections)
+        QUEUED_TRANSFERS.set(len(self._waiting))
+
+    def _acquire(self, job: _Job, connections: int) -> None:
+        job.connections = connections
+        self._total += connections
+        self._bytes += connections * job.part_size
+        self._per_dc[job.dc_id] += connections
+        self._per_user[job.user_id] += connections
+        ACTIVE_CONNECTIONS.labels(dc=job.dc_id).set(self._per_dc[job.dc_id])
+        BYTES_IN_FLIGHT.set(self._bytes)
+
+    def _release(self, job: _Job) -> None:
+        self._total -= job.connections
+        self._bytes -= job.connections * job.part_size
+        self._per_dc[job.dc_id] -= job.connections
+        self._per_user[job.user_id] -= job.connections
+        if self._per_user[job.user_id] <= 0:
+            del self._per_user[job.user_id]
+        ACTIVE_CONNECTIONS.labels(dc=job.dc_id).set(self._per_dc[job.dc_id])
+        BYTES_IN_FLIGHT.set(self._bytes)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def reserve(self, user_id: int, dc_id: int, size: int, connections: int,
+                      part_size: int) -> AsyncIterator[int]:
+        """Wait until the transfer can start and reserve connections for it.
+
+        Args:
+            user_id: The Telegram user whose client is used for the transfer.
+            dc_id: The DC that the transfer connects to.
+            size: The size of the file in bytes.
+            connections: The number of connections the transfer would like to use.
+            part_size: The size of a single file part in bytes.
+
+        Returns:
+            The number of connections the transfer may open, between 1 and ``connections``.
+        """
+        job = _Job(user_id, dc_id, size, max(connections, 1), part_size, next(self._seq))
+        self._waiting.append(job)
+        self._dispatch()
+        start = time.monotonic()
+        try:
+            granted = await job.future
+        except asyncio.CancelledError:
+            if job in self._waiting:
+                self._waiting.remove(job)
+                QUEUED_TRANSFERS.set(len(self._waiting))
+            elif job.future.done() and not job.future.cancelled():
+                self._release(job)
+            raise
+        QUEUE_WAIT_TIME.observe(time.monotonic() - start)
+        if granted < connections:
+            self.log.debug(f"Parallel transfer of {size} bytes to DC {dc_id} got {granted} "
+                           f"connections instead of {connections}")
+        try:
+            yield granted
+        finally:
+            self._release(job)
@@ -0,0 +1,295 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import threading
+import hashlib
+import asyncio
+import logging
+import json
+import time
+import os
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+SPOOL_SIZE = Gauge("bridge_transfer_spool_bytes", "Disk space reserved by spooled file transfers")
+RESUMED_PARTS = Counter("bridge_transfer_resumed_parts",
+                        "File parts that didn't have to be transferred again thanks to the spool")
+
+# Minimum number of seconds between checkpoint writes while parts are being transferred. Parts
+# finished after the last checkpoint are transferred again if the bridge crashes.
+CHECKPOINT_INTERVAL = 2
+
+
+class SpooledTransfer:
+    """The on-disk state of a single resumable transfer.
+
+    The file data is stored in a sparse file of the full size. The checkpoint next to it records
+    which parts of the data are on disk and which parts have been finished, e.g. sent to
+    Telegram, so that a retry or a restarted bridge can skip them.
+    """
+    spool: 'TransferSpool'
+    key: str
+    size: int
+    part_size: int
+    part_count: int
+    file_id: Optional[int]
+    stored: bytearray
+    done: bytearray
+    _lock: threading.Lock
+    _saved_at: float
+
+    def __init__(self, spool: 'TransferSpool', key: str, size: int, part_size: int,
+                 file_id: Optional[int] = None) -> None:
+        self.spool = spool
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.part_count = (size + part_size - 1) // part_size
+        self.file_id = file_id
+        self.stored = bytearray((self.part_count + 7) // 8)
+        self.done = bytearray((self.part_count + 7) // 8)
+        # Parts are written and marked as done from different executor threads
+        self._lock = threading.Lock()
+        self._saved_at = 0
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.spool.directory, f"{self.key}.data")
+
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.spool.directory, f"{self.key}.json")
+
+    @staticmethod
+    def _get(bitmap: bytearray, part: int) -> bool:
+        return bool(bitmap[part // 8] & (1 << (part % 8)))
+
+    @staticmethod
+    def _set(bitmap: bytearray, part: int) -> None:
+        bitmap[part // 8] |= 1 << (part % 8)
+
+    def is_stored(self, part: int) -> bool:
+        return self._get(self.stored, part)
+
+    def is_done(self, part: int) -> bool:
+        return self._get(self.done, part)
+
+    def missing_parts(self) -> List[int]:
+        return [part for part in range(self.part_count) if not self.is_stored(part)]
+
+    def _load(self) -> bool:
+        try:
+            with open(self.checkpoint_path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if data["size"] != self.size or data["part_size"] != self.part_size:
+            return False
+        self.file_id = data.get("file_id")
+        self.stored = bytearray.fromhex(data["stored"])
+        self.done = bytearray.fromhex(data["done"])
+        resumed = sum(self.is_stored(part) for part in range(self.part_count))
+        RESUMED_PARTS.inc(resumed)
+        self.spool.log.debug(f"Resuming spooled transfer {self.key} with {resumed}/"
+                             f"{self.part_count} parts on disk")
+        return True
+
+    def _open(self) -> None:
+        os.makedirs(self.spool.directory, exist_ok=True)
+        if not self._load():
+            with open(self.data_path, "wb") as file:
+                file.truncate(self.size)
+            self._save()
+
+    def _save(self) -> None:
+        # The parts must be on disk before a checkpoint that says they are
+        with open(self.data_path, "rb") as file:
+            os.fsync(file.fileno())
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"size": self.size, "part_size": self.part_size, "file_id": self.file_id,
+                       "stored": self.stored.hex(), "done": self.done.hex()}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self._saved_at = time.monotonic()
+
+    def _checkpoint(self, force: bool = False) -> None:
+        # Called with the lock held, so the bitmaps don't change while they're being saved
+        if force or time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL:
+            self._save()
+
+    def save(self) -> None:
+        """Write the checkpoint now, e.g. when the transfer is interrupted."""
+        with self._lock:
+            self._checkpoint(force=True)
+
+    def _write_part(self, part: int, data: Union[bytes, memoryview]) -> None:
+        with open(self.data_path, "r+b") as file:
+            file.seek(part * self.part_size)
+            file.write(data)
+        with self._lock:
+            self._set(self.stored, part)
+            self._checkpoint()
+
+    def _read_part(self, part: int) -> bytes:
+        with open(self.data_path, "rb") as file:
+            file.seek(part * self.part_size)
+            return file.read(self.part_size)
+
+    def _mark_done(self, part: int) -> None:
+        with self._lock:
+            self._set(self.done, part)
+            self._checkpoint()
+
+    async def write_part(self, part: int, data: Union[bytes, memoryview]) -> None:
+        await self.spool.loop.run_in_executor(None, self._write_part, part, data)
+
+    async def read_part(self, part: int) -> bytes:
+        return await self.spool.loop.run_in_executor(None, self._read_part, part)
+
+    async def mark_done(self, part: int) -> None:
+        await self.spool.loop.run_in_executor(None, self._mark_done, part)
+
+    async def remove(self) -> None:
+        await self.spool.remove(self)
+
+
+class TransferSpool:
+    """A directory of resumable file transfers with a disk usage cap.
+
+    Entries are removed when their transfer finishes. Interrupted entries are kept for
+    :attr:`max_age` seconds so that the transfer can resume, and the oldest inactive entries
+    are removed early if new transfers need the space.
+    """
+    log: TraceLogger = logging.getLogger("mau.transfer_spool")
+
+    directory: str
+    max_size: int
+    max_age: int
+    loop: asyncio.AbstractEventLoop
+
+    _active: Dict[str, Optional[SpooledTransfer]]
+
+    def __init__(self, directory: str, max_size: int, max_age: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.loop = asyncio.get_event_loop()
+        self._active = {}
+
+    @staticmethod
+    def make_key(kind: str, identifier: str) -> str:
+        return f"{kind}-{hashlib.sha256(identifier.encode('utf-8')).hexdigest()[:32]}"
+
+    def _entries(self) -> Iterator[Tuple[str, float, int]]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(".data"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            yield name[:-len(".data")], stat.st_mtime, stat.st_size
+
+    def _delete(self, key: str) -> None:
+        for ext in ("data", "json", "json.tmp"):
+            try:
+                os.remove(os.path.join(self.directory, f"{key}.{ext}"))
+            except FileNotFoundError:
+                pass
+
+    def cleanup(self, reserve: int = 0, keep: Optional[str] = None) -> bool:
+        """Remove expired entries and free up space for a new transfer.
+
+        Args:
+            reserve: The number of bytes the new transfer needs.
+            keep: The key of an entry that must not be removed.
+
+        Returns:
+            Whether there's enough space for the new transfer.
+        """
+        now = time.time()
+        usage = 0
+        inactive = []
+        for key, mtime, size in self._entries():
+            if key in self._active or key == keep:
+                usage += size
+            elif now - mtime > self.max_age:
+                self.log.debug(f"Removing expired spooled transfer {key}")
+                self._delete(key)
+            else:
+                usage += size
+                inactive.append((mtime, key, size))
+        inactive.sort()
+        while usage + reserve > self.max_size and inactive:
+            _, key, size = inactive.pop(0)
+            self.log.debug(f"Removing spooled transfer {key} to free up space")
+            self._delete(key)
+            usage -= size
+        SPOOL_SIZE.set(usage)
+        return usage + reserve <= self.max_size
+
+    def _open(self, key: str, size: int, part_size: int, file_id: Optional[int]
+              ) -> Optional[SpooledTransfer]:
+        exists = os.path.exists(os.path.join(self.directory, f"{key}.data"))
+        if not self.cleanup(0 if exists else size, keep=key):
+            self.log.debug(f"Not spooling {key}: no space for {size} more bytes")
+            return None
+        transfer = SpooledTransfer(self, key, size, part_size, file_id)
+        transfer._open()
+        return transfer
+
+    async def open(self, key: str, size: int, part_size: int, file_id: Optional[int] = None
+                   ) -> Optional[SpooledTransfer]:
+        if key in self._active:
+            # Another transfer of the same file is running, so don't touch its state
+            return None
+        self._active[key] = None
+        try:
+            transfer = await self.loop.run_in_executor(None, self._open, key, size, part_size,
+                                                       file_id)
+        except OSError:
+            self.log.warning(f"Failed to open spooled transfer {key}", exc_info=True)
+            transfer = None
+        if transfer:
+            self._active[key] = transfer
+        else:
+            del self._active[key]
+        return transfer
+
+    async def release(self, transfer: SpooledTransfer) -> None:
+        """Keep the spooled data for resuming later, but let cleanup remove it when it expires."""
+        try:
+            await self.loop.run_in_executor(None, transfer.save)
+        except OSError:
+            self.log.warning(f"Failed to save checkpoint of spooled transfer {transfer.key}",
+                             exc_info=True)
+        finally:
+            self._active.pop(transfer.key, None)
+
+    async def remove(self, transfer: SpooledTransfer) -> None:
+        try:
+            await self.loop.run_in_executor(None, self._delete, transfer.key)
+        finally:
+            # Only after deleting, so that a new transfer of the same file doesn't resume from
+            # the files that are being deleted
+            self._active.pop(transfer.key, None)
@@ -0,0 +1,185 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Iterable, List, Optional, Tuple
+import asyncio.subprocess
+import tempfile
+import logging
+import struct
+
+from mautrix.util.opt_prometheus import Counter
+
+from .tgs_converter import abswhich
+from . import process_pool
+
+try:
+    import imageio_ffmpeg
+except ImportError:
+    imageio_ffmpeg = None
+
+log: logging.Logger = logging.getLogger("mau.util.video_thumbnail")
+
+THUMBNAIL_INPUT_BYTES = Counter("bridge_video_thumbnail_input_bytes",
+                                "Bytes of video passed to ffmpeg for extracting thumbnails")
+THUMBNAIL_FILE_FALLBACKS = Counter("bridge_video_thumbnail_file_fallbacks",
+                                   "Number of video thumbnails that couldn't be extracted from "
+                                   "the leading bytes and needed a temporary file")
+
+PIPE_CHUNK_SIZE = 64 * 1024
+
+
+def _find_ffmpeg() -> Optional[str]:
+    path = abswhich("ffmpeg")
+    if not path and imageio_ffmpeg:
+        try:
+            # The ffmpeg binary that moviepy used to extract thumbnails
+            path = imageio_ffmpeg.get_ffmpeg_exe()
+        except RuntimeError:
+            pass
+    return path
+
+
+ffmpeg = _find_ffmpeg()
+
+
+def _ffmpeg_args(source: str, max_size: Tuple[int, int]) -> List[str]:
+    max_width, max_height = max_size
+    # Only shrink the frame to fit in max_size, like PIL's Image.thumbnail
+    scale = (f"scale=w=min(iw\\,{max_width}):h=min(ih\\,{max_height})"
+             ":force_original_aspect_ratio=decrease")
+    return [ffmpeg, "-hide_banner", "-loglevel", "error", "-i", source, "-frames:v", "1",
+            "-vf", scale, "-c:v", "png", "-f", "image2pipe", "pipe:1"]
+
+
+def _png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 24 or data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def _index_at_end(head: bytes) -> bool:
+    # MP4 and MOV files can only be decoded from a pipe if the moov box with the index comes
+    # before the mdat box with the media data. Other containers are always streamable.
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[offset:offset + 8])
+        if box_type == b"moov":
+            return False
+        elif box_type == b"mdat":
+            return True
+        elif size == 1 and offset + 16 <= len(head):
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+async def _feed(stdin: asyncio.StreamWriter, video: Iterable[bytes]) -> int:
+    written = 0
+    try:
+        for chunk in video:
+            for offset in range(0, len(chunk), PIPE_CHUNK_SIZE):
+                stdin.write(chunk[offset:offset + PIPE_CHUNK_SIZE])
+                await stdin.drain()
+                written += min(PIPE_CHUNK_SIZE, len(chunk) - offset)
+        stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exits as soon as it has decoded the first frame
+        pass
+    return written
+
+
+async def _run_ffmpeg(source: str, video: Optional[Iterable[bytes]], max_size: Tuple[int, int]
+                      ) -> Optional[bytes]:
+    # ffmpeg shares the worker budget of the media process pool, so that a burst of videos
+    # doesn't start an ffmpeg process for each one
+    async with process_pool.slot("ffmpeg_thumbnail"):
+        return await _run_ffmpeg_process(source, video, max_size)
+
+
+async def _run_ffmpeg_process(source: str, video: Optional[Iterable[bytes]],
+                              max_size: Tuple[int, int]) -> Optional[bytes]:
+    proc = await asyncio.create_subprocess_exec(
+        *_ffmpeg_args(source, max_size), stdin=asyncio.subprocess.PIPE if video else None,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    feed = asyncio.ensure_future(_feed(proc.stdin, video)) if video else None
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            asyncio.gather(proc.stdout.read(), proc.stderr.read()), process_pool.timeout)
+        await proc.wait()
+        if feed:
+            THUMBNAIL_INPUT_BYTES.inc(await feed)
+    except BaseException as e:
+        # Also make sure ffmpeg doesn't outlive a cancelled transfer
+        if feed:
+            feed.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            log.warning(f"ffmpeg took longer than {process_pool.timeout} seconds to extract a "
+                        "video thumbnail")
+            process_pool.JOB_TIMEOUTS.labels(job="ffmpeg_thumbnail").inc()
+            return None
+        raise
+    if proc.returncode != 0 or not stdout:
+        log.debug(f"ffmpeg failed to extract thumbnail from {source}: "
+                  f"{stderr.decode('utf-8', 'replace').strip()}")
+        return None
+    return stdout
+
+
+async def _extract_from_file(video: List[bytes], video_ext: str, max_size: Tuple[int, int]
+                             ) -> Optional[bytes]:
+    loop = asyncio.get_event_loop()
+    with tempfile.NamedTemporaryFile(prefix="mxtg_video_", suffix=f".{video_ext}") as file:
+        await loop.run_in_executor(None, file.writelines, video)
+        await loop.run_in_executor(None, file.flush)
+        return await _run_ffmpeg(file.name, None, max_size)
+
+
+async def extract_thumbnail(video: List[bytes], complete: bool = True, video_ext: str = "mp4",
+                            max_size: Tuple[int, int] = (1024, 720)
+                            ) -> Optional[Tuple[bytes, int, int]]:
+    """Extract the first frame of a video as a PNG.
+
+    The video is piped into ffmpeg, which stops reading as soon as it has the first frame, so
+    usually only the leading bytes are needed. Containers that can't be decoded from a pipe,
+    like MP4s with the index at the end, are written to a temporary file instead if the whole
+    video is available.
+
+    Args:
+        video: The chunks of the video, or the leading chunks if ``complete`` is false.
+        complete: Whether ``video`` contains the whole file.
+        video_ext: The file extension of the video for the temporary file.
+        max_size: The maximum width and height of the thumbnail.
+
+    Returns:
+        The PNG data, width and height, or ``None`` if the thumbnail couldn't be extracted.
+    """
+    if not ffmpeg or not video:
+        return None
+    data = None
+    if not _index_at_end(video[0]):
+        data = await _run_ffmpeg("pipe:0", video, max_size)
+    if not data and complete:
+        THUMBNAIL_FILE_FALLBACKS.inc()
+        data = await _extract_from_file(video, video_ext, max_size)
+    size = _png_size(data) if data else None
+    if not size:
+        return None
+    width, height = size
+    return data, width, height
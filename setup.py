@@ -35,6 +35,10 @@ setuptools.setup(
     packages=setuptools.find_packages(),
 
     install_requires=install_requires,
+    extras_require={
+        # Renders animated stickers in-process for the webm converter
+        "lottie": ["rlottie-python>=1.0,<2"],
+    },
     python_requires="~=3.7",
 
     setup_requires=["pytest-runner"],
@@ -0,0 +1,102 @@
+"""Measures per-update latency of the message mapping queries under concurrent portals.
+
+Every simulated update does what ``PortalTelegram.handle_telegram_message`` does with the
+database: a duplicate check, a reply lookup and a mapping insert. The event loop lag column shows
+how long other coroutines (i.e. other users' updates) were stalled while the queries ran.
+
+Usage: python -m tests.benchmarks.bench_db_latency [database URL] [portals] [updates per portal]
+"""
+from typing import Awaitable, Callable, List
+import statistics
+import asyncio
+import random
+import time
+import sys
+
+import sqlalchemy as sql
+
+from mautrix.util.db import Base
+
+from mautrix_telegram import db
+from mautrix_telegram.db import Message
+from mautrix_telegram.db.message_queue import MessageWriteQueue
+
+MODES = ("blocking", "executor", "batched")
+
+
+def _blocking(method: Callable, *bound_args) -> Callable[..., Awaitable]:
+    # Call the undecorated query directly on the event loop, like before the executor was added.
+    func = method.__wrapped__
+
+    async def wrapper(*args):
+        return func(*bound_args, *args)
+
+    return wrapper
+
+
+async def _handle_update(portal: int, msg_id: int, get_one: Callable[..., Awaitable],
+                         insert: Callable[..., Awaitable]) -> float:
+    start = time.perf_counter()
+    await get_one(msg_id, portal)
+    await get_one(max(msg_id - random.randint(1, 10), 0), portal)
+    await insert(Message(mxid=f"${portal}-{msg_id}:example.com", mx_room=f"!{portal}:example.com",
+                         tgid=msg_id, tg_space=portal, edit_index=0))
+    return time.perf_counter() - start
+
+
+async def _measure_lag(stop: asyncio.Event, lags: List[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def _run(mode: str, portals: int, updates: int) -> None:
+    if mode == "blocking":
+        get_one = _blocking(Message._get_one_by_tgid, Message)
+        insert = _blocking(Message._insert_now)
+    else:
+        get_one = Message.get_one_by_tgid
+        insert = Message.insert
+
+    async def portal_task(portal: int) -> List[float]:
+        return [await _handle_update(portal, msg_id, get_one, insert)
+                for msg_id in range(1, updates + 1)]
+
+    Message.write_queue = MessageWriteQueue(Message) if mode == "batched" else None
+    offset = MODES.index(mode) * portals
+    stop, lags = asyncio.Event(), []
+    lag_task = asyncio.ensure_future(_measure_lag(stop, lags))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(portal_task(offset + i) for i in range(portals)))
+    duration = time.perf_counter() - start
+    if Message.write_queue:
+        await Message.write_queue.stop()
+    stop.set()
+    await lag_task
+
+    latencies = sorted(latency for result in results for latency in result)
+    print(f"{mode:>9}: {len(latencies) / duration:8.1f} updates/s, "
+          f"median {statistics.median(latencies) * 1000:7.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms, "
+          f"max loop lag {max(lags, default=0) * 1000:7.2f} ms")
+
+
+def main() -> None:
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite:///mxtg-bench.db"
+    portals = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    updates = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    engine = sql.create_engine(url)
+    Base.metadata.drop_all(engine, tables=[Message.__table__])
+    Base.metadata.create_all(engine, tables=[Message.__table__])
+    db.init(engine)
+
+    print(f"{portals} concurrent portals, {updates} updates each, database {engine.dialect.name}")
+    loop = asyncio.get_event_loop()
+    for mode in MODES:
+        loop.run_until_complete(_run(mode, portals, updates))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Compares the dedup cache throughput of the old deque + md5 implementation and PortalDedup.
+
+Every simulated message is checked once by the first user who receives it and a few more
+times as duplicates received by other users, and then updated with the real event ID, like
+PortalTelegram.handle_telegram_message does in normal group chats.
+
+The old implementation scans the whole deque on every check, so it gets very slow with the
+largest queue length if the message count is raised above the default.
+
+Usage: python -m tests.benchmarks.bench_dedup [messages] [duplicates per message]
+"""
+from typing import Deque, Dict, List
+from collections import deque
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import hashlib
+import time
+import sys
+
+from telethon.tl.patched import Message
+from telethon.tl.types import PeerChat
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.portal.deduplication import PortalDedup
+
+QUEUE_LENGTHS = (20, 1000, 100000)
+
+
+class LegacyDedup:
+    def __init__(self, cache_queue_length: int) -> None:
+        self.cache_queue_length = cache_queue_length
+        self._dedup: Deque[str] = deque()
+        self._dedup_mxid: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _hash_event(event: Message) -> str:
+        hash_content = [event.date.timestamp(), event.message.strip()]
+        return hashlib.md5("-".join(str(a) for a in hash_content).encode("utf-8")).hexdigest()
+
+    def check(self, event: Message, mxid: tuple = None) -> tuple:
+        evt_hash = self._hash_event(event)
+        if evt_hash in self._dedup:
+            return self._dedup_mxid[evt_hash]
+        self._dedup_mxid[evt_hash] = mxid
+        self._dedup.append(evt_hash)
+        if len(self._dedup) > self.cache_queue_length:
+            del self._dedup_mxid[self._dedup.popleft()]
+        return None
+
+    def update(self, event: Message, mxid: tuple = None, expected_mxid: tuple = None) -> tuple:
+        evt_hash = self._hash_event(event)
+        try:
+            found_mxid = self._dedup_mxid[evt_hash]
+        except KeyError:
+            return "None", 0
+        if found_mxid != expected_mxid:
+            return found_mxid
+        self._dedup_mxid[evt_hash] = mxid
+        return None
+
+
+def _make_events(count: int, copies: int) -> List[List[Message]]:
+    start = datetime(2021, 1, 1)
+    # Every user's client gets its own copy of the message with a different ID
+    return [[Message(id=i * copies + copy, peer_id=PeerChat(1),
+                     date=start + timedelta(seconds=i // 3), message=f"Message number {i}")
+             for copy in range(copies)]
+            for i in range(count)]
+
+
+def _run(dedup, events: List[List[Message]]) -> float:
+    start = time.perf_counter()
+    for i, (first, *duplicates) in enumerate(events):
+        temporary = (f"${i}TGBRIDGETEMP", 1)
+        dedup.check(first, temporary)
+        for duplicate in duplicates:
+            dedup.check(duplicate, (f"${i}TGBRIDGETEMP", 2))
+        dedup.update(first, (f"${i}:example.com", 1), temporary)
+    return len(events) * len(events[0]) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    copies = int(sys.argv[2]) + 1 if len(sys.argv) > 2 else 5
+
+    print(f"{messages} messages, each received by {copies} users")
+    for length in QUEUE_LENGTHS:
+        legacy_rate = _run(LegacyDedup(length), _make_events(messages, copies))
+        PortalDedup.cache_queue_length = length
+        PortalDedup.cache_max_age = 0
+        new_rate = _run(PortalDedup(SimpleNamespace(peer_type="chat")),
+                        _make_events(messages, copies))
+        print(f"queue length {length:>6}: deque + md5 {legacy_rate:10.0f} checks/s, "
+              f"PortalDedup {new_rate:10.0f} checks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Compares the recursive Telegram entity to HTML renderer with the stack-based one.
+
+The corpus mimics the entity layouts of real messages: link digests and news posts from
+channels, long lists of mentions, chat messages with runs of bold and italic words, nested
+formatting and code blocks. Every layout is generated with a growing number of entities to show
+how the renderers scale. Mentions and links are rendered without database lookups, like in
+tests.formatter.test_from_telegram.
+
+Usage: python -m tests.benchmarks.bench_entities [repetitions]
+"""
+from typing import Callable, Dict, List, Tuple
+import asyncio
+import time
+import sys
+
+from telethon.helpers import add_surrogate
+from telethon.tl.types import (MessageEntityBold, MessageEntityItalic, MessageEntityTextUrl,
+                               MessageEntityUrl, MessageEntityMention, MessageEntityHashtag,
+                               MessageEntityPre, MessageEntityCode, MessageEntityUnderline,
+                               TypeMessageEntity)
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.formatter import from_telegram as ft
+from tests.formatter.test_from_telegram import (recursive_entities_to_matrix, fake_parse_url,
+                                                fake_parse_mention, fake_parse_name_mention)
+
+ENTITY_COUNTS = (10, 100, 500, 2000)
+
+Layout = Callable[[int], Tuple[str, List[TypeMessageEntity]]]
+
+
+class MessageBuilder:
+    def __init__(self) -> None:
+        self.parts: List[str] = []
+        self.length = 0
+        self.entities: List[TypeMessageEntity] = []
+
+    def add(self, text: str, *entity_types: Callable[..., TypeMessageEntity],
+            **kwargs: str) -> None:
+        text = add_surrogate(text)
+        for entity_type in entity_types:
+            self.entities.append(entity_type(self.length, len(text), **kwargs))
+        self.parts.append(text)
+        self.length += len(text)
+
+    def build(self) -> Tuple[str, List[TypeMessageEntity]]:
+        return "".join(self.parts), self.entities
+
+
+def link_digest(count: int) -> Tuple[str, List[TypeMessageEntity]]:
+    # "• **Title** — [source](url) #tag" lines from news channels
+    msg = MessageBuilder()
+    for i in range(count // 3):
+        msg.add("• ")
+        msg.add(f"Headline number {i} with <details> & more", MessageEntityBold)
+        msg.add(" — ")
+        msg.add("source", MessageEntityTextUrl, url=f"https://example.com/news/{i}?a=1&b=2")
+        msg.add(" ")
+        msg.add(f"#topic{i % 7}", MessageEntityHashtag)
+        msg.add("\n")
+    return msg.build()
+
+
+def mention_list(count: int) -> Tuple[str, List[TypeMessageEntity]]:
+    msg = MessageBuilder()
+    msg.add("Thanks to everyone who joined 🎉\n")
+    for i in range(count):
+        msg.add(f"@user_{i:04d}", MessageEntityMention)
+        msg.add(", " if i % 10 else "\n")
+    return msg.build()
+
+
+def bold_runs(count: int) -> Tuple[str, List[TypeMessageEntity]]:
+    # Chat messages with every other word emphasized, sometimes doubly
+    msg = MessageBuilder()
+    styles = ((MessageEntityBold,), (MessageEntityItalic,),
+              (MessageEntityBold, MessageEntityItalic), (MessageEntityUnderline,))
+    added = 0
+    while added < count:
+        entity_types = styles[added % len(styles)]
+        msg.add(f"word{added}", *entity_types)
+        msg.add(" plain text ")
+        added += len(entity_types)
+    return msg.build()
+
+
+def nested_post(count: int) -> Tuple[str, List[TypeMessageEntity]]:
+    # Bold paragraphs with italic sentences and links inside them
+    msg = MessageBuilder()
+    for i in range(count // 5):
+        start = len(msg.entities)
+        length = msg.length
+        msg.add("Paragraph ")
+        msg.add(f"sentence {i} ", MessageEntityItalic)
+        msg.add("see ")
+        msg.add(f"https://example.com/{i}", MessageEntityUrl)
+        msg.add(" and ")
+        msg.add("this", MessageEntityTextUrl, url=f"https://example.org/{i}")
+        msg.add(" or ")
+        msg.add(f"@channel{i}", MessageEntityMention)
+        msg.entities.insert(start, MessageEntityBold(length, msg.length - length))
+        msg.add("\n\n")
+    return msg.build()
+
+
+def code_blocks(count: int) -> Tuple[str, List[TypeMessageEntity]]:
+    msg = MessageBuilder()
+    for i in range(count // 2):
+        msg.add(f"Run `step_{i}`: ")
+        msg.add(f"print('<{i}>')\nexit({i})", MessageEntityPre, language="python")
+        msg.add(" then ")
+        msg.add(f"x & {i}", MessageEntityCode)
+        msg.add("\n")
+    return msg.build()
+
+
+LAYOUTS: Dict[str, Layout] = {
+    "link digest": link_digest,
+    "mention list": mention_list,
+    "bold runs": bold_runs,
+    "nested post": nested_post,
+    "code blocks": code_blocks,
+}
+
+
+async def measure(render: Callable, text: str, entities: List[TypeMessageEntity],
+                  repetitions: int) -> Tuple[float, str]:
+    durations = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        html = await render(text, entities)
+        durations.append(time.perf_counter() - start)
+    return min(durations), html
+
+
+async def main() -> None:
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ft._parse_mention = fake_parse_mention
+    ft._parse_name_mention = fake_parse_name_mention
+    ft._parse_url = fake_parse_url
+    print(f"{'layout':<14} {'entities':>8} {'recursive':>11} {'stack':>11} {'speedup':>8}")
+    for name, layout in LAYOUTS.items():
+        for count in ENTITY_COUNTS:
+            text, entities = layout(count)
+            old_time, old_html = await measure(recursive_entities_to_matrix, text, entities,
+                                               repetitions)
+            new_time, new_html = await measure(ft._telegram_entities_to_matrix, text, entities,
+                                               repetitions)
+            assert old_html == new_html, f"output differs for {name} with {count} entities"
+            print(f"{name:<14} {len(entities):>8} {old_time * 1000:9.2f}ms "
+                  f"{new_time * 1000:9.2f}ms {old_time / new_time:7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""Measures the message table lookups with and without the room lookup index.
+
+The table is filled with synthetic mappings: mostly channel-style rooms with one Telegram space
+and some normal groups where every message is mapped once per member. Every query is then run
+against random rooms and events, first without ``ix_message_mx_room_tg_space_tgid`` and then
+with it, and the query plans are printed so that sequential scans are easy to spot.
+
+Usage: python -m tests.benchmarks.bench_message_indexes [database URL] [rows] [queries]
+"""
+from typing import Callable, Dict, List, Tuple
+import statistics
+import random
+import time
+import sys
+
+import sqlalchemy as sql
+
+from mautrix.util.db import Base
+
+from mautrix_telegram import db
+from mautrix_telegram.db import Message
+
+ROOMS = 500
+GROUP_MEMBERS = 5
+INDEX_NAME = "ix_message_mx_room_tg_space_tgid"
+
+Sample = Tuple[str, int, str]
+
+
+def _fill(engine: sql.engine.Engine, rows: int) -> List[Sample]:
+    samples = []
+    batch = []
+    tgid = 0
+    with engine.begin() as conn:
+        while tgid < rows:
+            room = random.randrange(ROOMS)
+            mx_room = f"!room{room}:example.com"
+            # Every fifth room is a normal group, the rest behave like channels
+            spaces = ([room * 100 + member for member in range(GROUP_MEMBERS)]
+                      if room % 5 == 0 else [room * 100])
+            tgid += 1
+            mxid = f"$event{tgid}:example.com"
+            for tg_space in spaces:
+                batch.append(dict(mxid=mxid, mx_room=mx_room, tgid=tgid, tg_space=tg_space,
+                                  edit_index=0))
+            if random.random() < 0.01:
+                samples.append((mx_room, spaces[0], mxid))
+            if len(batch) >= 10000:
+                conn.execute(Message.t.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(Message.t.insert(), batch)
+    return samples
+
+
+def _delete_all(engine: sql.engine.Engine, mx_room: str) -> None:
+    # Roll back so that the same rows are there for the next pass
+    with engine.connect() as conn:
+        txn = conn.begin()
+        conn.execute(Message.t.delete().where(Message.c.mx_room == mx_room))
+        txn.rollback()
+
+
+def _queries(engine: sql.engine.Engine) -> Dict[str, Callable[[Sample], None]]:
+    return {
+        "find_last": lambda s: Message._find_last.__wrapped__(Message, s[0], s[1]),
+        "get_by_mxid": lambda s: Message._get_by_mxid.__wrapped__(Message, s[2], s[0], s[1]),
+        "count_spaces_by_mxid": lambda s: Message._count_spaces_by_mxid.__wrapped__(
+            Message, s[2], s[0]),
+        "delete_all": lambda s: _delete_all(engine, s[0]),
+    }
+
+
+def _explain(engine: sql.engine.Engine, sample: Sample) -> None:
+    mx_room, tg_space, mxid = sample
+    statements = {
+        "find_last": Message.t.select()
+            .where(sql.and_(Message.c.mx_room == mx_room, Message.c.tg_space == tg_space))
+            .order_by(sql.desc(Message.c.tgid)).limit(1),
+        "get_by_mxid": Message.t.select()
+            .where(sql.and_(Message.c.mxid == mxid, Message.c.mx_room == mx_room,
+                            Message.c.tg_space == tg_space)),
+        "count_spaces_by_mxid": sql.select([sql.func.count(Message.c.tg_space)])
+            .where(sql.and_(Message.c.mxid == mxid, Message.c.mx_room == mx_room)),
+        "delete_all": Message.t.delete().where(Message.c.mx_room == mx_room),
+    }
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    for name, stmt in statements.items():
+        query = str(stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+        plan = " / ".join(" ".join(str(col) for col in row)
+                          for row in engine.execute(sql.text(prefix + query)))
+        print(f"    {name:>20}: {plan}")
+
+
+def _measure(engine: sql.engine.Engine, samples: List[Sample], queries: int) -> None:
+    for name, query in _queries(engine).items():
+        latencies = []
+        for _ in range(queries):
+            sample = random.choice(samples)
+            start = time.perf_counter()
+            query(sample)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f"    {name:>20}: median {statistics.median(latencies) * 1000:8.3f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:8.3f} ms")
+
+
+def main() -> None:
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite:///mxtg-bench.db"
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    engine = sql.create_engine(url)
+    Base.metadata.drop_all(engine, tables=[Message.__table__])
+    Base.metadata.create_all(engine, tables=[Message.__table__])
+    db.init(engine)
+    index = next(index for index in Message.__table__.indexes if index.name == INDEX_NAME)
+    index.drop(engine)
+
+    print(f"Filling {engine.dialect.name} database with {rows} messages in {ROOMS} rooms")
+    random.seed(0)
+    samples = _fill(engine, rows)
+    if engine.dialect.name == "postgresql":
+        engine.execute("ANALYZE message")
+
+    for label in ("without index", "with index"):
+        if label == "with index":
+            index.create(engine)
+            if engine.dialect.name == "postgresql":
+                engine.execute("ANALYZE message")
+        print(f"{label}:")
+        _explain(engine, samples[0])
+        _measure(engine, samples, queries)
+
+
+if __name__ == "__main__":
+    main()
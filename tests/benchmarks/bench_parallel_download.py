@@ -0,0 +1,108 @@
+"""Compares the old lock-step parallel download with the pipelined sliding window download.
+
+Telegram is replaced with stand-in senders. Every connection has a limited bandwidth, and every
+part request gets a random extra latency on top of the round trip time, which is what makes the
+lock-step rounds wait for the slowest connection.
+
+Usage: python -m tests.benchmarks.bench_parallel_download [file size in MiB] [jitter in ms]
+       [max connections]
+"""
+from typing import List, Optional
+from types import SimpleNamespace
+import asyncio
+import random
+import time
+import sys
+
+from telethon import utils
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util.parallel_file_transfer import ParallelTransferrer
+
+ROUND_TRIP = 0.05
+BANDWIDTH = 2 * 1024 * 1024
+
+
+class StandInSender:
+    """Answers GetFileRequests after a jittered delay, one transmission at a time."""
+
+    def __init__(self, jitter: float) -> None:
+        self.jitter = jitter
+        self.busy_until = 0.0
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def send(self, request) -> SimpleNamespace:
+        loop = asyncio.get_event_loop()
+        # Requests are pipelined, but the data of the responses shares the connection bandwidth
+        start = max(loop.time() + ROUND_TRIP / 2, self.busy_until)
+        self.busy_until = start + request.limit / BANDWIDTH
+        done = self.busy_until + ROUND_TRIP / 2 + random.expovariate(1 / self.jitter)
+        await asyncio.sleep(done - loop.time())
+        return SimpleNamespace(bytes=bytes(request.limit))
+
+
+class StandInTransferrer(ParallelTransferrer):
+    def __init__(self, jitter: float) -> None:
+        self.loop = asyncio.get_event_loop()
+        self.dc_id = 2
+        self.pool = SimpleNamespace(put=lambda sender: None)
+        self.senders = None
+        self.upload_ticker = 0
+        self.jitter = jitter
+
+    async def _create_sender(self) -> StandInSender:
+        return StandInSender(self.jitter)
+
+
+async def lock_step_download(jitter: float, file_size: int, connections: int
+                             ) -> List[bytes]:
+    # The download loop from before the sliding window, with one request per connection per round
+    part_size = utils.get_appropriated_part_size(file_size) * 1024
+    part_count = (file_size + part_size - 1) // part_size
+    senders = [StandInSender(jitter) for _ in range(connections)]
+    parts = []
+    while len(parts) < part_count:
+        tasks = []
+        for index, sender in enumerate(senders):
+            offset = (len(parts) + index) * part_size
+            if offset < file_size:
+                tasks.append(asyncio.ensure_future(
+                    sender.send(SimpleNamespace(limit=part_size, offset=offset))))
+        for task in tasks:
+            parts.append((await task).bytes)
+    return parts
+
+
+async def sliding_window_download(jitter: float, file_size: int, connections: int
+                                  ) -> List[bytes]:
+    downloader = StandInTransferrer(jitter)
+    return [part async for part in downloader.download(None, file_size,
+                                                       connection_count=connections)]
+
+
+async def measure(name: str, download, jitter: float, file_size: int, connections: int) -> None:
+    start = time.perf_counter()
+    parts = await download(jitter, file_size, connections)
+    duration = time.perf_counter() - start
+    assert sum(len(part) for part in parts) >= file_size
+    print(f"{name:>15}: {file_size / duration / 1024 / 1024:7.2f} MiB/s")
+
+
+async def main(file_size: int, jitter: float, connections: Optional[int]) -> None:
+    connections = connections or ParallelTransferrer._get_connection_count(file_size)
+    print(f"{file_size // 1024 // 1024} MiB file, {connections} connections, "
+          f"{ROUND_TRIP * 1000:.0f} ms round trip, {jitter * 1000:.0f} ms mean jitter, "
+          f"{BANDWIDTH // 1024} KiB/s per connection")
+    random.seed(0)
+    await measure("lock-step", lock_step_download, jitter, file_size, connections)
+    random.seed(0)
+    await measure("sliding window", sliding_window_download, jitter, file_size, connections)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 50 * 1024 * 1024,
+                     int(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1,
+                     int(sys.argv[3]) if len(sys.argv) > 3 else None))
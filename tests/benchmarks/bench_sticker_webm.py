@@ -0,0 +1,111 @@
+"""Compares converting animated stickers to webm through a temporary directory of PNG frames with
+piping raw frames from rlottie into ffmpeg.
+
+The temporary directory approach uses lottieconverter if it's installed, like the bridge did.
+Otherwise the PNG frames are rendered with rlottie and Pillow, which leaves the disk I/O the
+same. Disk I/O is the size of the files written to the temporary directory, which ffmpeg then
+reads back.
+
+Usage: python -m tests.benchmarks.bench_sticker_webm <directory with tgs files> [size] [fps]
+       [repetitions]
+"""
+from typing import Any, Callable, Dict, Tuple
+import tempfile
+import asyncio
+import gzip
+import time
+import sys
+import os
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util import tgs_converter
+from mautrix_telegram.util.tgs_converter import ConvertedSticker, LottieAnimation
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class MeasuredTemporaryDirectory(tempfile.TemporaryDirectory):
+    written_bytes = 0
+
+    def cleanup(self) -> None:
+        for name in os.listdir(self.name):
+            MeasuredTemporaryDirectory.written_bytes += os.path.getsize(
+                os.path.join(self.name, name))
+        super().cleanup()
+
+
+async def rlottie_png_frames_to_webm(file: bytes, width: int, height: int, fps: int = 30
+                                     ) -> ConvertedSticker:
+    # Stand-in for lottieconverter's pngs output, followed by the same ffmpeg command
+    with MeasuredTemporaryDirectory(prefix="tgs_") as tmpdir:
+        animation = LottieAnimation.from_data(gzip.decompress(file).decode("utf-8"))
+        frame_count = max(1, round(animation.lottie_animation_get_duration() * fps))
+        for i in range(frame_count):
+            frame = animation.lottie_animation_get_frame_at_pos(i / frame_count)
+            data = animation.lottie_animation_render(frame, None, width, height)
+            Image.frombuffer("RGBA", (width, height), data, "raw", "BGRa").save(
+                f"{tmpdir}/out_{i:02d}.png")
+        animation.lottie_animation_destroy()
+        with open(f"{tmpdir}/out_00.png", "rb") as first_frame_file:
+            first_frame_data = first_frame_file.read()
+        returncode, stdout, _ = await tgs_converter._run(
+            tgs_converter.ffmpeg, "-hide_banner", "-loglevel", "error", "-framerate", str(fps),
+            "-pattern_type", "glob", "-i", f"{tmpdir}/out_*.png", "-c:v", "libvpx-vp9",
+            "-pix_fmt", "yuva420p", "-f", "webm", "-")
+    return ConvertedSticker("video/webm" if returncode == 0 else "application/gzip", stdout,
+                            "image/png", first_frame_data)
+
+
+def get_approaches() -> Dict[str, Callable[..., Any]]:
+    approaches = {}
+    if tgs_converter.lottieconverter and tgs_converter.ffmpeg:
+        tgs_converter.tempfile.TemporaryDirectory = MeasuredTemporaryDirectory
+        approaches["temp dir (lottieconverter)"] = tgs_converter.tgs_to_webm
+    elif LottieAnimation and Image and tgs_converter.ffmpeg:
+        approaches["temp dir (rlottie+PIL)"] = rlottie_png_frames_to_webm
+    if LottieAnimation and tgs_converter.ffmpeg:
+        approaches["pipe"] = tgs_converter.tgs_to_webm_pipe
+    return approaches
+
+
+async def measure(convert: Callable[..., Any], data: bytes, size: int, fps: int,
+                  repetitions: int) -> Tuple[float, int, int]:
+    durations = []
+    for _ in range(repetitions):
+        MeasuredTemporaryDirectory.written_bytes = 0
+        start = time.perf_counter()
+        converted = await convert(data, size, size, fps=fps)
+        durations.append(time.perf_counter() - start)
+        assert converted.mime == "video/webm", "conversion failed"
+    return min(durations), MeasuredTemporaryDirectory.written_bytes, len(converted.data)
+
+
+async def main() -> None:
+    directory = sys.argv[1]
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    fps = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    repetitions = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    # The converters are measured on their own, without the queue from convert_tgs_to
+    tgs_converter.timeout = 600
+    approaches = get_approaches()
+    if not approaches:
+        sys.exit("ffmpeg and lottieconverter or rlottie-python are required")
+    print(f"{size}x{size} at {fps} fps")
+    print(f"{'sticker':<20} {'approach':<26} {'time':>9} {'disk written':>13} {'webm':>9}")
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".tgs"):
+            continue
+        with open(os.path.join(directory, name), "rb") as file:
+            data = file.read()
+        for approach, convert in approaches.items():
+            duration, written, output = await measure(convert, data, size, fps, repetitions)
+            print(f"{name:<20} {approach:<26} {duration * 1000:7.0f}ms "
+                  f"{written / 1024:10.0f}KiB {output / 1024:6.0f}KiB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Measures how many bytes are copied per uploaded byte when cutting a download into upload parts.
+
+The old bytearray loop and UploadPartAssembler are fed the same stream of chunks. Both are
+followed by the serialization of the SaveFilePartRequest, which copies every byte once more
+in both cases and isn't included in the numbers.
+
+Usage: python -m tests.benchmarks.bench_upload_parts [file size in MiB] [part size in KiB]
+"""
+from typing import Callable, Iterable, List
+import hashlib
+import random
+import os
+import time
+import sys
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util.parallel_file_transfer import UploadPartAssembler
+
+CHUNK_SIZES = (8 * 1024, 64 * 1024, None, 512 * 1024)
+
+
+def legacy_parts(chunks: Iterable[bytes], part_size: int, md5: "hashlib._Hash") -> int:
+    # The loop from before UploadPartAssembler, with every copy counted
+    copied = 0
+    buffer = bytearray()
+    for data in chunks:
+        md5.update(data)
+        if len(buffer) == 0 and len(data) == part_size:
+            continue
+        new_len = len(buffer) + len(data)
+        if new_len >= part_size:
+            cutoff = part_size - len(buffer)
+            buffer.extend(data[:cutoff])
+            copied += cutoff * 2
+            bytes(buffer)
+            copied += len(buffer)
+            buffer.clear()
+            buffer.extend(data[cutoff:])
+            copied += (len(data) - cutoff) * 2
+        else:
+            buffer.extend(data)
+            copied += len(data)
+    if len(buffer) > 0:
+        bytes(buffer)
+        copied += len(buffer)
+    return copied
+
+
+def assembler_parts(chunks: Iterable[bytes], part_size: int, md5: "hashlib._Hash") -> int:
+    assembler = UploadPartAssembler(part_size, 8)
+    for data in chunks:
+        for part in assembler.feed(data):
+            md5.update(part)
+    part = assembler.flush()
+    if part is not None:
+        md5.update(part)
+    return assembler.copied_bytes
+
+
+def make_chunks(data: bytes, chunk_size: int) -> List[bytes]:
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        size = chunk_size or random.randrange(1024, 256 * 1024)
+        chunks.append(data[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def measure(name: str, func: Callable[..., int], chunks: List[bytes], part_size: int,
+            size: int) -> str:
+    md5 = hashlib.md5()
+    start = time.perf_counter()
+    copied = func(chunks, part_size, md5)
+    duration = time.perf_counter() - start
+    return f"{name} {copied / size:5.2f} copies/byte {size / duration / 1024 / 1024:8.0f} MiB/s"
+
+
+def main() -> None:
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    part_size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 512 * 1024
+    # The data only needs to be incompressible, the random chunk sizes are seeded
+    random.seed(0)
+    data = os.urandom(size)
+    print(f"{size // 1024 // 1024} MiB file, {part_size // 1024} KiB parts")
+    for chunk_size in CHUNK_SIZES:
+        chunks = make_chunks(data, chunk_size)
+        label = f"{chunk_size // 1024} KiB" if chunk_size else "random"
+        print(f"{label:>8} chunks: "
+              f"{measure('bytearray', legacy_parts, chunks, part_size, size)} | "
+              f"{measure('assembler', assembler_parts, chunks, part_size, size)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compares video thumbnail extraction through a temporary file and moviepy with piping the
+leading bytes of the video into ffmpeg.
+
+Every file is processed in a fresh child process, so that the peak memory of the bridge process
+(tracemalloc) and of ffmpeg (max RSS of the child processes) can be measured separately for each
+approach. The moviepy approach is skipped if moviepy and Pillow aren't installed.
+
+Usage: python -m tests.benchmarks.bench_video_thumbnail <directory with mp4/webm/gif files>
+       [repetitions]
+"""
+from typing import Callable, Dict, List, Tuple
+from io import BytesIO
+import multiprocessing
+import tracemalloc
+import tempfile
+import resource
+import asyncio
+import time
+import sys
+import os
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util import video_thumbnail
+
+try:
+    from moviepy.editor import VideoFileClip
+    from PIL import Image
+except ImportError:
+    VideoFileClip = Image = None
+
+EXTENSIONS = (".mp4", ".webm", ".gif")
+CHUNK_SIZE = 128 * 1024
+
+
+def temp_file_thumbnail(data: bytes, video_ext: str) -> Tuple[int, int]:
+    # The extraction from before piping to ffmpeg
+    with tempfile.NamedTemporaryFile(prefix="mxtg_video_", suffix=f".{video_ext}") as file:
+        file.write(data)
+        frame = VideoFileClip(file.name).get_frame(0)
+    image = Image.fromarray(frame).convert("RGBA")
+    thumbnail_file = BytesIO()
+    image.thumbnail((1024, 720), Image.ANTIALIAS)
+    image.save(thumbnail_file, "png")
+    return len(data), len(thumbnail_file.getvalue())
+
+
+def pipe_thumbnail(data: bytes, video_ext: str) -> Tuple[int, int]:
+    chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    read_bytes = 0
+    feed, extract_from_file = video_thumbnail._feed, video_thumbnail._extract_from_file
+
+    # Count how much of the video ffmpeg actually reads
+    async def counting_feed(*args) -> int:
+        nonlocal read_bytes
+        written = await feed(*args)
+        read_bytes += written
+        return written
+
+    async def counting_extract_from_file(*args) -> bytes:
+        nonlocal read_bytes
+        read_bytes += len(data)
+        return await extract_from_file(*args)
+
+    video_thumbnail._feed = counting_feed
+    video_thumbnail._extract_from_file = counting_extract_from_file
+    result = asyncio.run(video_thumbnail.extract_thumbnail(chunks, True, video_ext))
+    return read_bytes, len(result[0]) if result else 0
+
+
+APPROACHES: Dict[str, Callable[[bytes, str], Tuple[int, int]]] = {
+    "temp file": temp_file_thumbnail,
+    "pipe": pipe_thumbnail,
+}
+
+
+def run_one(name: str, path: str, conn) -> None:
+    with open(path, "rb") as file:
+        data = file.read()
+    tracemalloc.start()
+    start = time.perf_counter()
+    read_bytes, thumbnail_size = APPROACHES[name](data, path.rsplit(".", 1)[-1])
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    conn.send((duration, peak, child_rss, read_bytes, thumbnail_size))
+
+
+def measure(name: str, path: str, repetitions: int) -> List[Tuple[float, int, int, int, int]]:
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for _ in range(repetitions):
+        parent, child = ctx.Pipe()
+        process = ctx.Process(target=run_one, args=(name, path, child))
+        process.start()
+        results.append(parent.recv())
+        process.join()
+    return results
+
+
+def main() -> None:
+    directory = sys.argv[1]
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    if not video_thumbnail.ffmpeg:
+        sys.exit("ffmpeg not found")
+    names = [name for name in APPROACHES if name != "temp file" or VideoFileClip]
+    files = sorted(os.path.join(directory, file) for file in os.listdir(directory)
+                   if file.endswith(EXTENSIONS))
+    print(f"{'file':<24} {'approach':<10} {'time':>9} {'py peak':>10} {'ffmpeg rss':>11} "
+          f"{'video read':>11}")
+    for path in files:
+        size = os.path.getsize(path)
+        for name in names:
+            results = measure(name, path, repetitions)
+            duration = min(result[0] for result in results)
+            peak = max(result[1] for result in results)
+            child_rss = max(result[2] for result in results)
+            read_bytes = results[0][3]
+            if not results[0][4]:
+                print(f"{os.path.basename(path):<24} {name:<10} failed")
+                continue
+            print(f"{os.path.basename(path):<24} {name:<10} {duration * 1000:7.1f}ms "
+                  f"{peak / 1024:8.0f}KiB {child_rss / 1024 / 1024:8.1f}MiB "
+                  f"{read_bytes / size:10.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+from typing import Iterator
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+import pytest
+
+import mautrix_telegram.db
+from mautrix_telegram.db import Message
+
+
+@pytest.fixture
+def message_table() -> Iterator[None]:
+    """Binds the message table to an empty in-memory SQLite database."""
+    # The queries run in the database thread pool, so all threads must share one connection
+    engine = create_engine("sqlite://", poolclass=StaticPool,
+                           connect_args={"check_same_thread": False})
+    mautrix_telegram.db.init(engine)
+    Message.__table__.create(engine)
+    yield
+    Message.write_queue = None
+    Message.cache = None
+    engine.dispose()
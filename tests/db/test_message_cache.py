@@ -0,0 +1,147 @@
+from unittest.mock import patch
+
+import pytest
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.db import Message
+from mautrix_telegram.db.message_cache import MessageCache
+from mautrix_telegram.types import TelegramID
+
+pytestmark = pytest.mark.usefixtures("message_table")
+
+
+def make_message(tgid: int, mxid: str = None, tg_space: int = 1, room: str = "!room"
+                 ) -> Message:
+    return Message(mxid=mxid or f"$event{tgid}", mx_room=room, tgid=TelegramID(tgid),
+                   tg_space=TelegramID(tg_space), edit_index=0)
+
+
+async def get(tgid: int, tg_space: int = 1) -> Message:
+    return await Message.get_one_by_tgid(TelegramID(tgid), TelegramID(tg_space))
+
+
+async def get_latest(tgid: int, tg_space: int = 1) -> Message:
+    return await Message.get_one_by_tgid(TelegramID(tgid), TelegramID(tg_space), -1)
+
+
+@pytest.fixture
+def cache() -> MessageCache:
+    Message.cache = MessageCache(max_size=100)
+    return Message.cache
+
+
+@pytest.mark.asyncio
+async def test_lookups_are_cached(cache: MessageCache) -> None:
+    await make_message(1).insert()
+    with patch.object(Message, "_get_one_by_tgid") as query:
+        assert (await get(1)).mxid == "$event1"
+        assert (await Message.get_by_mxid("$event1", "!room", TelegramID(1))).tgid == 1
+        query.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cached_rows_are_copies(cache: MessageCache) -> None:
+    msg = make_message(1)
+    await msg.insert()
+    msg.mxid = "$changed"
+    first = await get(1)
+    assert first.mxid == "$event1"
+    first.redacted = True
+    assert not (await get(1)).redacted
+
+
+@pytest.mark.asyncio
+async def test_edit_and_update_invalidate(cache: MessageCache) -> None:
+    await make_message(1).insert()
+    await make_message(2).insert()
+    await (await get(1)).edit(mxid="$edited")
+    await Message.update_by_tgid(TelegramID(2), TelegramID(1), 0, redacted=True)
+    assert (await get(1)).mxid == "$edited"
+    assert (await get(2)).redacted
+    assert await Message.get_by_mxid("$event1", "!room", TelegramID(1)) is None
+
+
+@pytest.mark.asyncio
+async def test_update_by_mxid_invalidates_all_spaces(cache: MessageCache) -> None:
+    await make_message(1, "$shared", tg_space=1).insert()
+    await make_message(5, "$shared", tg_space=2).insert()
+    await Message.update_by_mxid("$shared", "!room", redacted=True)
+    assert (await get(1, tg_space=1)).redacted
+    assert (await get(5, tg_space=2)).redacted
+
+
+@pytest.mark.asyncio
+async def test_deletions_invalidate(cache: MessageCache) -> None:
+    for tgid in range(3):
+        await make_message(tgid).insert()
+    await make_message(10, room="!other").insert()
+    deleted = await Message.delete_by_tgids([TelegramID(0)], TelegramID(1))
+    assert [msg.tgid for msg in deleted] == [0]
+    assert await get(0) is None
+    await (await get(1)).delete()
+    assert await get(1) is None
+    await Message.delete_all("!room")
+    assert await get(2) is None
+    assert (await get(10)).mx_room == "!other"
+
+
+def test_stale_query_results_are_not_cached(cache: MessageCache) -> None:
+    msg = make_message(1)
+    generation = cache.generation
+    # The row is deleted while the query that found it is still running
+    cache.remove(msg.tgid, msg.tg_space, msg.edit_index)
+    cache.put(msg, generation)
+    assert cache.get_by_tgid(msg.tgid, msg.tg_space, 0) is None
+    cache.put(msg, cache.generation)
+    assert cache.get_by_tgid(msg.tgid, msg.tg_space, 0).mxid == "$event1"
+
+
+def test_least_recently_used_rows_are_evicted() -> None:
+    cache = MessageCache(max_size=2)
+    for tgid in range(2):
+        cache.put(make_message(tgid))
+    cache.get_by_tgid(TelegramID(0), TelegramID(1), 0)
+    cache.put(make_message(2))
+    assert cache.get_by_tgid(TelegramID(0), TelegramID(1), 0)
+    assert cache.get_by_tgid(TelegramID(1), TelegramID(1), 0) is None
+    assert cache.get_by_mxid("$event1", "!room", TelegramID(1)) is None
+    assert cache.get_by_mxid("$event2", "!room", TelegramID(1)).tgid == 2
+
+
+@pytest.mark.asyncio
+async def test_latest_edit_lookups_are_cached(cache: MessageCache) -> None:
+    await make_message(1).insert()
+    await Message(mxid="$edit", mx_room="!room", tgid=TelegramID(1), tg_space=TelegramID(1),
+                  edit_index=1).insert()
+    assert (await get_latest(1)).mxid == "$edit"
+    with patch.object(Message, "_get_one_by_tgid") as query:
+        assert (await get_latest(1)).mxid == "$edit"
+        query.assert_not_called()
+    # An edit right after the cached latest one replaces it
+    await Message(mxid="$edit2", mx_room="!room", tgid=TelegramID(1), tg_space=TelegramID(1),
+                  edit_index=2).insert()
+    with patch.object(Message, "_get_one_by_tgid") as query:
+        assert (await get_latest(1)).mxid == "$edit2"
+        query.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_latest_edit_is_invalidated(cache: MessageCache) -> None:
+    await make_message(1).insert()
+    await Message(mxid="$edit", mx_room="!room", tgid=TelegramID(1), tg_space=TelegramID(1),
+                  edit_index=1).insert()
+    assert (await get_latest(1)).mxid == "$edit"
+    await (await get_latest(1)).delete()
+    assert (await get_latest(1)).mxid == "$event1"
+    await Message.delete_by_tgids([TelegramID(1)], TelegramID(1))
+    assert await get_latest(1) is None
+
+
+def test_latest_edit_is_forgotten_on_eviction() -> None:
+    cache = MessageCache(max_size=1)
+    cache.put(make_message(1), latest=True)
+    assert cache.get_latest(TelegramID(1), TelegramID(1)).mxid == "$event1"
+    cache.put(make_message(2))
+    assert cache.get_latest(TelegramID(1), TelegramID(1)) is None
+    assert cache._latest == {}
@@ -0,0 +1,92 @@
+from typing import List
+
+from sqlalchemy.exc import IntegrityError
+import pytest
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.db import Message
+from mautrix_telegram.db.message_cache import MessageCache
+from mautrix_telegram.db.message_queue import MessageWriteQueue
+from mautrix_telegram.types import TelegramID
+
+pytestmark = pytest.mark.usefixtures("message_table")
+
+
+def make_message(tgid: int, mxid: str = None, tg_space: int = 1) -> Message:
+    return Message(mxid=mxid or f"$event{tgid}", mx_room="!room", tgid=TelegramID(tgid),
+                   tg_space=TelegramID(tg_space), edit_index=0)
+
+
+def stored_tgids() -> List[int]:
+    return sorted(row.tgid for row in Message._select_all())
+
+
+@pytest.mark.asyncio
+async def test_inserts_are_buffered_until_flushed() -> None:
+    Message.write_queue = MessageWriteQueue(Message, max_size=100, max_delay=60)
+    written = [await make_message(tgid).insert() for tgid in range(3)]
+    assert stored_tgids() == []
+    assert not any(result.done() for result in written)
+
+    pending = await Message.get_one_by_tgid(TelegramID(1), TelegramID(1))
+    assert pending.mxid == "$event1"
+
+    await Message.write_queue.flush()
+    assert stored_tgids() == [0, 1, 2]
+    assert all(result.done() and result.exception() is None for result in written)
+
+
+@pytest.mark.asyncio
+async def test_queue_flushes_when_full() -> None:
+    Message.write_queue = MessageWriteQueue(Message, max_size=2, max_delay=60)
+    await make_message(1).insert()
+    assert stored_tgids() == []
+    await make_message(2).insert()
+    assert stored_tgids() == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_failed_insert_is_returned_and_others_are_written() -> None:
+    await make_message(1).insert()
+    Message.cache = MessageCache()
+    Message.write_queue = MessageWriteQueue(Message, max_size=100, max_delay=60)
+    duplicate = await make_message(1, mxid="$duplicate").insert()
+    other = await make_message(2).insert()
+    await Message.write_queue.flush()
+
+    assert isinstance(duplicate.exception(), IntegrityError)
+    assert other.exception() is None
+    assert stored_tgids() == [1, 2]
+    # The failed insert must not be served from the cache
+    msg = await Message.get_one_by_tgid(TelegramID(1), TelegramID(1))
+    assert msg.mxid == "$event1"
+
+
+@pytest.mark.asyncio
+async def test_unexpected_batch_error_retries_one_by_one(monkeypatch) -> None:
+    queue = Message.write_queue = MessageWriteQueue(Message, max_size=100, max_delay=60)
+    execute = queue._execute
+    calls = 0
+
+    def fail_first_batch(conn, ops) -> None:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("connection lost")
+        execute(conn, ops)
+
+    monkeypatch.setattr(queue, "_execute", fail_first_batch)
+    written = [await make_message(tgid).insert() for tgid in range(3)]
+    await queue.flush()
+    assert stored_tgids() == [0, 1, 2]
+    assert all(result.exception() is None for result in written)
+
+
+@pytest.mark.asyncio
+async def test_pending_update_is_flushed_before_lookup() -> None:
+    await make_message(1).insert()
+    Message.write_queue = MessageWriteQueue(Message, max_size=100, max_delay=60)
+    await Message.update_by_tgid(TelegramID(1), TelegramID(1), 0, mxid="$edited")
+    msg = await Message.get_one_by_tgid(TelegramID(1), TelegramID(1))
+    assert msg.mxid == "$edited"
@@ -0,0 +1,128 @@
+from typing import List, Optional, Tuple
+import random
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from telethon.helpers import add_surrogate
+from telethon.tl.types import (MessageEntityMention, MessageEntityMentionName, MessageEntityUrl,
+                               MessageEntityEmail, MessageEntityTextUrl, MessageEntityBold,
+                               MessageEntityItalic, MessageEntityCode, MessageEntityPre,
+                               MessageEntityBotCommand, MessageEntityHashtag, MessageEntityCashtag,
+                               MessageEntityPhone, MessageEntityBlockquote, MessageEntityStrike,
+                               MessageEntityUnderline, MessageEntityUnknown, TypeMessageEntity)
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.formatter import from_telegram as ft
+
+
+async def recursive_entities_to_matrix(text: str, entities: List[TypeMessageEntity],
+                                       offset: int = 0, length: int = None) -> str:
+    """The recursive renderer that _telegram_entities_to_matrix replaced, for reference."""
+    if not entities:
+        return ft.escape(text)
+    if length is None:
+        length = len(text)
+    html = []
+    last_offset = 0
+    for i, entity in enumerate(entities):
+        if entity.offset > offset + length:
+            break
+        relative_offset = entity.offset - offset
+        if relative_offset > last_offset:
+            html.append(ft.escape(text[last_offset:relative_offset]))
+        elif relative_offset < last_offset:
+            continue
+
+        entity_text = await recursive_entities_to_matrix(
+            text=text[relative_offset:relative_offset + entity.length],
+            entities=entities[i + 1:], offset=entity.offset, length=entity.length)
+        skip_entity = await ft._entity_to_html(html, entity, entity_text)
+        last_offset = relative_offset + (0 if skip_entity else entity.length)
+    html.append(ft.escape(text[last_offset:]))
+
+    return "".join(html)
+
+
+def fake_parse_mention(html: List[str], entity_text: str) -> bool:
+    # Mentions of unknown users are left as plain text
+    if len(entity_text) % 2:
+        return True
+    html.append(f"<a href='https://matrix.to/#/@{entity_text[1:]}:example.com'>{entity_text}</a>")
+    return False
+
+
+def fake_parse_name_mention(html: List[str], entity_text: str, user_id: int) -> bool:
+    if user_id % 2:
+        return True
+    html.append(f"<a href='https://matrix.to/#/@telegram_{user_id}:example.com'>"
+                f"{entity_text}</a>")
+    return False
+
+
+async def fake_parse_url(html: List[str], entity_text: str, url: Optional[str]) -> bool:
+    html.append(f"<a href='{url or entity_text}'>{entity_text}</a>")
+    return False
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(ft, "_parse_mention", fake_parse_mention)
+    monkeypatch.setattr(ft, "_parse_name_mention", fake_parse_name_mention)
+    monkeypatch.setattr(ft, "_parse_url", fake_parse_url)
+
+
+ENTITY_TYPES = [
+    lambda rng, o, l: MessageEntityBold(o, l),
+    lambda rng, o, l: MessageEntityItalic(o, l),
+    lambda rng, o, l: MessageEntityUnderline(o, l),
+    lambda rng, o, l: MessageEntityStrike(o, l),
+    lambda rng, o, l: MessageEntityBlockquote(o, l),
+    lambda rng, o, l: MessageEntityCode(o, l),
+    lambda rng, o, l: MessageEntityPre(o, l, rng.choice(["", "python"])),
+    lambda rng, o, l: MessageEntityMention(o, l),
+    lambda rng, o, l: MessageEntityMentionName(o, l, rng.randint(1, 10)),
+    lambda rng, o, l: MessageEntityEmail(o, l),
+    lambda rng, o, l: MessageEntityUrl(o, l),
+    lambda rng, o, l: MessageEntityTextUrl(o, l, "https://example.com/?a=1&b=<2>"),
+    lambda rng, o, l: MessageEntityBotCommand(o, l),
+    lambda rng, o, l: MessageEntityHashtag(o, l),
+    lambda rng, o, l: MessageEntityCashtag(o, l),
+    lambda rng, o, l: MessageEntityPhone(o, l),
+    lambda rng, o, l: MessageEntityUnknown(o, l),
+]
+ALPHABET = "ab \n<>&'\"🦊"
+
+
+def random_message(rng: random.Random) -> Tuple[str, List[TypeMessageEntity]]:
+    text = add_surrogate("".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40))))
+    entities = []
+    for _ in range(rng.randint(1, 12)):
+        # Slightly past the end of the text too, to cover entities that Telegram got wrong
+        offset = rng.randint(0, len(text) + 2)
+        length = rng.randint(0, len(text) + 2 - offset)
+        entities.append(rng.choice(ENTITY_TYPES)(rng, offset, length))
+    if rng.random() < 0.8:
+        # Telegram sorts entities by offset, but unsorted ones must render the same too
+        entities.sort(key=lambda entity: (entity.offset, -entity.length))
+    return text, entities
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("seed", range(20))
+async def test_entities_to_matrix_matches_recursive(seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(200):
+        text, entities = random_message(rng)
+        expected = await recursive_entities_to_matrix(text, entities)
+        assert await ft._telegram_entities_to_matrix(text, entities) == expected, (text, entities)
+
+
+@pytest.mark.asyncio
+async def test_entities_to_matrix_nested() -> None:
+    text = "bold italic link end"
+    entities = [MessageEntityBold(0, 16), MessageEntityItalic(5, 11),
+                MessageEntityTextUrl(12, 4, "https://example.com")]
+    assert await ft._telegram_entities_to_matrix(text, entities) == (
+        "<strong>bold <em>italic <a href='https://example.com'>link</a></em></strong> end")
@@ -0,0 +1,176 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from telethon.tl.patched import Message
+from telethon.tl.types import (PeerChannel, PeerChat, UpdateNewChannelMessage,
+                               UpdateEditChannelMessage, UpdateDeleteChannelMessages)
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.db import DedupState
+from mautrix_telegram.portal.deduplication import DedupWindow, PortalDedup, SharedDedup, save_all
+
+
+def make_message(id: int, text: str = "hello", peer=PeerChannel(1), edit_date=None) -> Message:
+    return Message(id=id, peer_id=peer, date=datetime(2021, 1, 1), message=text,
+                   edit_date=edit_date)
+
+
+def make_dedup(peer_type: str = "channel") -> PortalDedup:
+    return PortalDedup(SimpleNamespace(peer_type=peer_type, tgid=1, tg_receiver=1,
+                                       tgid_log="1"))
+
+
+def test_window_evicts_oldest_when_full() -> None:
+    window = DedupWindow(3)
+    for key in range(5):
+        window.add(key)
+    assert len(window) == 3
+    assert 0 not in window and 1 not in window
+    assert all(key in window for key in (2, 3, 4))
+
+
+def test_window_readding_moves_key_to_end() -> None:
+    window = DedupWindow(3)
+    for key in (1, 2, 3):
+        window.add(key)
+    window.add(1)
+    window.add(4)
+    assert 1 in window
+    assert 2 not in window
+    assert [key for key, _, _ in window.items()] == [3, 1, 4]
+
+
+def test_window_replace_keeps_position() -> None:
+    window = DedupWindow(2)
+    window.add(1, "a")
+    window.add(2, "b")
+    window.replace(1, "c")
+    window.add(3)
+    assert 1 not in window
+    assert window.get(2) == "b"
+
+
+def test_window_expires_by_age() -> None:
+    window = DedupWindow(10, max_age=60)
+    with patch("time.time", return_value=1000):
+        window.add(1)
+    with patch("time.time", return_value=1030):
+        window.add(2)
+    with patch("time.time", return_value=1070):
+        assert 1 not in window
+        assert 2 in window
+    with patch("time.time", return_value=1100):
+        assert len(list(window.items())) == 0
+
+
+def test_window_get_default() -> None:
+    window = DedupWindow(10)
+    window.add(1)
+    assert window.get(1, "missing") is None
+    assert window.get(2, "missing") == "missing"
+
+
+def test_window_restore_keeps_newer_items() -> None:
+    window = DedupWindow(3)
+    window.add(3, "new")
+    window.restore([(1, 0, "a"), (2, 0, "b"), (3, 0, "old")])
+    assert [(key, value) for key, _, value in window.items()] == [(1, "a"), (2, "b"),
+                                                                  (3, "new")]
+
+
+def test_portal_dedup_check_and_update() -> None:
+    dedup = make_dedup()
+    msg = make_message(10)
+    temporary = ("$1TGBRIDGETEMP", 1)
+    assert dedup.check(msg, temporary) is None
+    assert dedup.check(msg) == temporary
+    assert dedup.update(msg, ("$real", 1), temporary) is None
+    assert dedup.check(msg) == ("$real", 1)
+    assert dedup.update(make_message(11), ("$other", 1)) == ("None", 0)
+
+
+def test_portal_dedup_check_without_mxid() -> None:
+    dedup = make_dedup()
+    msg = make_message(10)
+    assert dedup.check(msg) is None
+    # The key is known, but it has no event ID attached
+    assert dedup.update(msg, ("$real", 1)) is None
+    assert dedup.check(msg) == ("$real", 1)
+
+
+def test_portal_dedup_chats_use_fingerprint() -> None:
+    dedup = make_dedup("chat")
+    # Every receiver gets a different message ID in normal groups
+    first = make_message(10, peer=PeerChat(1))
+    second = make_message(20, peer=PeerChat(1))
+    assert dedup.check(first, ("$1", 1)) is None
+    assert dedup.check(second, ("$2", 2)) == ("$1", 1)
+    assert dedup.check(make_message(30, "different", PeerChat(1))) is None
+
+
+def test_shared_dedup_drops_copies() -> None:
+    shared = SharedDedup()
+    update = UpdateNewChannelMessage(make_message(10), pts=1, pts_count=1)
+    copy = UpdateNewChannelMessage(make_message(10), pts=5, pts_count=1)
+    assert not shared.is_duplicate(update)
+    assert shared.is_duplicate(copy)
+    assert not shared.is_duplicate(UpdateNewChannelMessage(make_message(11), pts=2,
+                                                           pts_count=1))
+
+
+def test_shared_dedup_edits_and_deletes() -> None:
+    shared = SharedDedup()
+    first_edit = make_message(10, "edited", edit_date=datetime(2021, 1, 1, 0, 1))
+    second_edit = make_message(10, "edited again", edit_date=datetime(2021, 1, 1, 0, 2))
+    assert not shared.is_duplicate(UpdateEditChannelMessage(first_edit, pts=1, pts_count=1))
+    assert shared.is_duplicate(UpdateEditChannelMessage(first_edit, pts=1, pts_count=1))
+    assert not shared.is_duplicate(UpdateEditChannelMessage(second_edit, pts=2, pts_count=1))
+    delete = UpdateDeleteChannelMessages(channel_id=1, messages=[10, 11], pts=3, pts_count=2)
+    assert not shared.is_duplicate(delete)
+    assert shared.is_duplicate(delete)
+
+
+def test_shared_dedup_ignores_other_chats() -> None:
+    shared = SharedDedup()
+    update = UpdateNewChannelMessage(make_message(10, peer=PeerChat(1)), pts=1, pts_count=1)
+    assert not shared.is_duplicate(update)
+    assert not shared.is_duplicate(update)
+
+
+def test_shared_dedup_forgets_old_updates() -> None:
+    shared = SharedDedup(max_size=2)
+    updates = [UpdateNewChannelMessage(make_message(i), pts=i, pts_count=1) for i in range(3)]
+    for update in updates:
+        assert not shared.is_duplicate(update)
+    assert not shared.is_duplicate(updates[0])
+
+
+@pytest.mark.asyncio
+async def test_save_all_keeps_changes_after_failed_save() -> None:
+    dedup = make_dedup()
+    dedup._loaded = True
+    dedup.check(make_message(10), ("$1", 1))
+    portal = SimpleNamespace(dedup=dedup)
+    with patch.object(DedupState, "save_all", side_effect=RuntimeError("database is down")):
+        with pytest.raises(RuntimeError):
+            await save_all([portal])
+    assert dedup.dirty
+
+    saved = []
+
+    async def save(states) -> None:
+        saved.extend(states)
+        # Changes made while the state is being saved are saved next time
+        dedup.check(make_message(11), ("$2", 1))
+
+    with patch.object(DedupState, "save_all", side_effect=save):
+        await save_all([portal])
+    assert len(saved) == 1 and saved[0].tgid == 1
+    assert dedup.dirty
+    with patch.object(DedupState, "save_all", side_effect=save):
+        await save_all([portal])
+    assert not dedup.dirty
@@ -0,0 +1,146 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+import asyncio
+
+import pytest
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.portal.work_queue import PortalWorkQueue
+
+
+def make_queue() -> PortalWorkQueue:
+    return PortalWorkQueue(SimpleNamespace(tgid_log="123", log=Mock()))
+
+
+@pytest.mark.asyncio
+async def test_updates_are_handled_in_order() -> None:
+    queue = make_queue()
+    handled = []
+
+    async def handle(number: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        handled.append(number)
+
+    await queue.push(handle, 1, 0.02)
+    await queue.push(handle, 2, 0)
+    await queue.push(handle, 3, 0.01)
+    await queue.wait_for_pending()
+    assert handled == [1, 2, 3]
+    assert not queue.busy
+
+
+@pytest.mark.asyncio
+async def test_failing_update_does_not_stop_the_queue() -> None:
+    queue = make_queue()
+    handled = []
+
+    async def fail() -> None:
+        raise ValueError("broken update")
+
+    async def handle() -> None:
+        handled.append(True)
+
+    await queue.push(fail)
+    await queue.push(handle)
+    await queue.wait_for_pending()
+    assert handled == [True]
+    queue._portal.log.exception.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_pending_only_waits_for_earlier_updates() -> None:
+    queue = make_queue()
+    release = asyncio.Event()
+    handled = []
+
+    async def blocked() -> None:
+        await release.wait()
+        handled.append("blocked")
+
+    await queue.push(blocked)
+    waiter = asyncio.ensure_future(queue.wait_for_pending())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    release.set()
+    await waiter
+    assert handled == ["blocked"]
+
+
+@pytest.mark.asyncio
+async def test_wait_for_pending_returns_when_idle() -> None:
+    queue = make_queue()
+    await asyncio.wait_for(queue.wait_for_pending(), 1)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_pending_with_sequence_number() -> None:
+    queue = make_queue()
+    release = asyncio.Event()
+
+    async def blocked() -> None:
+        await release.wait()
+
+    async def handle() -> None:
+        pass
+
+    first = await queue.push(handle)
+    await queue.push(blocked)
+    # Waiting for an earlier update doesn't wait for the blocked one after it
+    await asyncio.wait_for(queue.wait_for_pending(first), 1)
+    assert queue.busy
+    release.set()
+    await queue.wait_for_pending()
+    assert not queue.busy
+
+
+@pytest.mark.asyncio
+async def test_background_work_does_not_block_queue() -> None:
+    queue = make_queue()
+    release = asyncio.Event()
+    handled = []
+
+    async def transfer() -> None:
+        await release.wait()
+        handled.append("file")
+
+    async def start_transfer() -> None:
+        queue.run_in_background(1, transfer())
+
+    async def handle() -> None:
+        handled.append("text")
+
+    await queue.push(start_transfer)
+    text = await queue.push(handle)
+    waiter = asyncio.ensure_future(queue.wait_for_pending(text))
+    await asyncio.sleep(0.01)
+    assert handled == ["text"]
+    # The update that started the transfer only counts as handled once the transfer is done
+    assert not waiter.done()
+    background = asyncio.ensure_future(queue.wait_for_background(1))
+    release.set()
+    await waiter
+    await background
+    assert handled == ["text", "file"]
+    assert not queue.busy
+    await asyncio.wait_for(queue.wait_for_background(1), 1)
+
+
+@pytest.mark.asyncio
+async def test_stop_handles_queued_updates() -> None:
+    queue = make_queue()
+    handled = []
+
+    async def handle(number: int) -> None:
+        await asyncio.sleep(0)
+        handled.append(number)
+
+    async def start_transfer() -> None:
+        queue.run_in_background("file", handle(0))
+
+    await queue.push(start_transfer)
+    for number in range(1, 4):
+        await queue.push(handle, number)
+    await queue.stop()
+    assert sorted(handled) == [0, 1, 2, 3]
+    assert not queue.busy
@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+
+from telethon.tl.functions import PingRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util.sender_pool import SenderPool
+
+
+class FakeSender:
+    def __init__(self, auth_key: object = None, healthy: bool = True) -> None:
+        self.auth_key = auth_key or object()
+        self.connected = True
+        self.healthy = healthy
+        self.sent = []
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def disconnect(self) -> None:
+        self.connected = False
+
+    async def send(self, request: object) -> None:
+        self.sent.append(request)
+        if not self.healthy:
+            raise ConnectionError("connection lost")
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.session = SimpleNamespace(dc_id=2, auth_key=object())
+        self._init_request = SimpleNamespace(query=None)
+        self.exported = 0
+
+    async def __call__(self, request: ExportAuthorizationRequest) -> SimpleNamespace:
+        self.exported += 1
+        await asyncio.sleep(0)
+        return SimpleNamespace(id=1, bytes=b"auth")
+
+
+class FakePool(SenderPool):
+    def __init__(self, dc_id: int = 2) -> None:
+        super().__init__(FakeClient(), dc_id)
+        self.connected = []
+
+    async def _connect(self) -> FakeSender:
+        await asyncio.sleep(0)
+        sender = FakeSender(self.auth_key)
+        self.connected.append(sender)
+        return sender
+
+
+@pytest.mark.asyncio
+async def test_senders_are_reused() -> None:
+    pool = FakePool()
+    sender = await pool.get()
+    pool.put(sender)
+    assert await pool.get() is sender
+    assert len(pool.connected) == 1
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_disconnected_senders_are_not_pooled() -> None:
+    pool = FakePool()
+    sender = await pool.get()
+    await sender.disconnect()
+    pool.put(sender)
+    assert await pool.get() is not sender
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_senders_idle_for_a_while_are_pinged() -> None:
+    pool = FakePool()
+    healthy, broken = await pool.get(), await pool.get()
+    broken.healthy = False
+    pool.put(healthy)
+    pool.put(broken)
+    pool._idle = [(idle_since - pool.ping_after - 1, sender)
+                  for idle_since, sender in pool._idle]
+    # The most recently returned sender is tried first, but it fails the health check
+    assert await pool.get() is healthy
+    assert not broken.is_connected()
+    assert isinstance(broken.sent[0], PingRequest) and isinstance(healthy.sent[0], PingRequest)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_idle_senders_expire() -> None:
+    pool = FakePool()
+    pool.idle_timeout = 0.02
+    sender = await pool.get()
+    pool.put(sender)
+    await asyncio.sleep(0.05)
+    assert not sender.is_connected()
+    assert pool._idle == []
+    assert await pool.get() is not sender
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_close_disconnects_idle_senders() -> None:
+    pool = FakePool()
+    senders = [await pool.get() for _ in range(3)]
+    for sender in senders:
+        pool.put(sender)
+    await pool.close()
+    assert not any(sender.is_connected() for sender in senders)
+
+
+@pytest.mark.asyncio
+async def test_authorization_is_exported_once_per_dc() -> None:
+    pool = FakePool(dc_id=4)
+    assert pool.auth_key is None
+    senders = await asyncio.gather(*(pool.get() for _ in range(3)))
+    assert pool.client.exported == 1
+    assert len(set(map(id, senders))) == 3
+    # Only the sender that imported the authorization sent the import request
+    assert sum(len(sender.sent) for sender in senders) == 1
+    assert pool.auth_key is senders[0].auth_key
+    await pool.close()
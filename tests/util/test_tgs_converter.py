@@ -0,0 +1,118 @@
+from typing import Any
+from unittest.mock import patch
+import asyncio
+import gzip
+import json
+import os
+
+import pytest
+
+# The portal package can't be imported on its own because of an import cycle
+import mautrix_telegram.user
+from mautrix_telegram.util import tgs_converter
+from mautrix_telegram.util.tgs_converter import ConvertedSticker, convert_tgs_to
+
+# One second of an empty 64x64 animation
+EMPTY_ANIMATION = gzip.compress(json.dumps({
+    "v": "5.5.2", "fr": 30, "ip": 0, "op": 30, "w": 64, "h": 64, "layers": [],
+}).encode("utf-8"))
+
+
+def test_rlottie_renders_raw_frames() -> None:
+    pytest.importorskip("rlottie_python")
+    if not tgs_converter.ffmpeg:
+        pytest.skip("the rlottie renderer is only used with ffmpeg")
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as pipe:
+        # The pipe is closed by the renderer, 10 frames of 32x32 BGRA fit in the pipe buffer
+        tgs_converter._render_frames(EMPTY_ANIMATION, write_fd, 32, 32, 10)
+        frames = pipe.read()
+    assert len(frames) == 10 * 32 * 32 * 4
+
+
+class FakeConverter:
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, file: bytes, width: int, height: int, **_: Any
+                       ) -> ConvertedSticker:
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return ConvertedSticker("image/png", file[::-1])
+
+
+@pytest.fixture
+def converter() -> FakeConverter:
+    converter = FakeConverter()
+    with patch.dict(tgs_converter.converters, {"png": converter}), \
+            patch.object(tgs_converter, "max_parallel", 2), \
+            patch.object(tgs_converter, "_slots", None):
+        yield converter
+    assert tgs_converter._in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_identical_conversions_are_coalesced(converter: FakeConverter) -> None:
+    results = await asyncio.gather(*(convert_tgs_to(b"sticker", "png", 64, 64)
+                                     for _ in range(5)))
+    assert converter.calls == 1
+    assert all(result is results[0] for result in results)
+    assert results[0].data == b"rekcits" and results[0].width == 64
+    # Only conversions that are running at the same time are shared
+    await convert_tgs_to(b"sticker", "png", 64, 64)
+    assert converter.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_different_conversions_are_not_coalesced(converter: FakeConverter) -> None:
+    await asyncio.gather(convert_tgs_to(b"sticker", "png", 64, 64),
+                         convert_tgs_to(b"sticker", "png", 128, 128),
+                         convert_tgs_to(b"other", "png", 64, 64))
+    assert converter.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_conversion(converter: FakeConverter
+                                                                  ) -> None:
+    cancelled = asyncio.ensure_future(convert_tgs_to(b"sticker", "png", 64, 64))
+    waiting = asyncio.ensure_future(convert_tgs_to(b"sticker", "png", 64, 64))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert (await waiting).data == b"rekcits"
+    assert converter.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_parallel_conversions_are_limited(converter: FakeConverter) -> None:
+    await asyncio.gather(*(convert_tgs_to(bytes([i]), "png", 64, 64) for i in range(6)))
+    assert converter.calls == 6
+    assert converter.max_running == 2
+    assert not tgs_converter.is_busy()
+
+
+@pytest.mark.asyncio
+async def test_timed_out_conversion_falls_back_to_lottie(converter: FakeConverter) -> None:
+    async def time_out(*_: Any, **__: Any) -> ConvertedSticker:
+        raise asyncio.TimeoutError()
+
+    tgs_converter.converters["png"] = time_out
+    result = await convert_tgs_to(b"sticker", "png", 64, 64)
+    assert result.mime == "application/gzip" and result.data == b"sticker"
+
+
+@pytest.mark.asyncio
+async def test_converter_process_is_killed_after_timeout() -> None:
+    sleep = tgs_converter.abswhich("sleep")
+    if not sleep:
+        pytest.skip("sleep executable not found")
+    with patch.object(tgs_converter, "timeout", 0.1):
+        with pytest.raises(asyncio.TimeoutError):
+            await tgs_converter._run(sleep, "10")
@@ -0,0 +1,153 @@
+from contextlib import AsyncExitStack
+from typing import List, Tuple
+import asyncio
+
+import pytest
+
+from mautrix_telegram.util.transfer_scheduler import TransferScheduler
+
+PART = 1024
+
+
+async def start(stack: AsyncExitStack, scheduler: TransferScheduler, user_id: int = 1,
+                dc_id: int = 2, size: int = 10 * PART, connections: int = 1) -> int:
+    return await stack.enter_async_context(scheduler.reserve(user_id, dc_id, size, connections,
+                                                             PART))
+
+
+class Transfer:
+    """A transfer that waits for connections in the background and runs until it's finished."""
+
+    def __init__(self, scheduler: TransferScheduler, started: List[Tuple[int, int]],
+                 user_id: int = 1, size: int = 10 * PART, connections: int = 1) -> None:
+        self.size = size
+        self.finished = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(scheduler, started, user_id, connections))
+
+    async def _run(self, scheduler: TransferScheduler, started: List[Tuple[int, int]],
+                   user_id: int, connections: int) -> None:
+        async with scheduler.reserve(user_id, 2, self.size, connections, PART) as granted:
+            started.append((self.size, granted))
+            await self.finished.wait()
+
+    async def finish(self) -> None:
+        self.finished.set()
+        await self.task
+
+
+@pytest.mark.asyncio
+async def test_connections_are_limited_by_budgets() -> None:
+    scheduler = TransferScheduler(max_connections=6, max_connections_per_dc=4,
+                                  max_connections_per_user=10, max_connections_per_transfer=3,
+                                  max_bytes_in_flight=100 * PART)
+    async with AsyncExitStack() as stack:
+        assert await start(stack, scheduler, connections=8) == 3
+        assert await start(stack, scheduler, connections=8) == 1
+        # The DC 2 budget is used up, but other DCs still have room in the total budget
+        assert await start(stack, scheduler, dc_id=4, connections=8) == 2
+    assert scheduler._total == 0 and scheduler._bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_byte_budget_limits_connections() -> None:
+    scheduler = TransferScheduler(max_bytes_in_flight=3 * PART)
+    async with AsyncExitStack() as stack:
+        assert await start(stack, scheduler, connections=8) == 3
+
+
+@pytest.mark.asyncio
+async def test_oversized_transfer_runs_alone() -> None:
+    scheduler = TransferScheduler(max_bytes_in_flight=PART // 2)
+    async with AsyncExitStack() as stack:
+        assert await start(stack, scheduler, connections=4) == 1
+
+
+@pytest.mark.asyncio
+async def test_last_user_connection_is_kept_for_small_files() -> None:
+    scheduler = TransferScheduler(max_connections_per_user=4)
+    started = []
+    async with AsyncExitStack() as stack:
+        assert await start(stack, scheduler, connections=10) == 3
+        big = Transfer(scheduler, started, connections=10)
+        await asyncio.sleep(0)
+        assert started == []
+        assert await start(stack, scheduler, connections=1) == 1
+        big.task.cancel()
+    assert scheduler._total == 0 and scheduler._waiting == []
+
+
+@pytest.mark.asyncio
+async def test_single_connection_user_budget_does_not_starve_big_transfers() -> None:
+    scheduler = TransferScheduler(max_connections_per_user=1)
+    started = []
+    async with AsyncExitStack() as stack:
+        # Another user's transfer is running, so the bridge isn't idle
+        await start(stack, scheduler, user_id=2)
+        assert await asyncio.wait_for(start(stack, scheduler, connections=4), 1) == 1
+        big = Transfer(scheduler, started, connections=4)
+        await asyncio.sleep(0)
+        assert started == []
+    await big.finish()
+    assert started == [(10 * PART, 1)]
+    assert scheduler._total == 0
+
+
+@pytest.mark.asyncio
+async def test_user_without_transfers_gets_a_connection() -> None:
+    scheduler = TransferScheduler(max_connections_per_user=0)
+    async with AsyncExitStack() as stack:
+        await start(stack, scheduler, user_id=2)
+        assert await asyncio.wait_for(start(stack, scheduler, connections=4), 1) == 1
+
+
+@pytest.mark.asyncio
+async def test_waiting_transfers_are_admitted_smallest_first() -> None:
+    scheduler = TransferScheduler(max_connections=1)
+    started = []
+    first = Transfer(scheduler, started)
+    waiting = {size: Transfer(scheduler, started, size=size * PART) for size in (30, 10, 20)}
+    await asyncio.sleep(0)
+    await first.finish()
+    for size in (10, 20, 30):
+        await asyncio.sleep(0)
+        assert started[-1][0] == size * PART
+        await waiting[size].finish()
+    assert len(started) == 4
+
+
+@pytest.mark.asyncio
+async def test_users_with_fewer_connections_go_first() -> None:
+    scheduler = TransferScheduler(max_connections=3)
+    started = []
+    running = [Transfer(scheduler, started, user_id=user_id) for user_id in (1, 1, 3)]
+    await asyncio.sleep(0)
+    small = Transfer(scheduler, started, user_id=1, size=PART)
+    big = Transfer(scheduler, started, user_id=2, size=100 * PART)
+    await asyncio.sleep(0)
+    await running[0].finish()
+    await asyncio.sleep(0)
+    # User 1 still has a connection, so user 2's bigger file is admitted first
+    assert started[-1][0] == 100 * PART
+    await running[2].finish()
+    await asyncio.sleep(0)
+    assert started[-1][0] == PART
+    for transfer in (running[1], small, big):
+        await transfer.finish()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiting_transfer_leaves_queue() -> None:
+    scheduler = TransferScheduler(max_connections=1)
+    started = []
+    running = Transfer(scheduler, started)
+    cancelled = Transfer(scheduler, started)
+    after = Transfer(scheduler, started)
+    await asyncio.sleep(0)
+    cancelled.task.cancel()
+    # The slot is freed before the cancelled task has run again
+    await running.finish()
+    await asyncio.sleep(0)
+    assert cancelled.task.cancelled()
+    assert len(started) == 2
+    await after.finish()
+    assert scheduler._total == 0 and scheduler._waiting == []
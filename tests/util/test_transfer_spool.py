@@ -0,0 +1,94 @@
+from pathlib import Path
+from unittest.mock import patch
+import json
+
+import pytest
+
+from mautrix_telegram.util import transfer_spool
+from mautrix_telegram.util.transfer_spool import TransferSpool
+
+PART_SIZE = 1024
+SIZE = 3 * PART_SIZE - 100
+
+
+def make_spool(directory: Path, max_size: int = 1024 * 1024) -> TransferSpool:
+    return TransferSpool(str(directory), max_size=max_size, max_age=60)
+
+
+def part_data(part: int) -> bytes:
+    return bytes([part + 1]) * (PART_SIZE if part < 2 else SIZE - 2 * PART_SIZE)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_transfer_resumes(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spooled = await spool.open("download-test", SIZE, PART_SIZE)
+    assert spooled.missing_parts() == [0, 1, 2]
+    await spooled.write_part(0, part_data(0))
+    await spooled.write_part(2, part_data(2))
+    await spooled.mark_done(0)
+    await spool.release(spooled)
+
+    # A new spool, like after restarting the bridge
+    spool = make_spool(tmp_path)
+    resumed = await spool.open("download-test", SIZE, PART_SIZE)
+    assert resumed.missing_parts() == [1]
+    assert resumed.is_done(0) and not resumed.is_done(2)
+    assert await resumed.read_part(0) == part_data(0)
+    assert await resumed.read_part(2) == part_data(2)
+
+
+@pytest.mark.asyncio
+async def test_same_file_is_only_spooled_once(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spooled = await spool.open("download-test", SIZE, PART_SIZE)
+    assert await spool.open("download-test", SIZE, PART_SIZE) is None
+    await spool.release(spooled)
+    assert await spool.open("download-test", SIZE, PART_SIZE)
+
+
+@pytest.mark.asyncio
+async def test_changed_file_starts_over(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spooled = await spool.open("download-test", SIZE, PART_SIZE)
+    await spooled.write_part(0, part_data(0))
+    await spool.release(spooled)
+    resumed = await spool.open("download-test", SIZE + 1, PART_SIZE)
+    assert resumed.missing_parts() == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_checkpoints_are_throttled(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spooled = await spool.open("download-test", SIZE, PART_SIZE)
+    with patch.object(transfer_spool, "CHECKPOINT_INTERVAL", 3600):
+        for part in range(3):
+            await spooled.write_part(part, part_data(part))
+        with open(spooled.checkpoint_path) as file:
+            assert bytes.fromhex(json.load(file)["stored"]) == b"\x00"
+        await spool.release(spooled)
+    with open(spooled.checkpoint_path) as file:
+        assert bytes.fromhex(json.load(file)["stored"]) == b"\x07"
+
+
+@pytest.mark.asyncio
+async def test_finished_transfer_is_removed(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spooled = await spool.open("download-test", SIZE, PART_SIZE)
+    await spooled.remove()
+    assert list(tmp_path.iterdir()) == []
+    assert (await spool.open("download-test", SIZE, PART_SIZE)).missing_parts() == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_oldest_inactive_transfer_makes_room(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path, max_size=2 * SIZE)
+    first = await spool.open("download-first", SIZE, PART_SIZE)
+    second = await spool.open("download-second", SIZE, PART_SIZE)
+    # Both are still running, so there's no space for a third one
+    assert await spool.open("download-third", SIZE, PART_SIZE) is None
+    await spool.release(first)
+    await spool.release(second)
+    assert await spool.open("download-third", SIZE, PART_SIZE)
+    assert not Path(first.data_path).exists()
+    assert Path(second.data_path).exists()
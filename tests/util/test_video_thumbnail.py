@@ -0,0 +1,29 @@
+from typing import Any
+from unittest.mock import patch
+import asyncio
+
+import pytest
+
+from mautrix_telegram.util import process_pool, video_thumbnail
+
+
+@pytest.mark.asyncio
+async def test_ffmpeg_runs_are_limited_by_process_pool() -> None:
+    running = 0
+    max_running = 0
+
+    async def run_ffmpeg(*_: Any) -> bytes:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(running, max_running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return b"png"
+
+    with patch.object(video_thumbnail, "_run_ffmpeg_process", run_ffmpeg), \
+            patch.object(process_pool, "workers", 2), patch.object(process_pool, "_slots", None):
+        results = await asyncio.gather(*(video_thumbnail._run_ffmpeg("pipe:0", [b"video"],
+                                                                     (320, 320))
+                                         for _ in range(5)))
+    assert results == [b"png"] * 5
+    assert max_running == 2